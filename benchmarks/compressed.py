@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/compressed.py
+Memory versus recall trade-off of the compressed search index (utils/search.py) on synthetic hashes.
+The exact blas index is the reference. Half of the queries are near-duplicates of database hashes and
+half are unrelated, and the semantic decision (distance <= threshold of the nearest hash) is compared
+with the exact one. recall is measured against the exact nearest neighbor over all queries and
+dup_recall is the fraction of near-duplicate queries whose original hash is returned first.
+Usage (from the repo root):
+python -m benchmarks.compressed -n 100000 -c 64 128 256
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import time
+import numpy as np
+from utils.search import BlasIndex, CompressedIndex, supported_quantizers
+from benchmarks.search import synthetic_hashes, near_duplicates
+
+parser = argparse.ArgumentParser(description='Benchmark the compressed search index.')
+parser.add_argument('-n', '--num', default=20000, type=int, help='number of database hashes')
+parser.add_argument('-q', '--queries', default=200, type=int, help='number of queries')
+parser.add_argument('-D', '--dim', default=2048, type=int, help='hash dimension (2048 for ResNet50)')
+parser.add_argument('-c', '--components', nargs='+', default=[64, 128, 256], type=int, help='PCA dimensions')
+parser.add_argument('--quantizers', nargs='+', default=supported_quantizers, choices=supported_quantizers)
+parser.add_argument('--subvectors', default=32, type=int, help='number of pq sub-vectors')
+parser.add_argument('--rerank', default=64, type=int, help='number of re-ranked candidates')
+parser.add_argument('-o', '--output', default=None, help='optionally save the results as json')
+parser.add_argument('--seed', default=0, type=int)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    feats = synthetic_hashes(args.num, args.dim, args.seed)
+    dups, dup_ids = near_duplicates(feats, args.queries // 2, args.seed)
+    others = synthetic_hashes(args.queries - len(dups), args.dim, args.seed + 2)
+    queries = np.concatenate([dups, others])
+    exact_d, exact_i = BlasIndex().fit(feats).kneighbors(queries)
+    ths = np.full(args.num, np.median(exact_d), dtype=np.float32)  # half of the queries are semantic matches
+    exact_match = exact_d[:, 0] <= ths[exact_i[:, 0]]
+
+    results = [dict(quantizer='none', components=args.dim, bytes_per_hash=4 * args.dim, compression=1.,
+                    build_sec=0., query_ms=0., recall=1., dup_recall=1., decision_agreement=1.)]
+    for quantizer in args.quantizers:
+        for n_components in args.components:
+            start = time.time()
+            index = CompressedIndex(n_components=n_components, quantizer=quantizer, n_subvectors=args.subvectors,
+                                    rerank=args.rerank, seed=args.seed).fit(feats)
+            build = time.time() - start
+            start = time.time()
+            dist, ids = index.kneighbors(queries)
+            query = time.time() - start
+            match = dist[:, 0] <= ths[ids[:, 0]]
+            nbytes = index.codes.shape[1] * index.codes.itemsize
+            results.append(dict(quantizer=quantizer, components=n_components, bytes_per_hash=nbytes,
+                                compression=4. * args.dim / nbytes, build_sec=build,
+                                query_ms=1000 * query / len(queries),
+                                recall=float(np.mean(ids[:, 0] == exact_i[:, 0])),
+                                dup_recall=float(np.mean(ids[:len(dups), 0] == dup_ids)),
+                                decision_agreement=float(np.mean(match == exact_match))))
+    print('{:<9} {:>10} {:>8} {:>8} {:>10} {:>10} {:>8} {:>10} {:>9}'.format(
+        'quantizer', 'components', 'bytes', 'ratio', 'build(s)', 'ms/query', 'recall', 'dup_recall', 'decision'))
+    for res in results:
+        print('{quantizer:<9} {components:>10d} {bytes_per_hash:>8d} {compression:>8.1f} {build_sec:>10.2f} '
+              '{query_ms:>10.2f} {recall:>8.3f} {dup_recall:>10.3f} {decision_agreement:>9.3f}'.format(**res))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/decode.py
+Decode time of large jpeg photos at full resolution versus the reduced scale decode of utils/imageio.py,
+for the hashing stage (at least twice the 246x246 augmented image) and the geometry stage (--max-side).
+drift is the mean absolute difference (0-255) of the resized image the stage actually uses.
+Photos are generated from samples/cat.jpg (see benchmarks/geometry.py).
+Usage (from the repo root):
+python -m benchmarks.decode --megapixels 12 24 48 --max-side 1024
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image
+from utils.imageio import open_image
+from benchmarks.geometry import make_photos, best_time
+
+HASH_SIDE = 246  # augmented image size of ResNet50 (224 + 10% crop margin), see utils/extractor.py
+
+parser = argparse.ArgumentParser(description='Benchmark the reduced scale jpeg decode.')
+parser.add_argument('--megapixels', nargs='+', default=[12, 24], type=float, help='sizes of the synthetic photos')
+parser.add_argument('-m', '--max-side', default=1024, type=int, help='cap on the longer side of the geometry stage')
+parser.add_argument('-r', '--repeat', default=3, type=int, help='number of runs per setting (best is kept)')
+parser.add_argument('-o', '--output', default=None, help='optionally save the results as json')
+
+
+def hash_input(path, reduced):
+    """
+    image as resized by the hashing stage
+    """
+    im = open_image(path, 'RGB', min_size=(2 * HASH_SIDE, 2 * HASH_SIDE) if reduced else None)
+    return np.asarray(im.resize((HASH_SIDE, HASH_SIDE), Image.BILINEAR), dtype=np.float32)
+
+
+def geometry_input(path, max_side, reduced):
+    """
+    image as resized by the geometry stage
+    """
+    im = open_image(path, 'L', max_side=max_side if reduced else None)
+    im.thumbnail((max_side, max_side), Image.BILINEAR)
+    return np.asarray(im, dtype=np.float32)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp()
+    results = []
+    try:
+        for mp in args.megapixels:
+            _, photo = make_photos(folder, mp)
+            for stage, fn in [('hash', hash_input), ('geometry', lambda p, r: geometry_input(p, args.max_side, r))]:
+                full_sec, full = best_time(lambda: fn(photo, False), args.repeat)
+                sec, reduced = best_time(lambda: fn(photo, True), args.repeat)
+                results.append(dict(megapixels=mp, stage=stage, full_sec=full_sec, reduced_sec=sec,
+                                    speedup=full_sec / sec, drift=float(np.abs(full - reduced).mean())))
+    finally:
+        shutil.rmtree(folder)
+    print('{:>10} {:<9} {:>9} {:>11} {:>8} {:>7}'.format('megapixels', 'stage', 'full(s)', 'reduced(s)', 'speedup',
+                                                         'drift'))
+    for res in results:
+        print('{megapixels:>10.0f} {stage:<9} {full_sec:>9.3f} {reduced_sec:>11.3f} {speedup:>8.1f} '
+              '{drift:>7.2f}'.format(**res))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/geometry.py
+Latency of the geometry verification of check.py on large photos: the original full resolution path
+(defensive copies, flipped check always run) versus the bounded resolution path (jpeg decoded at reduced
+scale, images capped at --max-side, flipped check skipped when the first one matches). Both are timed
+from the paths of the query and the database photo to the decision, query decode included.
+A large synthetic photo and a near-duplicate of it are generated from samples/cat.jpg.
+Usage (from the repo root):
+python -m benchmarks.geometry --megapixels 24 --max-side 1024
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image
+from utils.geometry import geometry_matching, QueryFeatures, verify_geometry, MIN_INLINERS
+
+parser = argparse.ArgumentParser(description='Benchmark the geometry verification.')
+parser.add_argument('--megapixels', default=24, type=float, help='size of the synthetic database photo')
+parser.add_argument('-m', '--max-side', nargs='+', default=[512, 1024, 2048], type=int,
+                    help='caps on the longer side to be compared with full resolution')
+parser.add_argument('-r', '--repeat', default=3, type=int, help='number of runs per setting (best is kept)')
+parser.add_argument('-o', '--output', default=None, help='optionally save the results as json')
+parser.add_argument('--seed', default=0, type=int)
+
+
+def make_photos(folder, megapixels, seed=0):
+    """
+    large synthetic photo and a near-duplicate (rotated, cropped, downscaled, recompressed) of it
+    :return: path to the near-duplicate query, path to the database photo
+    """
+    rng = np.random.RandomState(seed)
+    src = Image.open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'samples',
+                                  'cat.jpg')).convert('RGB')
+    scale = np.sqrt(megapixels * 1e6 / (src.size[0] * src.size[1]))
+    big = src.resize((int(src.size[0] * scale), int(src.size[1] * scale)), Image.BICUBIC)
+    noise = rng.randint(-8, 9, size=(big.size[1], big.size[0], 1))  # sensor-like texture
+    big = Image.fromarray(np.uint8(np.clip(np.asarray(big, dtype=np.int16) + noise, 0, 255)))
+    db_path, query_path = os.path.join(folder, 'photo.jpg'), os.path.join(folder, 'query.jpg')
+    big.save(db_path, quality=90)
+    w, h = big.size
+    dup = big.rotate(3, Image.BILINEAR).crop((w // 20, h // 20, w - w // 20, h - h // 20))
+    dup.resize((dup.size[0] // 2, dup.size[1] // 2), Image.BILINEAR).save(query_path, quality=80)
+    return query_path, db_path
+
+
+def original_path(query, candidate):
+    """
+    geometry check as done originally in check.py
+    """
+    query = np.array(Image.open(query).convert('L'))  # full resolution decode of the query
+    img_candidate = np.array(Image.open(candidate).convert('L'))
+    inliners1, total1 = geometry_matching(np.copy(query), np.copy(img_candidate))
+    inliners2, total2 = geometry_matching(np.copy(query[:, ::-1]), np.copy(img_candidate))
+    return max(inliners1, inliners2) > MIN_INLINERS, max(inliners1, inliners2)
+
+
+def bounded_path(query, candidate, max_side):
+    """
+    geometry check as done in check.py with --max-side
+    """
+    decision, inliners, _ = verify_geometry(QueryFeatures(query, max_side), candidate, max_side=max_side)
+    return decision, inliners
+
+
+def best_time(fn, repeat):
+    """
+    :return: (best wall time in seconds, result of fn)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        res = fn()
+        times.append(time.time() - start)
+    return min(times), res
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp()
+    try:
+        query, candidate = make_photos(folder, args.megapixels, args.seed)
+        results = []
+        sec, (decision, inliners) = best_time(lambda: original_path(query, candidate), args.repeat)
+        results.append(dict(path='original', max_side=0, sec=sec, duplicate=bool(decision), inliners=int(inliners)))
+        for max_side in args.max_side:
+            sec, (decision, inliners) = best_time(lambda: bounded_path(query, candidate, max_side), args.repeat)
+            results.append(dict(path='bounded', max_side=max_side, sec=sec, duplicate=bool(decision),
+                                inliners=int(inliners)))
+    finally:
+        shutil.rmtree(folder)
+    print('{:<9} {:>8} {:>8} {:>8} {:>10} {:>9}'.format('path', 'max_side', 'sec', 'speedup', 'duplicate',
+                                                       'inliners'))
+    for res in results:
+        res['speedup'] = results[0]['sec'] / res['sec']
+        print('{path:<9} {max_side:>8d} {sec:>8.3f} {speedup:>8.1f} {duplicate!s:>10} {inliners:>9d}'.format(**res))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
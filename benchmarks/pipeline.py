@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/pipeline.py
+Offline benchmark suite of the hashing and query pipeline, to compare runs before and after a change.
+Nothing is downloaded: images are synthetic, the model is randomly initialised (Extractor(weights=None),
+same speed as the imagenet weights) and the hash databases are synthetic (benchmarks/search.py).
+Stages (--stages):
+extraction: images/sec of Extractor.extract_batch per augmentation profile and of extract_stream
+append: cost of appending --append-rows rows to a database of each size, per backend (npz, h5, mmap)
+search: index build time and memory, single query latency percentiles and batch throughput per algorithm
+geometry: geometry verification time of a large photo at full and bounded resolution (benchmarks/geometry.py)
+Only the extraction stage needs tensorflow; geometry needs opencv, the others only numpy/h5py/sklearn.
+The synthetic databases are written block by block to a memory-mapped database in --workdir, so sizes
+up to 10M rows only need disk space (10M x 2048 float32 = 80GB; use a smaller --dim to scale down).
+The index memory is measured with tracemalloc: build_peak_mb is the peak of the allocations during the
+build and index_mb what the index keeps afterwards (the memory-mapped hashes themselves are not counted).
+Usage (from the repo root):
+python -m benchmarks.pipeline -n 10000 100000 1000000 -o pipeline.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from PIL import Image
+from utils.database import NumpyData, H5pyData, MemmapData
+from utils.search import build_search_index, supported_search_algorithms
+from benchmarks.search import synthetic_hashes, near_duplicates
+
+supported_stages = ['extraction', 'append', 'search', 'geometry']
+supported_backends = {'npz': NumpyData, 'h5': H5pyData, 'mmap': MemmapData}
+
+parser = argparse.ArgumentParser(description='Offline benchmark suite of the hashing and query pipeline.')
+parser.add_argument('--stages', nargs='+', default=supported_stages, choices=supported_stages)
+parser.add_argument('-n', '--sizes', nargs='+', default=[10000, 100000], type=int,
+                    help='numbers of rows of the synthetic hash databases')
+parser.add_argument('-D', '--dim', default=2048, type=int, help='hash dimension (2048 for ResNet50)')
+parser.add_argument('--arch', default='ResNet50', help='architecture of the extraction stage')
+parser.add_argument('--images', default=64, type=int, help='number of synthetic images of the extraction stage')
+parser.add_argument('--profiles', nargs='+', default=['full', 'centre'], help='augmentation profiles to time')
+parser.add_argument('-b', '--backends', nargs='+', default=sorted(supported_backends),
+                    choices=sorted(supported_backends), help='database backends of the append stage')
+parser.add_argument('--append-rows', default=1000, type=int, help='rows per timed append')
+parser.add_argument('-a', '--algorithms', nargs='+', default=supported_search_algorithms,
+                    choices=supported_search_algorithms, help='search algorithms of the search stage')
+parser.add_argument('-q', '--queries', default=100, type=int, help='number of queries of the search stage')
+parser.add_argument('--megapixels', default=12, type=float, help='size of the photo of the geometry stage')
+parser.add_argument('-m', '--max-side', nargs='+', default=[1024], type=int,
+                    help='caps on the longer side of the geometry stage, compared with full resolution')
+parser.add_argument('-r', '--repeat', default=3, type=int, help='number of runs of the timed operations')
+parser.add_argument('-w', '--workdir', default=None,
+                    help='folder for the synthetic data (default: a temporary folder, removed at the end)')
+parser.add_argument('-o', '--output', default=None, help='optionally save the results as json')
+parser.add_argument('--seed', default=0, type=int)
+
+
+def synthetic_images(folder, num, seed=0):
+    """
+    smooth random colour images of various sizes and aspect ratios, saved as jpeg
+    :param folder: output folder
+    :param num: number of images
+    :param seed: random seed
+    :return: list of paths
+    """
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(num):
+        w, h = rng.randint(320, 1280), rng.randint(240, 960)
+        im = Image.fromarray(rng.randint(0, 256, size=(h // 16 + 1, w // 16 + 1, 3)).astype(np.uint8))
+        path = os.path.join(folder, 'synthetic_%06d.jpg' % i)
+        im.resize((w, h), Image.BICUBIC).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def synthetic_database(path, num, dim, seed=0, block_size=65536):
+    """
+    memory-mapped database of synthetic hashes, written block by block so it can be larger than memory
+    the database is reused if it already exists with the same shape
+    :param path: database path (.mmap)
+    :return: MemmapData reader
+    """
+    if os.path.isdir(path):
+        db = MemmapData(path, 'r')
+        if db.n == num and db.dim == dim:
+            return db
+        shutil.rmtree(path)
+    writer = MemmapData(path, 'w')
+    for start in range(0, num, block_size):
+        n = min(block_size, num - start)
+        feats = synthetic_hashes(n, dim, seed + start)
+        writer.append(feats, np.full(n, 0.5 * np.sqrt(dim), dtype=np.float32))
+    return MemmapData(path, 'r')
+
+
+def percentiles(times):
+    """
+    :param times: durations in seconds
+    :return: dict of latency percentiles in ms
+    """
+    return {'p%d_ms' % p: 1000 * float(np.percentile(times, p)) for p in [50, 95, 99]}
+
+
+def bench_extraction(args, folder):
+    """
+    :return: list of result dicts
+    """
+    from utils.extractor import Extractor
+    paths = synthetic_images(folder, args.images, args.seed)
+    hasher = Extractor(args.arch, weights=None)
+    results = []
+    for profile in args.profiles:
+        hasher.extract_batch(paths[:2], profile=profile)  # warm up (graph building, buffer allocation)
+        times = []
+        for _ in range(args.repeat):
+            start = time.time()
+            hasher.extract_batch(paths, profile=profile)
+            times.append(time.time() - start)
+        results.append(dict(method='extract_batch', profile=profile, passes=hasher.n_aug[profile],
+                            images_per_sec=len(paths) / min(times)))
+    times = []
+    for _ in range(args.repeat):
+        start = time.time()
+        for _ in hasher.extract_stream(paths):
+            pass
+        times.append(time.time() - start)
+    results.append(dict(method='extract_stream', profile='full', passes=hasher.n_aug['full'],
+                        images_per_sec=len(paths) / min(times)))
+    return results
+
+
+def bench_append(args, db, folder):
+    """
+    :param db: synthetic database of one of the sizes
+    :return: list of result dicts
+    """
+    rng = np.random.RandomState(args.seed)
+    feats = synthetic_hashes(args.append_rows, db.dim, args.seed + 1)
+    ths = rng.rand(args.append_rows).astype(np.float32)
+    results = []
+    for backend in args.backends:
+        path = os.path.join(folder, 'append_%d.%s' % (db.n, backend))
+        writer = supported_backends[backend](path, 'w')
+        start = time.time()
+        for _, block, block_ths in db.iter_blocks():  # the npz backend has to hold the database in memory
+            writer.append(np.asarray(block), np.asarray(block_ths))
+        create = time.time() - start
+        times = []
+        for _ in range(args.repeat):
+            start = time.time()
+            writer.append(feats, ths)
+            times.append(time.time() - start)
+        del writer
+        results.append(dict(backend=backend, size=db.n, create_sec=create, append_rows=args.append_rows,
+                            append_sec=float(np.mean(times)),
+                            rows_per_sec=args.append_rows / float(np.mean(times))))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    return results
+
+
+def bench_search(args, db):
+    """
+    :param db: synthetic database of one of the sizes
+    :return: list of result dicts
+    """
+    feats = db.get_hashes()
+    rng = np.random.RandomState(args.seed)
+    ids = np.sort(rng.choice(db.n, min(db.n, args.queries), replace=False))
+    queries, truth = near_duplicates(np.asarray(db.get_rows(ids)), len(ids), args.seed)
+    truth = ids[truth]
+    results = []
+    for algorithm in args.algorithms:
+        build_search_index(np.asarray(feats[:1000]), algorithm)  # warm up (lazy imports)
+        tracemalloc.start()
+        start = time.time()
+        index = build_search_index(feats, algorithm)
+        build = time.time() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        single = []
+        for q in queries:
+            start = time.time()
+            index.kneighbors(q[None, :])
+            single.append(time.time() - start)
+        start = time.time()
+        _, found = index.kneighbors(queries)
+        batch = time.time() - start
+        res = dict(algorithm=algorithm, size=db.n, build_sec=build, build_peak_mb=peak / 2.**20,
+                   index_mb=current / 2.**20, batch_ms_per_query=1000 * batch / len(queries),
+                   recall=float(np.mean(found[:, 0] == truth)))
+        res.update(percentiles(single))
+        results.append(res)
+        del index
+    return results
+
+
+def bench_geometry(args, folder):
+    """
+    :return: list of result dicts
+    """
+    from benchmarks.geometry import make_photos, original_path, bounded_path, best_time
+    query, candidate = make_photos(folder, args.megapixels, args.seed)
+    query_image = Image.open(query).convert('RGB')
+    sec, (decision, inliners) = best_time(lambda: original_path(query, candidate), args.repeat)
+    results = [dict(path='original', max_side=0, megapixels=args.megapixels, sec=sec, duplicate=bool(decision),
+                    inliners=int(inliners))]
+    for max_side in args.max_side:
+        sec, (decision, inliners) = best_time(lambda: bounded_path(query_image, candidate, max_side), args.repeat)
+        results.append(dict(path='bounded', max_side=max_side, megapixels=args.megapixels, sec=sec,
+                            duplicate=bool(decision), inliners=int(inliners)))
+    return results
+
+
+def print_table(rows, columns):
+    """
+    :param rows: result dicts
+    :param columns: keys to be printed
+    """
+    print(' '.join('{:>14}'.format(c[:14]) for c in columns))
+    for row in rows:
+        print(' '.join('{:>14.4g}'.format(row[c]) if isinstance(row[c], float) else '{:>14}'.format(str(row[c]))
+                       for c in columns))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    folder = args.workdir or tempfile.mkdtemp()
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    report = dict(config=vars(args), environment=dict(python=sys.version.split()[0], numpy=np.__version__,
+                                                      platform=platform.platform(), cpus=os.cpu_count()),
+                  started=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    try:
+        if 'extraction' in args.stages:
+            print('Extraction stage ...')
+            report['extraction'] = bench_extraction(args, folder)
+            print_table(report['extraction'], ['method', 'profile', 'passes', 'images_per_sec'])
+        if 'append' in args.stages or 'search' in args.stages:
+            report.update((stage, []) for stage in ['append', 'search'] if stage in args.stages)
+            for size in args.sizes:
+                print('Synthetic database of %d rows ...' % size)
+                db = synthetic_database(os.path.join(folder, 'synthetic_%d_%d.mmap' % (size, args.dim)), size,
+                                        args.dim, args.seed)
+                if 'append' in args.stages:
+                    report['append'].extend(bench_append(args, db, folder))
+                if 'search' in args.stages:
+                    report['search'].extend(bench_search(args, db))
+            if 'append' in args.stages:
+                print('Append stage:')
+                print_table(report['append'], ['backend', 'size', 'create_sec', 'append_sec', 'rows_per_sec'])
+            if 'search' in args.stages:
+                print('Search stage:')
+                print_table(report['search'], ['algorithm', 'size', 'build_sec', 'build_peak_mb', 'index_mb',
+                                               'p50_ms', 'p95_ms', 'p99_ms', 'batch_ms_per_query', 'recall'])
+        if 'geometry' in args.stages:
+            print('Geometry stage ...')
+            report['geometry'] = bench_geometry(args, folder)
+            print_table(report['geometry'], ['path', 'max_side', 'sec', 'duplicate', 'inliners'])
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(folder)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results saved at %s.' % args.output)
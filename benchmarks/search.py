@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/search.py
+Compare the sklearn ball tree with the blas search engine (utils/search.py) on synthetic hashes:
+build time, single-query and batch query latency, and agreement of the returned neighbors.
+Usage (from the repo root):
+python -m benchmarks.search -n 100000 -q 100
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import time
+import numpy as np
+from utils.search import build_search_index, supported_search_algorithms
+
+parser = argparse.ArgumentParser(description='Benchmark the nearest neighbor search engines.')
+parser.add_argument('-n', '--num', default=20000, type=int, help='number of database hashes')
+parser.add_argument('-q', '--queries', default=100, type=int, help='number of queries')
+parser.add_argument('-D', '--dim', default=2048, type=int, help='hash dimension (2048 for ResNet50)')
+parser.add_argument('-a', '--algorithms', nargs='+', default=supported_search_algorithms,
+                    choices=supported_search_algorithms)
+parser.add_argument('-o', '--output', default=None, help='optionally save the results as json')
+parser.add_argument('--seed', default=0, type=int)
+
+
+def synthetic_hashes(num, dim, seed=0):
+    """
+    non-negative, clustered hashes resembling pooled relu activations
+    :param num: number of hashes
+    :param dim: hash dimension
+    :param seed: random seed
+    :return: num x dim float32
+    """
+    rng = np.random.RandomState(seed)
+    centres = np.abs(rng.randn(max(1, num // 100), dim)).astype(np.float32)
+    feats = centres[rng.randint(len(centres), size=num)]
+    feats += 0.5 * np.abs(rng.randn(num, dim)).astype(np.float32)
+    return feats
+
+
+def near_duplicates(feats, num, seed=0):
+    """
+    queries made of slightly perturbed database hashes
+    :return: (queries, ids of the original database hashes)
+    """
+    rng = np.random.RandomState(seed + 1)
+    ids = rng.randint(len(feats), size=num)
+    return feats[ids] + 0.01 * rng.randn(num, feats.shape[1]).astype(np.float32), ids
+
+
+def bench(algorithm, feats, queries):
+    """
+    :return: dict of timings (seconds) and the batch search result ids
+    """
+    start = time.time()
+    index = build_search_index(feats, algorithm)
+    build = time.time() - start
+    single = []
+    for q in queries:
+        start = time.time()
+        index.kneighbors(q[None, :])
+        single.append(time.time() - start)
+    start = time.time()
+    _, ids = index.kneighbors(queries)
+    batch = time.time() - start
+    return dict(algorithm=algorithm, build_sec=build, query_p50_ms=1000 * float(np.percentile(single, 50)),
+                query_p95_ms=1000 * float(np.percentile(single, 95)),
+                batch_ms_per_query=1000 * batch / len(queries)), ids[:, 0]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    feats = synthetic_hashes(args.num, args.dim, args.seed)
+    queries, truth = near_duplicates(feats, args.queries, args.seed)
+    results = []
+    print('{:<10} {:>10} {:>10} {:>10} {:>14} {:>8}'.format('algorithm', 'build(s)', 'p50(ms)', 'p95(ms)',
+                                                             'batch(ms/q)', 'recall'))
+    for algorithm in args.algorithms:
+        res, ids = bench(algorithm, feats, queries)
+        res.update(num=args.num, dim=args.dim, recall=float(np.mean(ids == truth)))
+        results.append(res)
+        print('{algorithm:<10} {build_sec:>10.3f} {query_p50_ms:>10.2f} {query_p95_ms:>10.2f} '
+              '{batch_ms_per_query:>14.3f} {recall:>8.3f}'.format(**res))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/startup.py
+Startup time of a short-lived query process (check.py) per search index format, measured in a fresh
+python process each run:
+imports: python start and `import check` (tensorflow, cv2, h5py, pandas and sklearn are deferred)
+resources: check.load_resources(), i.e. opening the database and loading the search index
+first_query: the first nearest neighbor search (the pages of a memory-mapped index are read here)
+total: wall time from launching the process to the first search result, seen by the parent
+heavy_modules: which of the deferred modules ended up imported
+With --model the Extractor is also built (randomly initialised, no download) and its time reported.
+The database is a synthetic memory-mapped one storing its image paths (as written by ingest.py, so no
+image list is loaded); indexes are saved as a pickle file (.pkl) and as a directory of memory-mapped
+arrays (.index), see utils/search.py.
+Usage (from the repo root):
+python -m benchmarks.startup -n 100000 -D 2048 -a blas compressed ball_tree
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from utils.database import MemmapData
+from utils.search import IncrementalIndex, save_search_index, supported_search_algorithms
+from benchmarks.search import synthetic_hashes
+
+HEAVY_MODULES = ['tensorflow', 'cv2', 'h5py', 'pandas', 'sklearn']
+
+# run in the child process: argv = database, search index, build the model (0/1)
+CHILD = """
+import sys, time, json
+launch = time.time()
+import check
+imported = time.time()
+ths, search, img_lst = check.load_resources(sys.argv[1], sys.argv[2], None)
+loaded = time.time()
+import numpy as np
+search.kneighbors(np.ones((1, %d), dtype=np.float32))
+searched = time.time()
+res = dict(imports=imported - launch, resources=loaded - imported, first_query=searched - loaded)
+if sys.argv[3] == '1':
+    from utils.extractor import Extractor
+    Extractor(weights=None)
+    res['model'] = time.time() - searched
+res['heavy_modules'] = [m for m in %r if m in sys.modules]
+print('RESULT ' + json.dumps(res))
+"""
+
+parser = argparse.ArgumentParser(description='Benchmark the startup time of check.py.')
+parser.add_argument('-n', '--size', default=100000, type=int, help='number of database rows')
+parser.add_argument('-D', '--dim', default=2048, type=int, help='hash dimension')
+parser.add_argument('-a', '--algorithms', nargs='+', default=['blas', 'compressed'],
+                    choices=supported_search_algorithms, help='search indexes to compare')
+parser.add_argument('--model', action='store_true', default=False, help='also build the model (needs tensorflow)')
+parser.add_argument('-r', '--repeat', default=3, type=int, help='number of runs per setting (best is kept)')
+parser.add_argument('-w', '--workdir', default=None, help='folder of the database and indexes (default: temporary)')
+parser.add_argument('-o', '--output', default=None, help='optionally save the results as json')
+
+
+def synthetic_database(path, num, dim, block_size=65536):
+    """
+    memory-mapped database of synthetic hashes and paths, reused if it already exists with the same shape
+    :param path: database path (.mmap)
+    :return: MemmapData reader
+    """
+    if os.path.isdir(path):
+        db = MemmapData(path, 'r')
+        if db.n == num and db.dim == dim and db.has_paths:
+            return db
+        shutil.rmtree(path)
+    writer = MemmapData(path, 'w')
+    for start in range(0, num, block_size):
+        n = min(block_size, num - start)
+        writer.append(synthetic_hashes(n, dim, start), np.full(n, 0.5 * np.sqrt(dim), dtype=np.float32),
+                      ['synthetic/%09d.jpg' % i for i in range(start, start + n)])
+    return MemmapData(path, 'r')
+
+
+def run_child(db_path, index_path, dim, model=False):
+    """
+    :return: dict of timings of one fresh query process
+    """
+    code = CHILD % (dim, HEAVY_MODULES)
+    start = time.time()
+    out = subprocess.check_output([sys.executable, '-c', code, db_path, index_path, '1' if model else '0'],
+                                  cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    total = time.time() - start
+    line = [l for l in out.decode('utf-8').splitlines() if l.startswith('RESULT ')][-1]
+    res = json.loads(line[len('RESULT '):])
+    res['total'] = total
+    return res
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    folder = args.workdir or tempfile.mkdtemp()
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    results = []
+    try:
+        db_path = os.path.join(folder, 'startup_%d_%d.mmap' % (args.size, args.dim))
+        db = synthetic_database(db_path, args.size, args.dim)
+        for algorithm in args.algorithms:
+            index = IncrementalIndex(algorithm).add_rows(db.get_hashes())
+            formats = ['pkl'] if algorithm == 'ball_tree' else ['pkl', 'index']  # see utils/search.py
+            for fmt in formats:
+                path = os.path.join(folder, 'startup_%s.%s' % (algorithm, fmt))
+                save_search_index(index, path)
+                runs = [run_child(db_path, path, args.dim, args.model) for _ in range(args.repeat)]
+                best = min(runs, key=lambda r: r['total'])
+                best.update(algorithm=algorithm, format=fmt, rows=args.size, dim=args.dim)
+                results.append(best)
+            del index
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(folder)
+    print('{:<11} {:<6} {:>9} {:>10} {:>12} {:>8} {:>8}  {}'.format(
+        'algorithm', 'format', 'imports', 'resources', 'first_query', 'model', 'total', 'heavy modules'))
+    for res in results:
+        row = dict(res, model='%.3f' % res['model'] if 'model' in res else '-',
+                   heavy=','.join(res['heavy_modules']) or '-')
+        print('{algorithm:<11} {format:<6} {imports:>9.3f} {resources:>10.3f} {first_query:>12.3f} {model:>8} '
+              '{total:>8.3f}  {heavy}'.format(**row))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+build_keypoints.py
+Precompute the ORB keypoints and descriptors of the database images for geometry verification,
+so that check.py does not need to read the original database images at query time.
+Only the images not in the store yet are processed, so the command can be re-run after new images
+are added to the database (or to resume an interrupted run). Unreadable images are stored without
+keypoints (they never pass the geometry verification) with a warning.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import numpy as np
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from utils.database import KeypointData, get_database_reader
+from utils.geometry import orb_features, load_grey
+
+parser = argparse.ArgumentParser(description='Precompute ORB features of the database images.')
+parser.add_argument('-l', '--image-list', help='a list (txt, csv) containing full path to the database images')
+parser.add_argument('-d', '--hash-database', default=None,
+                    help='instead of -l, read the image paths stored in this database (see ingest.py)')
+parser.add_argument('-o', '--output', help='output keypoint store (hdf5)')
+parser.add_argument('-w', '--workers', default=4, type=int, help='number of threads (opencv releases the GIL)')
+parser.add_argument('-m', '--max-side', default=None, type=int,
+                    help='downscale images to this longer side, should match check.py --max-side')
+parser.add_argument('-b', '--batch', default=1000, type=int, help='number of images written at a time')
+
+
+def image_features(path, max_side=None):
+    """
+    :param path: path to a database image
+    :param max_side: cap on the longer side of the image
+    :return: ORB keypoint coordinates and descriptors of the image, empty for an unreadable image
+    """
+    try:
+        return orb_features(load_grey(path, max_side))
+    except Exception as e:  # stored as an image without keypoints, so a rerun does not stop here again
+        print('Warning! No keypoints for %s: %s' % (path, e))
+        return np.zeros((0, 2), dtype=np.float32), np.zeros((0, 32), dtype=np.uint8)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.image_list:
+        import pandas as pd  # slow to import, only loaded when a list is read
+        img_lst = pd.read_csv(args.image_list, header=None)[0].tolist()
+    else:
+        img_lst = get_database_reader(args.hash_database).get_paths()
+        assert img_lst is not None, 'Error! %s stores no image paths, give the image list (-l).' % args.hash_database
+    store = KeypointData(args.output, 'w')
+    start = len(store)
+    print('%d images in the store, %d to process.' % (start, len(img_lst) - start))
+    pool = ThreadPool(args.workers)
+    for i in range(start, len(img_lst), args.batch):
+        store.append(pool.map(partial(image_features, max_side=args.max_side), img_lst[i:i+args.batch]))
+        print('%d/%d images done.' % (min(i + args.batch, len(img_lst)), len(img_lst)))
+    pool.close()
+    print('Done. Keypoints saved at %s.' % args.output)
@@ -4,6 +4,10 @@
 build_searchtree.py
 Created on Aug 22 2019 12:13
 Creat a search model for nearest neighbor search
+--update only indexes the database rows appended since the last build (saved as <output>.delta)
+--compact merges the main index and its delta into a single index
+An output ending with .index is saved as a directory of memory-mapped arrays, which loads instantly
+(blas and compressed only, see utils/search.py); other outputs are pickled.
 @author: Tu Bui tb0035@surrey.ac.uk
 """
 
@@ -12,10 +16,10 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
-import numpy as np
-import pickle
-from sklearn.neighbors import NearestNeighbors as NN
-from utils.database import get_database_reader
+import time
+from utils.database import get_database_reader, read_hashes
+from utils.search import IncrementalIndex, load_search_index, save_search_index, remove_search_index, \
+    is_directory_index, directory_index_parts, supported_search_algorithms, supported_quantizers
 
 IN = '/vol/vssp/cvpnobackup/scratch_4weeks/tb0035/projects/archangel/tmp/hash_database.npz'
 OUT = '/vol/vssp/cvpnobackup/scratch_4weeks/tb0035/projects/archangel/tmp/search_index.pkl'
@@ -23,16 +27,57 @@ num = 1  # number of nearest neighbors to be returned
 
 parser = argparse.ArgumentParser(description='Input arguments.')
 parser.add_argument('-i', '--input', default=IN, help='hash database')
-parser.add_argument('-o', '--output', default=OUT, help='output search index')
+parser.add_argument('-o', '--output', default=OUT,
+                    help='output search index: a directory of memory-mapped arrays if it ends with .index '
+                         '(fast to load), a pickle file otherwise')
 parser.add_argument('-n', '--num', default=num, help='number of nearest neighbors', type=int)
+parser.add_argument('-a', '--algorithm', default='ball_tree', choices=supported_search_algorithms,
+                    help='ball_tree (sklearn) or blas (exact blocked matrix multiplication, '
+                         'much faster to build and query for high dimensional hashes) '
+                         'or compressed (PCA + quantisation, re-ranked with the database hashes)')
+parser.add_argument('--components', default=256, type=int, help='compressed index: PCA dimension')
+parser.add_argument('--quantizer', default='int8', choices=supported_quantizers,
+                    help='compressed index: int8 (1 byte per component) or pq (1 byte per sub-vector)')
+parser.add_argument('--subvectors', default=32, type=int, help='compressed index: number of pq sub-vectors')
+parser.add_argument('--rerank', default=64, type=int,
+                    help='compressed index: number of candidates re-ranked with the full-precision hashes')
+parser.add_argument('-u', '--update', action='store_true', default=False,
+                    help='only index the rows appended to the database since the last build')
+parser.add_argument('-c', '--compact', action='store_true', default=False,
+                    help='merge the index and its delta into a single index (can run while queries are served)')
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
+    if not (args.update or args.compact):  # fail before a long build rather than when saving it
+        assert not is_directory_index(args.output) or args.algorithm in directory_index_parts, \
+            'Error! A %s index cannot be saved as a directory index (.index), use a .pkl file.' % args.algorithm
     print('Loading hash database from %s.' % args.input)
     db = get_database_reader(args.input)
-    feats = db.get_hashes()
-    nbrs = NN(args.num, algorithm='ball_tree').fit(feats)
-    with open(args.output, 'wb') as f:
-        pickle.dump(nbrs, f)
-    print('Done. Search index saved at %s.' % args.output)
+    start = time.time()
+    delta_path = args.output.rstrip('/') + '.delta'
+    if args.update:
+        main = load_search_index(args.output, delta=False)
+        n0, n = main.n_rows, len(db.get_thresholds())
+        # the delta always covers every row after the main index, so it is rebuilt rather than stacked
+        delta = IncrementalIndex(main.algorithm, main.n_neighbors, **main.kwargs)
+        delta.add_rows(read_hashes(db, n0, n), n0)
+        save_search_index(delta, delta_path)
+        print('Indexed %d new hashes (rows %d-%d) in %.2f seconds.' % (n - n0, n0, n - 1, time.time() - start))
+        print('Done. Delta index saved at %s.' % delta_path)
+    elif args.compact:
+        nbrs = load_search_index(args.output).compact(db)
+        save_search_index(nbrs, args.output)
+        remove_search_index(delta_path)
+        print('Compacted index over %d hashes in %.2f seconds.' % (nbrs.n_rows, time.time() - start))
+        print('Done. Search index saved at %s.' % args.output)
+    else:
+        kwargs = {}
+        if args.algorithm == 'compressed':
+            kwargs = dict(n_components=args.components, quantizer=args.quantizer, n_subvectors=args.subvectors,
+                          rerank=args.rerank)
+        nbrs = IncrementalIndex(args.algorithm, args.num, **kwargs).add_rows(db.get_hashes())
+        print('Built %s index over %d hashes in %.2f seconds.' % (args.algorithm, nbrs.n_rows, time.time() - start))
+        save_search_index(nbrs, args.output)
+        remove_search_index(delta_path)  # stale delta of a previous index
+        print('Done. Search index saved at %s.' % args.output)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+build_shards.py
+Split a hash database and its image list into shards, build a search index per shard and write the
+manifest used by check.py, server.py and shard_worker.py (see utils/shards.py), e.g.
+python build_shards.py -d hash_database.h5 -l image_list.txt -n 4 -o shards/ -a blas
+python check.py -i my_test_image.jpg -d shards/shards.json
+The hashes are streamed block by block so the database does not need to fit in memory.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import argparse
+import numpy as np
+from utils.database import get_database_reader, NumpyData, H5pyData, MemmapData
+from utils.search import IncrementalIndex, save_search_index, supported_search_algorithms, directory_index_parts
+from utils.shards import write_manifest
+
+shard_formats = {'npz': NumpyData, 'h5': H5pyData, 'mmap': MemmapData}
+
+parser = argparse.ArgumentParser(description='Split a hash database into shards.')
+parser.add_argument('-d', '--hash-database', help='hash database file')
+parser.add_argument('-l', '--image-list', default=None,
+                    help='a list (txt, csv) containing full path to images; not needed if the database stores '
+                         'them (ingest.py)')
+parser.add_argument('-n', '--num-shards', default=2, type=int, help='number of shards')
+parser.add_argument('-o', '--output', help='output folder of the shards and their manifest (shards.json)')
+parser.add_argument('-f', '--format', default='mmap', choices=sorted(shard_formats), help='shard database format')
+parser.add_argument('-a', '--algorithm', default='blas', choices=supported_search_algorithms,
+                    help='search index of each shard, see build_searchtree.py')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    db = get_database_reader(args.hash_database)
+    if args.image_list:
+        import pandas as pd  # slow to import, only loaded when a list is read
+        img_lst = pd.read_csv(args.image_list, header=None)[0].tolist()
+    else:
+        img_lst = db.get_paths()
+    assert img_lst is not None, 'Error! %s stores no image paths, give the image list (-l).' % args.hash_database
+    n = len(db.get_thresholds())
+    assert n == len(img_lst), 'Error! %d hashes but %d images.' % (n, len(img_lst))
+    assert 0 < args.num_shards <= n, 'Error! Cannot split %d hashes into %d shards.' % (n, args.num_shards)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    bounds = np.linspace(0, n, args.num_shards + 1).astype(np.int64)
+    names = ['shard_%03d' % i for i in range(args.num_shards)]
+    writers = [shard_formats[args.format](os.path.join(args.output, '%s.%s' % (name, args.format)), 'w')
+               for name in names]
+    start = time.time()
+    for first, feats, ths in db.iter_blocks():  # route each block to the shards it overlaps
+        for i in range(args.num_shards):
+            lo, hi = max(first, bounds[i]), min(first + len(ths), bounds[i + 1])
+            if lo < hi:
+                writers[i].append(np.asarray(feats[lo - first:hi - first]), np.asarray(ths[lo - first:hi - first]))
+    del writers
+    print('Split %d hashes into %d shards in %.2f seconds.' % (n, args.num_shards, time.time() - start))
+
+    # memory-mapped indexes load instantly, the others (ball_tree) can only be pickled, see utils/search.py
+    index_ext = '.index' if args.algorithm in directory_index_parts else '.pkl'
+    shards = []
+    for i, name in enumerate(names):
+        database = '%s.%s' % (name, args.format)
+        with open(os.path.join(args.output, name + '.txt'), 'w') as f:
+            f.write(''.join(path + '\n' for path in img_lst[bounds[i]:bounds[i + 1]]))
+        shard_db = get_database_reader(os.path.join(args.output, database))
+        nbrs = IncrementalIndex(args.algorithm).add_rows(shard_db.get_hashes())
+        save_search_index(nbrs, os.path.join(args.output, name + index_ext))
+        shards.append(dict(database=database, search_index=name + index_ext, image_list=name + '.txt',
+                           offset=int(bounds[i]), rows=int(bounds[i + 1] - bounds[i])))
+        print('Shard %d: rows %d-%d, %s index built.' % (i, bounds[i], bounds[i + 1] - 1, args.algorithm))
+    manifest = os.path.join(args.output, 'shards.json')
+    write_manifest(manifest, shards)
+    print('Done. Manifest saved at %s.' % manifest)
@@ -13,89 +13,381 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import pickle
-import numpy as np
-import pandas as pd
-from PIL import Image
-from utils.extractor import Extractor
-from utils.database import get_database_reader
-from utils.geometry import geometry_matching
+import json
+import time
+LAUNCH = time.time()  # before the other imports, for the startup time (see benchmarks/startup.py)
+from utils.extractor import Extractor, augmentation_profiles
+from utils.database import get_database_reader, KeypointData
+from utils.geometry import QueryFeatures, verify_geometry, MIN_INLINERS
+from utils.imageio import open_image
+from utils.search import BlasIndex, load_search_index
+from utils.shards import ShardedIndex
+from utils.metrics import metrics
+from utils.cache import FeatureCache
 import argparse
+# tensorflow (utils/extractor.py), cv2 (utils/geometry.py), h5py, pandas and sklearn are imported on first use
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-MIN_INLINERS = 10
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp']
 
 parser = argparse.ArgumentParser(description='Query an image against a database for near-duplicated detection.')
 parser.add_argument('-i', '--input', help='image to check')
-parser.add_argument('-d', '--hash-database', help='hash database file')
-parser.add_argument('-s', '--search-index', help='search index file')
-parser.add_argument('-l', '--image-list', help='a list (txt, csv) containing full path to images')
+parser.add_argument('-b', '--batch', default=None,
+                    help='batch mode: a list (txt, csv) or a directory of query images, checked instead of --input')
+parser.add_argument('-o', '--output', default=None,
+                    help='batch mode: json lines output, one result per query; queries already in it are skipped')
+parser.add_argument('--batch-size', default=64, type=int, help='batch mode: number of queries hashed together')
+parser.add_argument('-d', '--hash-database',
+                    help='hash database file, or manifest (.json) of a sharded database (see build_shards.py)')
+parser.add_argument('-s', '--search-index', default=None,
+                    help='search index file; if not given an exact blas index is built from the hash database')
+parser.add_argument('-l', '--image-list', default=None,
+                    help='a list (txt, csv) containing full path to images; not needed if the database stores '
+                         'them (ingest.py)')
+parser.add_argument('--shard-processes', action='store_true', default=False,
+                    help='sharded database: search the local shards in worker processes instead of this one')
+parser.add_argument('-k', '--keypoints', default=None,
+                    help='precomputed ORB features of the database images (see build_keypoints.py)')
+parser.add_argument('-t', '--top-k', default=1, type=int,
+                    help='number of nearest neighbors checked; semantic matches are verified in parallel')
+parser.add_argument('-w', '--workers', default=4, type=int, help='number of geometry verification threads')
+parser.add_argument('-m', '--max-side', default=None, type=int,
+                    help='downscale images to this longer side for the geometry check (default: full resolution)')
+parser.add_argument('-p', '--profile', default='full', choices=sorted(augmentation_profiles),
+                    help='augmentation profile used to hash the query image (see eval_profiles.py)')
+parser.add_argument('-r', '--reduced-decode', action='store_true', default=False,
+                    help='decode jpeg queries at reduced scale (see utils/imageio.py), needs --max-side')
+parser.add_argument('--cache', default=None,
+                    help='directory of a feature cache: files already hashed with the same settings are not '
+                         'hashed again (see utils/cache.py)')
+parser.add_argument('--cache-size', default=1024, type=float, help='size limit of the feature cache in MB')
+parser.add_argument('--metrics', default=None,
+                    help='save per-stage timings and counters to this file (Prometheus text if it ends with .prom, '
+                         'json otherwise)')
 parser.add_argument('-v', '--verbose', action='store_true', default=False)
 
 
-def neardup_detect(query, hasher, image_list, thresholds, search_index, verbose=True):
+def load_resources(hash_database, search_index, image_list, shard_processes=False):
     """
-    near duplication wrapper
-    :param query: [string] path to query image
+    load everything needed to answer queries (done once per process)
+    :param hash_database: [string] hash database file, or manifest (.json) of a sharded database whose
+                          shards hold their own search index and image list (see utils/shards.py)
+    :param search_index: [string] search index file, None to search the hash database with a blas index
+    :param image_list: [string] a list (txt, csv) containing full path to images, None to use the paths
+                       stored in the hash database (see ingest.py)
+    :param shard_processes: [bool] sharded database: search the local shards in worker processes
+    :return: [tuple] (thresholds, search_index, image_list)
+    """
+    if hash_database.endswith('.json'):
+        print('Loading sharded database ...')
+        search = ShardedIndex(hash_database, processes=shard_processes)
+        return search.thresholds, search, search.image_list  # indexed by global id, fetched from the shards
+
+    print('Loading hash database ...')
+    db = get_database_reader(hash_database)
+    ths = db.get_thresholds()
+
+    if search_index is None:
+        print('Building blas search index ...')
+        search = BlasIndex().fit(db.get_hashes())
+    else:
+        print('Loading search index ...')
+        search = load_search_index(search_index, db)  # rows appended since the last build included
+
+    if image_list is None:
+        img_lst = db.get_paths()  # read on access, nothing to load
+        assert img_lst is not None, 'Error! %s stores no image paths, give the image list (-l).' % hash_database
+    else:
+        import pandas as pd
+        img_lst = pd.read_csv(image_list, header=None)[0].tolist()  # list of paths of database images
+    return ths, search, img_lst
+
+
+def verify_candidates(query, candidates, image_list, keypoints=None, pool=None, max_side=None):
+    """
+    geometry check of several semantic candidates of a query, run concurrently (opencv releases the GIL)
+    stops as soon as one candidate is geometrically verified
+    :param query: [string/object] path to query image, PIL image or QueryFeatures
+    :param candidates: [list] (database id, distance) of the candidates, nearest first
+    :param image_list: [list] list of paths to database images
+    :param keypoints: [object] optional KeypointData store of the database images
+    :param pool: [object] ThreadPoolExecutor running the checks, None to run them one by one
+    :param max_side: [int] cap on the longer side of the images, None for full resolution
+    :return: [list] one dict per verified candidate (id, path, distance, inliners, total, duplicate)
+    """
+    if not isinstance(query, QueryFeatures):  # computed once for all candidates
+        query = QueryFeatures(query, max_side)
+
+    def check(candidate):
+        candidate_id, dist = candidate
+        decision, inliners, total = verify_geometry(query, image_list[candidate_id], candidate_id, keypoints,
+                                                    max_side)
+        return dict(id=int(candidate_id), path=image_list[candidate_id], distance=float(dist),
+                    inliners=int(inliners), total=int(total), duplicate=bool(decision))
+
+    verified = []
+    if pool is None or len(candidates) == 1:
+        for candidate in candidates:
+            verified.append(check(candidate))
+            if verified[-1]['duplicate']:
+                break
+        return verified
+    futures = [pool.submit(check, candidate) for candidate in candidates]
+    try:
+        for future in as_completed(futures):
+            verified.append(future.result())
+            if verified[-1]['duplicate']:
+                break
+    finally:
+        for future in futures:  # checks not started yet are dropped
+            future.cancel()
+    return verified
+
+
+def neardup_detect_batch(queries, hasher, image_list, thresholds, search_index, verbose=True, profile='full',
+                         keypoints=None, top_k=1, workers=4, max_side=None):
+    """
+    near duplication wrapper for a batch of queries
+    the queries are hashed in shared inference batches and searched with a single kneighbors call
+    :param queries: [list] paths to query images
     :param hasher: [object] an object of the Extractor class defined in utils/extractor.py
     :param image_list: [list] list of paths to database images
     :param thresholds: [list] semantic thresholds of the database images
     :param search_index: [object] search index object
     :param verbose: [bool] print out work steps if True
-    :return: [tuple] (neardup decision, closest_image_id, path_to_the_closest_image)
+    :param profile: [string] augmentation profile used to hash the queries, see utils/extractor.py
+    :param keypoints: [object] optional KeypointData store of the database images
+    :param top_k: [int] number of nearest neighbors checked; those passing the semantic check are
+                  geometrically verified in parallel until one matches
+    :param workers: [int] number of geometry verification threads
+    :param max_side: [int] cap on the longer side of the images in the geometry check, None for full resolution
+    :return: [list] (neardup decision, closest_image_id, path_to_the_closest_image, hash distance to it,
+             verified candidates) for each query. The closest image is the verified duplicate if any, the nearest
+             neighbor otherwise. The verified candidates are dicts, see verify_candidates()
     """
     if verbose:
-        print('Hashing query image ...')
-    feat, th = hasher.extract2(query)
-    feat = feat[None, ...]
+        print('Hashing %d query image(s) ...' % len(queries))
+    start = time.time()
+    metrics.inc('query.queries', len(queries))
+    metrics.observe('query.batch_size', len(queries))
+    # each query is decoded only once, at reduced scale (-r) to what both the hashing and the geometry check need
+    assert max_side or not hasher.decode_size, 'Error! Reduced decoding needs max_side (--max-side).'
+    decode = dict(min_size=hasher.decode_size, max_side=max_side) if hasher.decode_size else {}
+    # the queries are decoded one at a time and each decoded image is released once reduced to its rotated copies
+    # for the hashing (see Extractor.prepare()) and a greyscale copy (at most max_side) for the geometry check, so a
+    # batch of large photos is never held in memory while the crops of the whole batch still share the inference
+    # batches. The ORB features are only computed for the queries with semantic candidates, see verify_geometry()
+    prepared, geometries = [], []
+    for query in queries:
+        with metrics.timer('query.decode'):
+            image = open_image(query, 'RGB', **decode)
+            prepared.append(hasher.prepare(image, profile))
+            geometries.append(QueryFeatures(image, max_side))
+        del image
+    with metrics.timer('query.hash'):
+        keys = [hasher.cache_key(query, profile) for query in queries]  # None without a feature cache
+        feats, _ = hasher.extract_batch(prepared, profile=profile, cache_keys=keys)  # query thresholds are not used
+    del prepared
 
     if verbose:
         print('Nearest neighbor search ...')
-    dist, ids = search_index.kneighbors(feat)
-    candidate_id = ids[0][0]
-    dist = dist[0][0]
-    candidate_path = image_list[candidate_id]
+    with metrics.timer('query.search'):
+        dists, ids = search_index.kneighbors(feats, top_k)
 
     if verbose:
         print('Near-duplication checking ...')
+    semantic = [[(c, d) for c, d in zip(candidate_ids, dist) if d <= thresholds[c]]  # semantic check
+                for dist, candidate_ids in zip(dists, ids)]
+    for candidates in semantic:
+        metrics.observe('query.semantic_candidates', len(candidates))
+    pool = ThreadPoolExecutor(workers) if workers > 1 and (top_k > 1 or len(queries) > 1) else None
+    with metrics.timer('query.geometry'):
+        try:
+            # we need to read the query and candidates (or their stored keypoints) so will need paths to them
+            if pool is not None and len(queries) > 1:  # queries in parallel, candidates of a query one by one
+                verified_all = list(pool.map(
+                    lambda args: verify_candidates(args[0], args[1], image_list, keypoints, None, max_side)
+                    if args[1] else [], zip(geometries, semantic)))
+            else:  # candidates of the query in parallel
+                verified_all = [verify_candidates(query, candidates, image_list, keypoints, pool, max_side)
+                                if candidates else [] for query, candidates in zip(geometries, semantic)]
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False)
 
-    if dist > thresholds[candidate_id]:  # semantic check
-        msg = 'Semantic match: False. No near-duplicated image found.'
-        duplicate_decision = False
-    else:  # geometry check
-        msg = 'Found a semantic match.'
-        # we need to read the query and candidate images so will need physical paths to them
-        query = np.array(Image.open(args.input).convert('L'))
-        img_candidate = np.array(Image.open(candidate_path).convert('L'))
-        inliners1, total1 = geometry_matching(query, img_candidate)
-        inliners2, total2 = geometry_matching(query[:, ::-1], img_candidate)  # check flip version
-
-        if inliners1 > MIN_INLINERS or inliners2 > MIN_INLINERS:
-            msg += '\nGeometry matched. Duplicated found.'
-            duplicate_decision = True
-        else:
-            msg += '\nGeometry not matched. No duplication.'
-            duplicate_decision = False
-        inliners, total = (inliners1, total1) if inliners1 >= inliners2 else (inliners2, total2)
-        msg += '\n%d out of %d keypoints matched.' % (inliners, total)
-    if verbose:
-        print(msg)
-    return duplicate_decision, candidate_id, candidate_path
+    out = []
+    for dist, candidate_ids, candidates, verified in zip(dists, ids, semantic, verified_all):
+        candidate_id, distance, duplicate_decision = candidate_ids[0], dist[0], False
+        if not candidates:
+            msg = 'Semantic match: False. No near-duplicated image found.'
+        else:  # geometry check
+            msg = 'Found %d semantic match(es).' % len(candidates)
+            for res in verified:
+                msg += '\nCandidate #%d: %d out of %d keypoints matched.' % (res['id'], res['inliners'],
+                                                                             res['total'])
+            if verified[-1]['duplicate']:
+                candidate_id, distance, duplicate_decision = verified[-1]['id'], verified[-1]['distance'], True
+                msg += '\nGeometry matched. Duplicated found.'
+            else:
+                msg += '\nGeometry not matched. No duplication.'
+        if verbose:
+            print(msg)
+        metrics.observe('query.verified_candidates', len(verified))
+        metrics.inc('query.duplicates', int(duplicate_decision))
+        out.append((duplicate_decision, candidate_id, image_list[candidate_id], float(distance), verified))
+    metrics.observe('query.total', time.time() - start, timer=True)
+    return out
 
 
-if __name__ == '__main__':
-    args = parser.parse_args()
-    print('Loading hash database ...')
-    db = get_database_reader(args.hash_database)
-    ths = db.get_thresholds()
+def neardup_detect(query, hasher, image_list, thresholds, search_index, verbose=True, profile='full',
+                   keypoints=None, top_k=1, workers=4, max_side=None):
+    """
+    near duplication wrapper
+    :param query: [string] path to query image
+    :param hasher: [object] an object of the Extractor class defined in utils/extractor.py
+    :param image_list: [list] list of paths to database images
+    :param thresholds: [list] semantic thresholds of the database images
+    :param search_index: [object] search index object
+    :param verbose: [bool] print out work steps if True
+    :param profile: [string] augmentation profile used to hash the query, see utils/extractor.py
+    :param keypoints: [object] optional KeypointData store of the database images
+    :param top_k: [int] number of nearest neighbors checked, see neardup_detect_batch()
+    :param workers: [int] number of geometry verification threads
+    :param max_side: [int] cap on the longer side of the images in the geometry check, None for full resolution
+    :return: [tuple] (neardup decision, closest_image_id, path_to_the_closest_image)
+    """
+    return neardup_detect_batch([query], hasher, image_list, thresholds, search_index, verbose, profile,
+                                keypoints, top_k, workers, max_side)[0][:3]
+
+
+def list_queries(batch):
+    """
+    query images of the batch mode
+    :param batch: [string] a list (txt, csv) of paths or a directory searched recursively for images
+    :return: [list] paths to the query images
+    """
+    if not os.path.isdir(batch):
+        import pandas as pd
+        return pd.read_csv(batch, header=None)[0].tolist()
+    queries = []
+    for root, dirs, files in os.walk(batch):
+        dirs.sort()
+        queries.extend(os.path.join(root, f) for f in sorted(files)
+                       if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS)
+    return queries
+
+
+def read_done(output):
+    """
+    queries already answered in a json lines output, so an interrupted batch can be resumed
+    a trailing incomplete line (process killed while writing) is cut off the file
+    :param output: [string] json lines output of the batch mode
+    :return: [set] query paths
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, 'rb+') as f:
+        valid = 0
+        for line in f:
+            try:
+                done.add(json.loads(line.decode('utf-8'))['query'])
+            except (ValueError, KeyError):
+                break
+            valid += len(line)
+        f.truncate(valid)
+    return done
 
-    print('Loading search index ...')
-    with open(args.search_index, 'rb') as f:
-        search = pickle.load(f)
 
-    extract = Extractor()  # this object can be reused
-    img_lst = pd.read_csv(args.image_list, header=None)[0].tolist()  # list of paths of database images
+def neardup_detect_stream(queries, output, hasher, image_list, thresholds, search_index, batch_size=64,
+                          verbose=False, profile='full', keypoints=None, top_k=1, workers=4, max_side=None):
+    """
+    batch mode: check many queries and stream one json line per query to the output file
+    each batch of queries is hashed together, searched with a single kneighbors call and its candidates
+    geometrically verified in parallel (see neardup_detect_batch). Results are flushed after every batch;
+    queries already in the output are skipped so the job can be resumed after an interruption
+    :param queries: [list] paths to query images
+    :param output: [string] json lines output, appended to; None to print the lines
+    :param batch_size: [int] number of queries per batch
+    other params: see neardup_detect_batch()
+    :return: [tuple] (# queries checked, # duplicates found, # queries failed)
+    """
+    done = read_done(output) if output else set()
+    todo = [query for query in queries if query not in done]
+    print('%d queries, %d already checked, %d to go.' % (len(queries), len(queries) - len(todo), len(todo)))
+    n_dup = n_err = 0
+    f = open(output, 'a') if output else None
+    try:
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start + batch_size]
+            try:
+                out = neardup_detect_batch(batch, hasher, image_list, thresholds, search_index, verbose, profile,
+                                           keypoints, top_k, workers, max_side)
+            except Exception:  # e.g. unreadable image, fall back to one by one to isolate it
+                out = []
+                for query in batch:
+                    try:
+                        out.extend(neardup_detect_batch([query], hasher, image_list, thresholds, search_index,
+                                                        verbose, profile, keypoints, top_k, workers, max_side))
+                    except Exception as e:
+                        out.append(e)
+            lines = []
+            for query, out_i in zip(batch, out):
+                if isinstance(out_i, Exception):
+                    n_err += 1
+                    res = dict(query=query, error=str(out_i))
+                else:
+                    n_dup += int(out_i[0])
+                    best = [v for v in out_i[4] if v['id'] == out_i[1]]  # verified closest image, if any
+                    res = dict(query=query, duplicate=bool(out_i[0]), id=int(out_i[1]), path=out_i[2],
+                               distance=out_i[3], inliners=best[0]['inliners'] if best else None,
+                               candidates=out_i[4])
+                lines.append(json.dumps(res) + '\n')
+            if f is None:
+                print(''.join(lines), end='')
+            else:
+                f.write(''.join(lines))
+                f.flush()
+                print('Checked %d/%d queries, %d duplicates, %d errors.' % (min(start + batch_size, len(todo)),
+                                                                           len(todo), n_dup, n_err))
+    finally:
+        if f is not None:
+            f.close()
+    return len(todo), n_dup, n_err
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    assert args.max_side or not args.reduced_decode, \
+        'Error! --reduced-decode needs --max-side: each query is decoded once for the hashing and the geometry check.'
+    if args.metrics:
+        metrics.enable()
+    start = time.time()
+    metrics.observe('startup.imports', start - LAUNCH, timer=True)
+    ths, search, img_lst = load_resources(args.hash_database, args.search_index, args.image_list,
+                                          args.shard_processes)
+    metrics.observe('startup.resources', time.time() - start, timer=True)
+    start = time.time()
+    cache = FeatureCache(args.cache, args.cache_size) if args.cache else None
+    extract = Extractor(reduced_decode=args.reduced_decode, cache=cache)  # this object can be reused
+    kps = KeypointData(args.keypoints, 'r') if args.keypoints else None
+    metrics.observe('startup.model', time.time() - start, timer=True)
+    if args.verbose:
+        print('Ready %.2f seconds after launch (model: %.2f seconds).' % (time.time() - LAUNCH, time.time() - start))
 
-    dup_decision, nearest_img_id, nearest_img_path = neardup_detect(args.input, extract, img_lst, ths,
-                                                                    search, args.verbose)
-    print('Closest image id: #%d, path: %s' % (nearest_img_id, nearest_img_path))
-    print('Final decision: Duplication detect? {}'.format(dup_decision))
+    if args.batch:
+        neardup_detect_stream(list_queries(args.batch), args.output, extract, img_lst, ths, search,
+                              args.batch_size, args.verbose, args.profile, kps, args.top_k, args.workers,
+                              args.max_side)
+    else:
+        dup_decision, nearest_img_id, nearest_img_path, _, verified = neardup_detect_batch(
+            [args.input], extract, img_lst, ths, search, args.verbose, args.profile, kps, args.top_k,
+            args.workers, args.max_side)[0]
+        for res in verified:
+            print('Verified candidate #{id}: {path}, distance {distance:.4f}, {inliners} out of {total} keypoints '
+                  'matched, duplicate: {duplicate}'.format(**res))
+        print('Closest image id: #%d, path: %s' % (nearest_img_id, nearest_img_path))
+        print('Final decision: Duplication detect? {}'.format(dup_decision))
+    if args.metrics:
+        metrics.save(args.metrics)
+        print('Metrics saved at %s.' % args.metrics)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+client.py
+Thin client for the near-duplicate query service (server.py).
+Does not load tensorflow, so it starts instantly.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import socket
+import argparse
+
+SOCKET = '/tmp/image_hash.sock'
+
+parser = argparse.ArgumentParser(description='Query images against a running near-duplicate server.')
+parser.add_argument('-i', '--input', nargs='+', default=[], help='image(s) to check')
+parser.add_argument('--metrics', action='store_true', default=False,
+                    help='print the server metrics in Prometheus text format (server started with --metrics)')
+parser.add_argument('-u', '--socket', default=SOCKET, help='path of the server unix domain socket')
+
+
+def query_server(queries, socket_path=SOCKET):
+    """
+    send queries to the server and wait for the answers
+    :param queries: [list] paths to query images
+    :param socket_path: [string] path of the server unix domain socket
+    :return: [list] one result dict per query, see server.py
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        request = ''.join(json.dumps({'query': os.path.abspath(q)}) + '\n' for q in queries) + '\n'
+        sock.sendall(request.encode('utf-8'))
+        with sock.makefile('rb') as f:
+            return [json.loads(f.readline().decode('utf-8')) for _ in queries]
+    finally:
+        sock.close()
+
+
+def server_metrics(socket_path=SOCKET, fmt='prometheus'):
+    """
+    :param socket_path: [string] path of the server unix domain socket
+    :param fmt: [string] 'prometheus' for the text exposition format, 'json' for a snapshot dict
+    :return: [string/dict] per-stage timings and counters of the server, see utils/metrics.py
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        sock.sendall((json.dumps({'metrics': fmt}) + '\n\n').encode('utf-8'))
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))['metrics']
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    failed = False
+    for res in query_server(args.input, args.socket):
+        if 'error' in res:
+            print('%s: error: %s' % (res['query'], res['error']))
+            failed = True
+        else:
+            print('%s: closest image id: #%d, path: %s. Duplication detect? %s' % (
+                res['query'], res['id'], res['path'], res['duplicate']))
+    if args.metrics:
+        print(server_metrics(args.socket), end='')
+    sys.exit(1 if failed else 0)
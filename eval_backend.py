@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+eval_backend.py
+Accuracy drift and speed of the optimised inference backends (see utils/inference.py) against the float
+Keras model. Every query is hashed by each backend; the report gives the relative error of the hashes
+and thresholds and, if a hash database is given, how often the nearest database image and the semantic
+decision (distance <= database threshold) are the same as with the Keras hashes.
+e.g. python eval_backend.py -i query_list.txt -d hash_database.npz -q none dynamic int8 -c calib_list.txt
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import time
+import numpy as np
+from utils.extractor import Extractor, augmentation_profiles
+from utils.database import get_database_reader
+from utils.search import BlasIndex, load_search_index
+
+parser = argparse.ArgumentParser(description='Compare the tflite inference backend with the keras model.')
+parser.add_argument('-i', '--input', help='a list (txt, csv) of query images')
+parser.add_argument('-d', '--hash-database', default=None, help='optional hash database for the search drift')
+parser.add_argument('-s', '--search-index', default=None,
+                    help='search index file; if not given an exact blas index is built from the hash database')
+parser.add_argument('-q', '--quantize', nargs='+', default=['none', 'dynamic'], choices=['none', 'dynamic', 'int8'],
+                    help='tflite quantisations to be evaluated')
+parser.add_argument('-c', '--calibration', default=None,
+                    help='a list (txt, csv) of sample images for the int8 calibration (a few dozen is enough)')
+parser.add_argument('-t', '--threads', default=None, type=int, help='intra-op / interpreter threads')
+parser.add_argument('-p', '--profile', default='full', choices=sorted(augmentation_profiles),
+                    help='augmentation profile; use full to compare the thresholds')
+parser.add_argument('-o', '--output', default=None, help='optionally save the report as json')
+
+
+def hash_queries(hasher, queries, profile):
+    """
+    :return: hashes, thresholds, seconds per image
+    """
+    hasher.extract_batch(queries[:1], profile=profile)  # warm up
+    start = time.time()
+    feats, ths = hasher.extract_batch(queries, profile=profile)
+    return feats, ths, (time.time() - start) / max(1, len(queries))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    import pandas as pd  # slow to import, only loaded when a list is read
+    queries = pd.read_csv(args.input, header=None)[0].tolist()
+    calibration = pd.read_csv(args.calibration, header=None)[0].tolist() if args.calibration else None
+    search = None
+    if args.hash_database:
+        db = get_database_reader(args.hash_database)
+        db_ths = db.get_thresholds()
+        if args.search_index is None:
+            search = BlasIndex().fit(db.get_hashes())
+        else:
+            search = load_search_index(args.search_index, db)
+
+    results = {}
+    # one model at a time: deleting an Extractor clears the keras session
+    settings = [('keras', None)] + [('tflite', None if q == 'none' else q) for q in args.quantize]
+    for backend, quantize in settings:
+        name = backend if backend == 'keras' else 'tflite_%s' % (quantize or 'float32')
+        print('Hashing %d queries with %s ...' % (len(queries), name))
+        hasher = Extractor(backend=backend, quantize=quantize, calibration=calibration,
+                           intra_op_threads=args.threads)
+        feats, ths, sec = hash_queries(hasher, queries, args.profile)
+        del hasher
+        res = dict(feats=feats, ths=ths, sec_per_image=sec)
+        if search is not None:
+            dist, ids = search.kneighbors(feats)
+            res.update(ids=ids[:, 0], match=dist[:, 0] <= db_ths[ids[:, 0]])
+        results[name] = res
+
+    ref = results['keras']
+    report = []
+    print('\n{:<16} {:>10} {:>8} {:>10} {:>10} {:>8} {:>9}'.format(
+        'backend', 'sec/image', 'speedup', 'hash_err', 'th_err', 'same_nn', 'decision'))
+    for name, res in results.items():
+        row = dict(backend=name, sec_per_image=res['sec_per_image'],
+                   speedup=ref['sec_per_image'] / res['sec_per_image'],
+                   hash_rel_error=float(np.mean(np.linalg.norm(res['feats'] - ref['feats'], axis=1) /
+                                                np.maximum(np.linalg.norm(ref['feats'], axis=1), 1e-12))),
+                   threshold_rel_error=float(np.mean(np.abs(res['ths'] - ref['ths']) /
+                                                     np.maximum(ref['ths'], 1e-12))),
+                   same_nn=float(np.mean(res['ids'] == ref['ids'])) if search is not None else float('nan'),
+                   decision_agreement=float(np.mean(res['match'] == ref['match'])) if search is not None
+                   else float('nan'))
+        report.append(row)
+        print('{backend:<16} {sec_per_image:>10.4f} {speedup:>8.2f} {hash_rel_error:>10.5f} '
+              '{threshold_rel_error:>10.5f} {same_nn:>8.3f} {decision_agreement:>9.3f}'.format(**row))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Report saved at %s.' % args.output)
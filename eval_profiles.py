@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+eval_profiles.py
+Report the speed/recall trade-off of the query augmentation profiles (see utils/extractor.py).
+Each query is hashed with every profile and searched against the database. The semantic matches
+found with the 'full' profile are the reference; recall of a profile is the fraction of those
+matches it also finds (same database image, distance within the database threshold).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import time
+import numpy as np
+from utils.extractor import Extractor, augmentation_profiles
+from utils.database import get_database_reader
+from utils.search import BlasIndex, load_search_index
+
+parser = argparse.ArgumentParser(description='Compare query augmentation profiles against the full profile.')
+parser.add_argument('-i', '--input', help='a list (txt, csv) of query images, ideally known near-duplicates')
+parser.add_argument('-d', '--hash-database', help='hash database file')
+parser.add_argument('-s', '--search-index', default=None,
+                    help='search index file; if not given an exact blas index is built from the hash database')
+parser.add_argument('-p', '--profiles', nargs='+', default=['full', 'flips', 'centre'],
+                    choices=sorted(augmentation_profiles), help='profiles to be evaluated')
+parser.add_argument('-o', '--output', default=None, help='optionally save the report as json')
+
+
+def semantic_matches(feats, thresholds, search_index):
+    """
+    semantic near-duplicate check of a batch of query hashes
+    :param feats: query hashes NxD
+    :param thresholds: thresholds of the database images
+    :param search_index: search index object
+    :return: nearest database ids (N), boolean semantic match (N)
+    """
+    dist, ids = search_index.kneighbors(feats)
+    ids, dist = ids[:, 0], dist[:, 0]
+    return ids, dist <= thresholds[ids]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    import pandas as pd  # slow to import, only loaded when a list is read
+    queries = pd.read_csv(args.input, header=None)[0].tolist()
+    db = get_database_reader(args.hash_database)
+    ths = db.get_thresholds()
+    if args.search_index is None:
+        search = BlasIndex().fit(db.get_hashes())
+    else:
+        search = load_search_index(args.search_index, db)  # rows appended since the last build included
+    hasher = Extractor()
+
+    profiles = ['full'] + [p for p in args.profiles if p != 'full']  # full is the reference
+    results = {}
+    for profile in profiles:
+        print('Hashing %d queries with profile %s ...' % (len(queries), profile))
+        start = time.time()
+        feats, _ = hasher.extract_batch(queries, profile=profile)
+        elapsed = time.time() - start
+        ids, match = semantic_matches(feats, ths, search)
+        results[profile] = dict(passes=hasher.n_aug[profile], sec_per_image=elapsed / max(1, len(queries)),
+                                ids=ids, match=match)
+
+    ref = results['full']
+    report = []
+    print('\n{:<8} {:>6} {:>12} {:>8} {:>8} {:>8} {:>8}'.format(
+        'profile', 'passes', 'sec/image', 'speedup', 'matches', 'recall', 'same_nn'))
+    for profile in profiles:
+        res = results[profile]
+        found = res['match'] & ref['match'] & (res['ids'] == ref['ids'])
+        row = dict(profile=profile, passes=res['passes'], sec_per_image=res['sec_per_image'],
+                   speedup=ref['sec_per_image'] / res['sec_per_image'],
+                   matches=int(res['match'].sum()),
+                   recall=float(found.sum()) / max(1, ref['match'].sum()),
+                   same_nn=float(np.mean(res['ids'] == ref['ids'])))
+        report.append(row)
+        print('{profile:<8} {passes:>6d} {sec_per_image:>12.4f} {speedup:>8.1f} {matches:>8d} '
+              '{recall:>8.3f} {same_nn:>8.3f}'.format(**row))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Report saved at %s.' % args.output)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ingest.py
+Hash a (possibly huge) list of images into a database that also stores their paths, e.g.
+python ingest.py -l image_list.txt -o hash_database.mmap -c 10000 -w 8
+The list is streamed chunk by chunk, so it is never held in memory. After each chunk the hashes,
+thresholds and paths are appended together, so the database never needs a separate image list
+(check.py, server.py, selfjoin.py and build_shards.py read the paths from it when -l is not given).
+Unreadable images are skipped with a warning.
+Progress is kept in <output>.ckpt. If the run is interrupted, run the same command again: it resumes
+after the last chunk written to the database.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+from utils.extractor import Extractor
+from utils.database import get_database_reader, get_database_writer
+from utils.cache import FeatureCache
+
+parser = argparse.ArgumentParser(description='Hash a list of images into a database holding their paths.')
+parser.add_argument('-l', '--image-list', help='a list (txt, csv) containing full path to images')
+parser.add_argument('-o', '--output', help='hash database (npz, h5 or mmap), created or resumed')
+parser.add_argument('-c', '--chunk', default=10000, type=int, help='images per chunk (one append and checkpoint each)')
+parser.add_argument('-w', '--workers', default=4, type=int, help='number of decoding threads')
+parser.add_argument('-b', '--batch-size', default=32, type=int, help='number of crops per model.predict batch')
+parser.add_argument('-r', '--reduced-decode', action='store_true', default=False,
+                    help='decode jpeg images at reduced scale (see utils/imageio.py); hash the queries the same way')
+parser.add_argument('--cache', default=None,
+                    help='directory of a feature cache: files already hashed with the same settings are not '
+                         'hashed again (see utils/cache.py)')
+parser.add_argument('--cache-size', default=1024, type=float, help='size limit of the feature cache in MB')
+
+
+def read_checkpoint(output):
+    """
+    :param output: path to the database
+    :return: number of list entries already ingested, number of database rows
+    """
+    ckpt = output.rstrip('/') + '.ckpt'
+    n = len(get_database_reader(output).get_thresholds()) if os.path.exists(output) else 0
+    if not os.path.isfile(ckpt):
+        assert n == 0, 'Error! Database %s exists but has no checkpoint %s.' % (output, ckpt)
+        return 0, 0
+    with open(ckpt) as f:
+        state = json.load(f)
+    # the append of the last chunk is either complete or not visible (npz files are replaced atomically, hdf5
+    # and mmap databases ignore the rows of an incomplete append), see write_checkpoint()
+    if n == state.get('next_rows'):
+        return state['next_entries'], n
+    assert n == state['rows'], 'Error! Database has %d rows, checkpoint expects %d.' % (n, state['rows'])
+    return state['entries'], n
+
+
+def write_checkpoint(output, **state):
+    """
+    atomically replace the checkpoint of a database
+    Before an append it holds both the current and the next (entries, rows), after it only the next,
+    so a crash at any point can be resolved from the number of rows in the database.
+    :param output: path to the database
+    :param state: entries (list entries done), rows (database rows), optionally next_entries, next_rows
+    """
+    ckpt = output.rstrip('/') + '.ckpt'
+    with open(ckpt + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(ckpt + '.tmp', ckpt)
+
+
+def hash_chunk(hasher, paths, workers=4, batch_size=32):
+    """
+    :param hasher: Extractor
+    :param paths: list of image paths
+    :param workers: number of decoding threads
+    :param batch_size: number of crops per model.predict batch
+    :return: feats (Mxdim), thresholds (M), paths (M) of the readable images, in list order
+    """
+    out = {}
+    for i, feat, th in hasher.extract_stream(paths, workers=workers, batch_size=batch_size, skip_errors=True):
+        out[i] = (feat, th)
+    ids = sorted(out)
+    feats = np.array([out[i][0] for i in ids], dtype=np.float32).reshape(len(ids), -1)
+    ths = np.array([out[i][1] for i in ids], dtype=np.float32)
+    return feats, ths, [paths[i] for i in ids]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    done, rows = read_checkpoint(args.output)
+    print('Resuming after %d images (%d rows).' % (done, rows) if done else 'Starting a new database.')
+    cache = FeatureCache(args.cache, args.cache_size) if args.cache else None
+    hasher = Extractor(reduced_decode=args.reduced_decode, cache=cache)
+    db = get_database_writer(args.output)
+
+    start = time.time()
+    entries = 0
+    import pandas as pd  # slow to import, only loaded when a list is read
+    for chunk in pd.read_csv(args.image_list, header=None, chunksize=args.chunk):
+        paths = chunk[0].astype(str).str.strip().tolist()
+        if entries + len(paths) <= done:  # ingested by a previous run
+            entries += len(paths)
+            continue
+        paths = paths[max(0, done - entries):]
+        entries = max(entries, done)
+        feats, ths, kept = hash_chunk(hasher, paths, args.workers, args.batch_size)
+        write_checkpoint(args.output, entries=entries, rows=rows,
+                         next_entries=entries + len(paths), next_rows=rows + len(kept))
+        if len(kept):
+            db.append(feats, ths, kept)
+        entries += len(paths)
+        rows += len(kept)
+        write_checkpoint(args.output, entries=entries, rows=rows)
+        print('%d images ingested (%d skipped), %.1f images/s.' % (
+            entries, entries - rows, (entries - done) / (time.time() - start)))
+    del db
+    if cache is not None:
+        print('Feature cache: %s' % json.dumps(cache.stats()))
+    print('Done. %d hashes and paths saved at %s.' % (rows, args.output))
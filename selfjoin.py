@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+selfjoin.py
+Find every near-duplicate pair inside a hash database and group them into clusters, e.g.
+python selfjoin.py -d hash_database.mmap -l image_list.txt -o clusters.jsonl --pairs pairs.csv -g
+Pairs are semantic matches (distance within the threshold of either image, see utils/selfjoin.py),
+optionally confirmed by the geometry check of check.py (-g, see utils/geometry.py). Clusters are the connected components of
+the pairs, written as one json line each: {"cluster": k, "size": n, "ids": [...], "paths": [...]}.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from utils.database import get_database_reader, KeypointData
+from utils.selfjoin import self_join, clusters
+from utils.geometry import QueryFeatures, verify_geometry
+
+parser = argparse.ArgumentParser(description='Find all near-duplicate pairs and clusters of a hash database.')
+parser.add_argument('-d', '--hash-database', help='hash database file')
+parser.add_argument('-l', '--image-list', default=None,
+                    help='a list (txt, csv) containing full path to images, needed by -g and to output paths '
+                         'unless the database stores them (see ingest.py)')
+parser.add_argument('-o', '--output', help='output clusters (json lines)')
+parser.add_argument('--pairs', default=None, help='optionally save the pairs as csv (i, j, distance[, inliners])')
+parser.add_argument('-b', '--block-size', default=4096, type=int,
+                    help='rows per block; memory is about workers x block_size^2 x 8 bytes plus the blocks')
+parser.add_argument('-w', '--workers', default=4, type=int, help='number of threads')
+parser.add_argument('-g', '--geometry', action='store_true', default=False,
+                    help='only keep the pairs confirmed by the geometry check')
+parser.add_argument('-k', '--keypoints', default=None,
+                    help='precomputed ORB features of the database images (see build_keypoints.py)')
+parser.add_argument('-m', '--max-side', default=None, type=int,
+                    help='downscale images to this longer side for the geometry check (default: full resolution)')
+
+
+def confirm_pairs(i, j, image_list, keypoints=None, max_side=None, workers=4):
+    """
+    geometry check of semantic pairs
+    :param i: first rows of the pairs
+    :param j: second rows of the pairs
+    :param image_list: [list] list of paths to database images
+    :param keypoints: [object] optional KeypointData store of the database images
+    :param max_side: [int] cap on the longer side of the images, None for full resolution
+    :param workers: [int] number of threads
+    :return: (geometry decisions, # inliners) arrays
+    """
+    def check(pair):
+        a, b = pair
+        # both sides are read from the keypoint store when it holds them, the image of a is then only decoded
+        # for the flipped pass
+        stored = keypoints.get(a) if keypoints is not None and a < len(keypoints) else None
+        decision, inliners, _ = verify_geometry(QueryFeatures(image_list[a], max_side, stored), image_list[b], b,
+                                                keypoints, max_side)
+        return decision, inliners
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        res = list(pool.map(check, zip(i.tolist(), j.tolist())))
+    return np.array([r[0] for r in res], dtype=bool), np.array([r[1] for r in res], dtype=np.int64)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    db = get_database_reader(args.hash_database)
+    n = len(db.get_thresholds())
+    if args.image_list:
+        import pandas as pd  # slow to import, only loaded when a list is read
+        img_lst = pd.read_csv(args.image_list, header=None)[0].tolist()
+    else:
+        img_lst = db.get_paths()
+    assert img_lst is not None or not args.geometry, 'Error! The geometry check (-g) needs the image list (-l).'
+    kps = KeypointData(args.keypoints, 'r') if args.keypoints else None
+    pairs_file = open(args.pairs, 'w') if args.pairs else None
+
+    start = time.time()
+    pairs = []
+    n_semantic = 0
+    n_blocks = (n + args.block_size - 1) // args.block_size
+    for k, (i, j, dist) in enumerate(self_join(db, args.block_size, args.workers)):
+        n_semantic += len(i)
+        inliners = None
+        if args.geometry and len(i):
+            keep, inliners = confirm_pairs(i, j, img_lst, kps, args.max_side, args.workers)
+            i, j, dist, inliners = i[keep], j[keep], dist[keep], inliners[keep]
+        pairs.extend(zip(i.tolist(), j.tolist()))
+        if pairs_file is not None:
+            for row in range(len(i)):
+                pairs_file.write('%d,%d,%.6f%s\n' % (i[row], j[row], dist[row],
+                                                     '' if inliners is None else ',%d' % inliners[row]))
+        if (k + 1) % n_blocks == 0:
+            print('%d block pairs done, %d semantic pairs, %d kept, %.1f seconds.' % (
+                k + 1, n_semantic, len(pairs), time.time() - start))
+    if pairs_file is not None:
+        pairs_file.close()
+
+    groups = clusters(n, pairs)
+    with open(args.output, 'w') as f:
+        for c, group in enumerate(groups):
+            res = dict(cluster=c, size=len(group), ids=group)
+            if img_lst is not None:
+                res['paths'] = [img_lst[row] for row in group]
+            f.write(json.dumps(res) + '\n')
+    print('Found %d pairs (%d semantic) in %d clusters covering %d images, in %.1f seconds.' % (
+        len(pairs), n_semantic, len(groups), sum(len(g) for g in groups), time.time() - start))
+    print('Done. Clusters saved at %s.' % args.output)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+server.py
+Long-running near-duplicate query service.
+The hashing model, search index, thresholds and image list are loaded once and queries are served
+over a local unix domain socket. Queries arriving at the same time are hashed and searched together.
+
+Protocol: one json object per line in each direction
+request:  {"query": "/abs/path/to/image.jpg"}
+response: {"query": ..., "duplicate": true/false, "id": closest_image_id, "path": path_to_closest_image,
+           "candidates": [verified candidates, see check.py verify_candidates()]}
+          or {"query": ..., "error": message}
+metrics (with --metrics): {"metrics": "prometheus"} or {"metrics": "json"}
+response: {"metrics": Prometheus text or snapshot dict, see utils/metrics.py}
+See client.py for a command line client.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import time
+import argparse
+import threading
+import socketserver
+import queue
+from utils.extractor import Extractor, augmentation_profiles
+from utils.database import KeypointData
+from utils.metrics import metrics
+from utils.cache import FeatureCache
+from check import load_resources, neardup_detect_batch
+
+SOCKET = '/tmp/image_hash.sock'
+
+parser = argparse.ArgumentParser(description='Serve near-duplicate queries over a unix domain socket.')
+parser.add_argument('-d', '--hash-database',
+                    help='hash database file, or manifest (.json) of a sharded database (see build_shards.py)')
+parser.add_argument('-s', '--search-index', default=None,
+                    help='search index file; if not given an exact blas index is built from the hash database')
+parser.add_argument('-l', '--image-list', default=None,
+                    help='a list (txt, csv) containing full path to images; not needed if the database stores '
+                         'them (ingest.py)')
+parser.add_argument('--shard-processes', action='store_true', default=False,
+                    help='sharded database: search the local shards in worker processes instead of this one')
+parser.add_argument('-k', '--keypoints', default=None,
+                    help='precomputed ORB features of the database images (see build_keypoints.py)')
+parser.add_argument('-t', '--top-k', default=1, type=int,
+                    help='number of nearest neighbors checked; semantic matches are verified in parallel')
+parser.add_argument('-w', '--workers', default=4, type=int, help='number of geometry verification threads')
+parser.add_argument('-m', '--max-side', default=None, type=int,
+                    help='downscale images to this longer side for the geometry check (default: full resolution)')
+parser.add_argument('-p', '--profile', default='full', choices=sorted(augmentation_profiles),
+                    help='augmentation profile used to hash the query images')
+parser.add_argument('-r', '--reduced-decode', action='store_true', default=False,
+                    help='decode jpeg queries at reduced scale (see utils/imageio.py), needs --max-side')
+parser.add_argument('--cache', default=None,
+                    help='directory of a feature cache: files already hashed with the same settings are not '
+                         'hashed again (see utils/cache.py)')
+parser.add_argument('--cache-size', default=1024, type=float, help='size limit of the feature cache in MB')
+parser.add_argument('-u', '--socket', default=SOCKET, help='path of the unix domain socket')
+parser.add_argument('-b', '--max-batch', default=32, type=int, help='max number of queries processed together')
+parser.add_argument('--batch-wait', default=0.01, type=float,
+                    help='seconds to wait for more queries before processing a batch')
+parser.add_argument('--metrics', action='store_true', default=False,
+                    help='record per-stage timings and counters, served on {"metrics": "prometheus"} requests')
+parser.add_argument('-v', '--verbose', action='store_true', default=False)
+
+
+class QueryBatcher(object):
+    """
+    collect queries submitted by the connection threads and process them in batches
+    run() must be called from the thread that created the hashing model (tensorflow graph)
+    """
+    def __init__(self, hasher, image_list, thresholds, search_index, profile='full', max_batch=32,
+                 batch_wait=0.01, verbose=False, keypoints=None, top_k=1, workers=4,
+                 max_side=None):
+        self.hasher = hasher
+        self.image_list = image_list
+        self.thresholds = thresholds
+        self.search_index = search_index
+        self.profile = profile
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.verbose = verbose
+        self.keypoints = keypoints
+        self.top_k = top_k
+        self.workers = workers
+        self.max_side = max_side
+        self.requests = queue.Queue()
+
+    def submit(self, query):
+        """
+        submit a query; the result is available once the returned event is set
+        :param query: path to query image
+        :return: (event, result dict)
+        """
+        done = threading.Event()
+        res = {'query': query}
+        self.requests.put((query, done, res))
+        return done, res
+
+    def _process(self, batch):
+        """
+        answer a batch of queries, falling back to one by one if the batch fails (e.g. unreadable image)
+        :param batch: list of (query, event, result dict)
+        """
+        try:
+            out = neardup_detect_batch([q for q, _, _ in batch], self.hasher, self.image_list, self.thresholds,
+                                       self.search_index, self.verbose, self.profile, self.keypoints,
+                                       self.top_k, self.workers, self.max_side)
+        except Exception as e:
+            if len(batch) == 1:
+                out = [e]
+            else:
+                for item in batch:
+                    self._process([item])
+                return
+        for (_, done, res), out_i in zip(batch, out):
+            if isinstance(out_i, Exception):
+                res['error'] = str(out_i)
+            else:
+                res['duplicate'], res['id'], res['path'] = bool(out_i[0]), int(out_i[1]), out_i[2]
+                res['distance'], res['candidates'] = out_i[3], out_i[4]
+            done.set()
+
+    def run(self):
+        """
+        serve forever
+        """
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    """
+    read json queries from a connection, submit them all then write the answers in the same order
+    """
+    def handle(self):
+        pending = []
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                break  # an empty line ends the request
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if 'metrics' in request:  # answered right away, not queued
+                    pending.append((None, {'metrics': metrics.prometheus() if request['metrics'] == 'prometheus'
+                                           else metrics.snapshot()}))
+                else:
+                    pending.append(self.server.batcher.submit(request['query']))
+            except Exception as e:
+                pending.append((None, {'error': 'Bad request: %s' % e}))
+        for done, res in pending:
+            if done is not None:
+                done.wait()
+            self.wfile.write((json.dumps(res) + '\n').encode('utf-8'))
+
+
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, batcher):
+        if os.path.exists(socket_path):  # stale socket from a previous run
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, QueryHandler)
+        self.batcher = batcher
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    assert args.max_side or not args.reduced_decode, \
+        'Error! --reduced-decode needs --max-side: each query is decoded once for the hashing and the geometry check.'
+    ths, search, img_lst = load_resources(args.hash_database, args.search_index, args.image_list,
+                                          args.shard_processes)
+    cache = FeatureCache(args.cache, args.cache_size) if args.cache else None
+    extract = Extractor(reduced_decode=args.reduced_decode, cache=cache)
+    kps = KeypointData(args.keypoints, 'r') if args.keypoints else None
+    if args.metrics:
+        metrics.enable()
+    batcher = QueryBatcher(extract, img_lst, ths, search, args.profile, args.max_batch, args.batch_wait,
+                           args.verbose, kps, args.top_k, args.workers,
+                           args.max_side)
+    server = QueryServer(args.socket, batcher)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    print('Ready. Listening on %s.' % args.socket)
+    try:
+        batcher.run()  # inference stays in the main thread where the model was built
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(args.socket)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+shard_worker.py
+Serve one shard of a sharded hash database (see build_shards.py and utils/shards.py) over TCP.
+Start one worker per shard node and put its address in the manifest, e.g.
+python shard_worker.py -m shards.json -i 3 --host 0.0.0.0 --port 5003
+Does not load tensorflow: the queries arrive already hashed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import argparse
+from utils.shards import read_manifest, LocalShard, ShardServer
+
+parser = argparse.ArgumentParser(description='Serve a shard of a sharded hash database.')
+parser.add_argument('-m', '--manifest', help='json manifest of the sharded database')
+parser.add_argument('-i', '--shard', type=int, help='position of the shard in the manifest')
+parser.add_argument('--host', default='127.0.0.1', help='interface to listen on (0.0.0.0 for all)')
+parser.add_argument('--port', default=5000, type=int, help='port to listen on (0 for any free port)')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    entries = read_manifest(args.manifest)
+    assert 0 <= args.shard < len(entries), 'Error! Shard %d not in %s.' % (args.shard, args.manifest)
+    print('Loading shard %d (rows %d-%d) ...' % (args.shard, entries[args.shard]['offset'],
+                                                 entries[args.shard]['offset'] + entries[args.shard]['rows'] - 1))
+    server = ShardServer((args.host, args.port), LocalShard(entries[args.shard]))
+    print('Ready. Listening on %s:%d.' % server.server_address[:2])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
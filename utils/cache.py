@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+cache.py
+content-addressed cache of (feat, threshold) in front of the Extractor (utils/extractor.py)
+
+Pipelines often resubmit byte-identical files. The cache key is a blake2b digest of the file bytes
+plus the hashing settings (architecture, weights, backend, decode, augmentation profile; a weights file
+and a converted tflite model are identified by their content), so a renamed or copied file is still a hit
+while a changed setting is a miss. Randomly initialised models (weights=None) are never cached. Two tiers:
+memory: the most recently used entries of this process
+disk: one small file per entry (float32 feat followed by the threshold) under <cache dir>/<2 hex>/,
+      shared between processes. When the directory grows over max_size the least recently used
+      entries (by modification time, refreshed on every hit) are deleted.
+Usage:
+hasher = Extractor(cache=FeatureCache('feature_cache', max_size=2048))
+feat, th = hasher.extract2('cat.jpg')  # inference
+feat, th = hasher.extract2('copy_of_cat.jpg')  # cache hit
+print(hasher.cache.stats())
+Hits, misses and evictions are also counted in the metrics registry (cache.*, see utils/metrics.py).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import hashlib
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+from .metrics import metrics
+
+
+def file_digest(path, block_size=1 << 20):
+    """
+    :param path: path to a file
+    :param block_size: bytes read at a time
+    :return: blake2b digest (16 bytes) of the file content
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.digest()
+
+
+class FeatureCache(object):
+    """
+    two-tier (memory, disk) LRU cache of (feat, threshold) keyed by content digest and settings
+    Safe to use from several threads; several processes can share the disk tier.
+    """
+    def __init__(self, cache_dir=None, max_size=1024, memory_items=10000):
+        """
+        initializer
+        :param cache_dir: directory of the disk tier (created if needed), None for memory only
+        :param max_size: size limit of the disk tier in MB
+        :param memory_items: number of entries kept in memory, 0 to disable the memory tier
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_size * 2**20)
+        self.memory_items = memory_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        if cache_dir is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            self.size = sum(size for _, _, size in self._entries())
+
+    def key(self, digest, settings):
+        """
+        :param digest: file_digest() of an image
+        :param settings: string describing how the image is hashed
+        :return: cache key (hex string)
+        """
+        return hashlib.blake2b(digest + b'\0' + settings.encode('utf-8'), digest_size=20).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.bin')
+
+    def _entries(self):
+        """
+        :return: list of (modification time, path, size) of the disk entries
+        """
+        out = []
+        for sub in os.listdir(self.cache_dir):
+            folder = os.path.join(self.cache_dir, sub)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if name.endswith('.bin'):
+                    try:
+                        st = os.stat(os.path.join(folder, name))
+                    except OSError:  # evicted by another process
+                        continue
+                    out.append((st.st_mtime, os.path.join(folder, name), st.st_size))
+        return out
+
+    def _remember(self, key, value):
+        if not self.memory_items:
+            return
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_items:
+                self.memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        :param key: cache key, see key()
+        :return: (feat, threshold) or None if not cached
+        """
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.hits['memory'] += 1
+        if value is not None:
+            metrics.inc('cache.hits.memory')
+            return value
+        if self.cache_dir is not None:
+            path = self._path(key)
+            try:
+                data = np.fromfile(path, dtype=np.float32)
+                os.utime(path, None)  # most recently used
+            except (IOError, OSError):  # not cached, or evicted by another process
+                data = None
+            if data is not None and len(data) > 1:
+                value = data[:-1], data[-1]
+                self._remember(key, value)
+                with self.lock:
+                    self.hits['disk'] += 1
+                metrics.inc('cache.hits.disk')
+                return value
+        with self.lock:
+            self.misses += 1
+        metrics.inc('cache.misses')
+        return None
+
+    def put(self, key, feat, th):
+        """
+        :param key: cache key, see key()
+        :param feat: 1-D hash
+        :param th: threshold
+        """
+        feat = np.asarray(feat, dtype=np.float32).reshape(-1)
+        self._remember(key, (feat, np.float32(th)))
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:  # created by another thread
+                pass
+        data = np.append(feat, np.float32(th)).tobytes()
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')  # readers never see a partial entry
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        with self.lock:
+            self.size += len(data)
+            evict = self.size > self.max_bytes
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        delete the least recently used disk entries until the disk tier is 10% under its size limit
+        """
+        entries = sorted(self._entries())
+        size = sum(s for _, _, s in entries)
+        removed = 0
+        for _, path, s in entries:
+            if size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= s
+            removed += 1
+        with self.lock:
+            self.size = size
+            self.evictions += removed
+        metrics.inc('cache.evictions', removed)
+
+    def stats(self):
+        """
+        :return: dict of hit and miss counts and disk usage
+        """
+        with self.lock:
+            lookups = self.hits['memory'] + self.hits['disk'] + self.misses
+            return dict(memory_hits=self.hits['memory'], disk_hits=self.hits['disk'], misses=self.misses,
+                        hit_rate=(lookups - self.misses) / lookups if lookups else 0., evictions=self.evictions,
+                        memory_items=len(self.memory), disk_bytes=self.size)
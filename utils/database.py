@@ -11,6 +11,15 @@ Each class must have at least 3 following methods:
 get_hashes() : return all hashes stored in the database (for reading)
 get_thresholds(): return all threshold values associated with the hashes (for reading)
 append(hashes, thresholds): append or create if database not exist data (for writing)
+and the following methods to stream over databases larger than memory:
+iter_blocks(block_size): iterate over (start_row, hashes, thresholds) blocks of rows (for reading)
+get_rows(ids): return the hashes of the given rows (for reading)
+and to keep the image paths with the hashes (see ingest.py):
+append(hashes, thresholds, paths): paths of the appended images, either always or never given
+get_paths(): return a PathList of the image paths, None if the database stores no paths (for reading)
+
+Supported formats: numpy (.npz), hdf5 (.h5, .hdf5) and append-only memory-mapped files (.mmap, recommended
+for large databases that grow incrementally)
 
 @author: Tu Bui tb0035@surrey.ac.uk
 """
@@ -19,10 +28,63 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import os
+import struct
 import numpy as np
-import h5py as h5
 
-supported_database_extensions = ['h5', 'hdf5', 'npz']
+supported_database_extensions = ['h5', 'hdf5', 'npz', 'mmap']
+supported_h5_compressions = [None, 'lzf', 'gzip']
+
+
+def iter_array_blocks(feats, ths, block_size=65536):
+    """
+    iterate over blocks of rows of in-memory (or memory-mapped) hashes and thresholds
+    :param feats: hashes NxD
+    :param ths: threshold values N
+    :param block_size: number of rows per block
+    :return: generator of (start_row, hashes, thresholds)
+    """
+    for start in range(0, len(ths), block_size):
+        yield start, feats[start:start+block_size], ths[start:start+block_size]
+
+
+def encode_paths(paths, start=0):
+    """
+    pack image paths into a compact offset-indexed string store
+    :param paths: list of N paths
+    :param start: number of bytes already in the store
+    :return: utf-8 bytes of all paths (uint8 array), end offset of each path in the store (N int64)
+    """
+    data = [p.encode('utf-8') for p in paths]
+    return np.frombuffer(b''.join(data), dtype=np.uint8), start + np.cumsum([len(d) for d in data], dtype=np.int64)
+
+
+class PathList(object):
+    """
+    read-only list of the image paths of a database, decoded on access
+    the store is the utf-8 bytes of all paths and N+1 offsets: path i is data[offsets[i]:offsets[i+1]].
+    Both can be arrays, memmaps or hdf5 datasets, so nothing is loaded up front.
+    """
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Error! Row %d out of range.' % i)
+        start, end = self.offsets[i:i+2]
+        return bytes(np.asarray(self.data[int(start):int(end)])).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
 
 def get_database_reader(data_path):
@@ -38,13 +100,52 @@ def get_database_reader(data_path):
     elif data_path.endswith('.h5') or data_path.endswith('.hdf5'):
         print('HDF5 database detected.')
         return H5pyData(data_path, 'r')
+    elif data_path.rstrip('/').endswith('.mmap'):
+        print('Memory-mapped database detected.')
+        return MemmapData(data_path, 'r')
     else:
         raise TypeError("Error! Database must have extension %s" % supported_database_extensions)
 
 
+def get_database_writer(data_path):
+    """
+    database object in write mode, type based on file extension (see get_database_reader)
+    :param data_path: path to the database to be appended/created
+    :return: a database object
+    """
+    if data_path.endswith('.npz'):
+        return NumpyData(data_path, 'w')
+    elif data_path.endswith('.h5') or data_path.endswith('.hdf5'):
+        return H5pyData(data_path, 'w')
+    elif data_path.rstrip('/').endswith('.mmap'):
+        return MemmapData(data_path, 'w')
+    else:
+        raise TypeError("Error! Database must have extension %s" % supported_database_extensions)
+
+
+def read_hashes(db, start=0, stop=None):
+    """
+    read a range of rows of a database block by block, without loading the rest
+    :param db: database reader
+    :param start: first row
+    :param stop: end row (excluded), default: end of the database
+    :return: hashes of rows start to stop-1
+    """
+    blocks = []
+    for first, feats, _ in db.iter_blocks():
+        last = first + len(feats)
+        if stop is not None and first >= stop:
+            break
+        if last > start:
+            blocks.append(np.asarray(feats[max(0, start - first):(last if stop is None else min(stop, last)) - first],
+                                     dtype=np.float32))
+    return np.concatenate(blocks) if blocks else np.zeros((0, 0), dtype=np.float32)
+
+
 class NumpyData(object):
     """
     database reader/writer using numpy
+    Every append rewrites the whole file (atomically), so this format suits small databases only.
     Read usage:
     npdata = NumpyData('my_database.npz', 'r')
     feats = npdata.get_hashes()
@@ -81,23 +182,59 @@ class NumpyData(object):
         assert self.mode == 'r', "Error! Function get_thresholds() can only be used in read mode."
         return self.data['ths']
 
-    def append(self, feats, ths):
+    def iter_blocks(self, block_size=65536):
+        """
+        :param block_size: number of rows per block
+        :return: generator of (start_row, hashes, thresholds)
+        """
+        return iter_array_blocks(self.get_hashes(), self.get_thresholds(), block_size)
+
+    def get_rows(self, ids):
+        """
+        :param ids: row ids
+        :return: hashes of the given rows
+        """
+        return self.get_hashes()[np.asarray(ids)]
+
+    def get_paths(self):
+        """
+        :return: PathList of the image paths, None if the database stores no paths
+        """
+        assert self.mode == 'r', "Error! Function get_paths() can only be used in read mode."
+        if 'path_offsets' not in self.data.files:
+            return None
+        return PathList(self.data['paths'], self.data['path_offsets'])
+
+    def append(self, feats, ths, paths=None):
         """
         append data to database; create a new database if not exist.
         :param feats: hashes NxD
         :param ths: threshold values N
+        :param paths: optional list of the N image paths, if given for all appends
         :return: 0
         """
         ths = ths.squeeze()
         feats = feats + np.zeros((1, 1))  # make sure feats have shape NxD
         assert self.mode == 'w', "Error! Function append() can only be used in write mode."
+        assert paths is None or len(paths) == len(feats), "Error! %d paths for %d hashes." % (len(paths), len(feats))
         if os.path.isfile(self.data_path):  # append to existing database
             data = np.load(self.data_path)
-            feats_new = np.r_[data['feats'], feats]
-            ths_new = np.r_[data['ths'], ths]
-            np.savez(self.data_path, feats=feats_new, ths=ths_new)
+            assert (paths is None) == ('path_offsets' not in data.files), \
+                "Error! Paths must be given for all appends or for none."
+            out = dict(feats=np.r_[data['feats'], feats], ths=np.r_[data['ths'], ths])
+            if paths is not None:
+                path_data, ends = encode_paths(paths, data['path_offsets'][-1])
+                out.update(paths=np.r_[data['paths'], path_data], path_offsets=np.r_[data['path_offsets'], ends])
+            data.close()
         else:  # database not exist, create a new one
-            np.savez(self.data_path, feats=feats, ths=ths)
+            out = dict(feats=feats, ths=ths)
+            if paths is not None:
+                path_data, ends = encode_paths(paths)
+                out.update(paths=path_data, path_offsets=np.r_[np.zeros(1, dtype=np.int64), ends])
+        # written aside then renamed, so a crash leaves either the previous or the new database
+        with open(self.data_path + '.tmp', 'wb') as f:
+            np.savez(f, **out)
+        os.replace(self.data_path + '.tmp', self.data_path)
 
 
 class H5pyData(object):
@@ -113,18 +250,40 @@ class H5pyData(object):
     npdata = NumpyData('my_database.h5', 'w')
     npdata.append(feats1, ths1)  # feats1: NxD, ths1: N,
     npdata.append(feats2, ths2)  # feats2: MxD, ths2: M,
+
+    Streaming read usage (databases larger than memory):
+    for start, feats, ths in h5data.iter_blocks():
+        ...
+    feats = h5data.get_rows([5, 2, 9])
+
+    The layout is chosen when the file is created, e.g. for fast reads:
+    h5data = H5pyData('my_database.h5', 'w', chunk_rows=1024, compression='lzf')
+
+    The datasets are resized one by one during an append, so the number of complete rows is committed
+    last in the 'rows' attribute; rows beyond it (left by a crash) are ignored and overwritten.
     """
-    def __init__(self, data_path, mode='r'):
+    def __init__(self, data_path, mode='r', chunk_rows=None, compression='gzip', compression_level=None):
         """
         initializer
         :param data_path: path to the database to be read/created.
         :param mode: 'r' for read mode, 'w' for write mode
+        :param chunk_rows: number of rows per hdf5 chunk when creating a database
+                           (default: about 1MB of hashes per chunk)
+        :param compression: compression when creating a database: None, 'lzf' or 'gzip'
+        :param compression_level: gzip level 0-9 (default 4)
         """
         assert mode in ['r', 'w'], "Error! Mode can only be 'r' or 'w'."
+        assert compression in supported_h5_compressions, "Error! Compression must be one of %s." % \
+            supported_h5_compressions
         self.mode = mode
         self.data_path = data_path
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.compression_level = compression_level if compression == 'gzip' else None
         if self.mode == 'r':
+            import h5py as h5  # imported on first use, most tools never touch an hdf5 file
             self.data = h5.File(data_path, 'r')
+            self.n = self._num_rows(self.data)
 
     def __del__(self):
         if self.mode == 'r':
@@ -138,46 +297,387 @@ class H5pyData(object):
         :return: all hash descriptors
         """
         assert self.mode == 'r', "Error! Function get_hashes() can only be used in read mode."
-        return self.data['feats'][...]
+        return self.data['feats'][:self.n]
 
     def get_thresholds(self):
         """
         :return: array of corresponding thresholds (each image has a threshold)
         """
         assert self.mode == 'r', "Error! Function get_thresholds() can only be used in read mode."
-        return self.data['ths'][...]
+        return self.data['ths'][:self.n]
+
+    def iter_blocks(self, block_size=None):
+        """
+        read the database block by block so that only one block is in memory at a time
+        :param block_size: number of rows per block (default: as many whole chunks as fit in about 64MB)
+                           it should be a multiple of the chunk size so that each chunk is decompressed once
+        :return: generator of (start_row, hashes, thresholds)
+        """
+        assert self.mode == 'r', "Error! Function iter_blocks() can only be used in read mode."
+        feats, ths = self.data['feats'], self.data['ths']
+        if block_size is None:
+            chunk = feats.chunks[0] if feats.chunks else 1024
+            block_size = chunk * max(1, 2**26 // (chunk * feats.shape[1] * feats.dtype.itemsize))
+        for start in range(0, self.n, block_size):
+            stop = min(start + block_size, self.n)
+            yield start, feats[start:stop], ths[start:stop]
 
-    def append(self, feats, ths):
+    def get_rows(self, ids):
+        """
+        random access to some rows, only the chunks holding them are read
+        :param ids: row ids
+        :return: hashes of the given rows
+        """
+        assert self.mode == 'r', "Error! Function get_rows() can only be used in read mode."
+        ids = np.asarray(ids).reshape(-1)
+        uids, inverse = np.unique(ids, return_inverse=True)  # h5py needs increasing indices
+        if len(uids) and (uids[0] < 0 or uids[-1] >= self.n):  # the rows of an incomplete append are not readable
+            raise IndexError('Error! Row ids must be in [0, %d).' % self.n)
+        return self.data['feats'][uids.tolist()][inverse] if len(uids) else \
+            np.zeros((0, self.data['feats'].shape[1]), dtype=np.float32)
+
+    def get_paths(self):
+        """
+        :return: PathList of the image paths (read on access), None if the database stores no paths
+        """
+        assert self.mode == 'r', "Error! Function get_paths() can only be used in read mode."
+        if 'path_offsets' not in self.data:
+            return None
+        return PathList(self.data['paths'], self.data['path_offsets'][:self.n + 1])
+
+    def append(self, feats, ths, paths=None):
         """
         append data to database; create a new database if not exist.
         :param feats: hashes NxD
         :param ths: threshold values N
+        :param paths: optional list of the N image paths, if given for all appends
         :return: 0
         """
         ths = ths.squeeze()
         feats = feats + np.zeros((1, 1))  # make sure feats have shape NxD
         assert self.mode == 'w', "Error! Function append() can only be used in write mode."
+        assert paths is None or len(paths) == len(feats), "Error! %d paths for %d hashes." % (len(paths), len(feats))
+        import h5py as h5
         n, dim = feats.shape
         if os.path.isfile(self.data_path):  # append to existing database
             with h5.File(self.data_path, 'a') as f:
+                assert (paths is None) == ('path_offsets' not in f), \
+                    "Error! Paths must be given for all appends or for none."
+                n0 = self._num_rows(f)  # rows of an incomplete append are overwritten
                 feat_data = f['feats']
-                n0 = feat_data.shape[0]
                 feat_data.resize((n+n0, feat_data.shape[1]))
-                feat_data[-n:] = feats
+                feat_data[n0:] = feats
                 th_data = f['ths']
                 th_data.resize((n+n0, ))
-                th_data[-n:] = ths
+                th_data[n0:] = ths
+                if paths is not None:
+                    self._append_paths(f, paths, n0)
+                f.flush()
+                f.attrs['rows'] = n0 + n  # commit
                 f.flush()
         else:  # database not exist, create a new one
-            with h5.File(self.data_path, 'w') as f:
+            chunk_rows = self.chunk_rows or max(1, 2**20 // (dim * 4))  # about 1MB of float32 hashes
+            # created aside then renamed, so a crash never leaves a partial file
+            with h5.File(self.data_path + '.tmp', 'w') as f:
                 f.create_dataset('feats', data=feats,
                                  shape=(n, dim),
                                  maxshape=(None, dim),
+                                 chunks=(chunk_rows, dim),
                                  dtype=np.float32,
-                                 compression='gzip')
+                                 compression=self.compression,
+                                 compression_opts=self.compression_level)
 
                 f.create_dataset('ths', data=ths,
                                  shape=(n,),
                                  maxshape=(None,),
+                                 chunks=(max(chunk_rows, 1024),),
                                  dtype=np.float32,
-                                 compression='gzip')
+                                 compression=self.compression,
+                                 compression_opts=self.compression_level)
+                if paths is not None:
+                    f.create_dataset('paths', shape=(0,), maxshape=(None,), chunks=(2**16,), dtype=np.uint8)
+                    f.create_dataset('path_offsets', data=np.zeros(1, dtype=np.int64), maxshape=(None,),
+                                     chunks=(4096,))
+                    self._append_paths(f, paths)
+                f.attrs['rows'] = n
+            os.replace(self.data_path + '.tmp', self.data_path)
+
+    @staticmethod
+    def _num_rows(f):
+        """
+        :param f: open hdf5 file of the database
+        :return: number of complete rows
+        """
+        if 'rows' in f.attrs:
+            return int(f.attrs['rows'])
+        n = min(f['feats'].shape[0], f['ths'].shape[0])  # database written before the row count was kept
+        return min(n, f['path_offsets'].shape[0] - 1) if 'path_offsets' in f else n
+
+    @staticmethod
+    def _append_paths(f, paths, n0=0):
+        """
+        :param f: open hdf5 file of the database
+        :param paths: list of image paths
+        :param n0: number of complete rows, the paths are written after them
+        """
+        m0 = int(f['path_offsets'][n0])
+        data, ends = encode_paths(paths, m0)
+        f['paths'].resize((m0 + len(data),))
+        f['paths'][m0:] = data
+        f['path_offsets'].resize((n0 + 1 + len(ends),))
+        f['path_offsets'][n0 + 1:] = ends
+
+
+class MemmapData(object):
+    """
+    append-only database of fixed-width float32 rows, read via numpy memmap
+    The database is a directory (e.g. my_database.mmap) holding feats.bin and ths.bin. Each file is a
+    small header (magic, row width) followed by the raw rows, so appending costs O(batch) and
+    reading is zero-copy: get_hashes() maps the file instead of loading it.
+    If the image paths are appended with the hashes they are kept in paths.bin (utf-8 bytes) and
+    paths.idx (N+1 int64 offsets into paths.bin, starting with 0).
+
+    Read usage:
+    mmdata = MemmapData('my_database.mmap', 'r')
+    feats = mmdata.get_hashes()  # np.memmap, rows are only read from disk when accessed
+    thresholds = mmdata.get_thresholds()
+
+    Write usage:
+    mmdata = MemmapData('my_database.mmap', 'w')
+    mmdata.append(feats1, ths1)  # feats1: NxD, ths1: N,
+    mmdata.append(feats2, ths2)  # feats2: MxD, ths2: M,
+    """
+    MAGIC = b'IMHASHDB'
+    HEADER = struct.Struct('<8sI')  # magic, number of float32 values per row
+    HEADER_SIZE = 64  # header is padded so that the rows are aligned
+
+    def __init__(self, data_path, mode='r'):
+        """
+        initializer
+        :param data_path: path to the database directory to be read/created.
+        :param mode: 'r' for read mode, 'w' for write mode
+        """
+        assert mode in ['r', 'w'], "Error! Mode can only be 'r' or 'w'."
+        self.mode = mode
+        self.data_path = data_path
+        self.feat_path = os.path.join(data_path, 'feats.bin')
+        self.th_path = os.path.join(data_path, 'ths.bin')
+        self.path_data_path = os.path.join(data_path, 'paths.bin')
+        self.path_idx_path = os.path.join(data_path, 'paths.idx')
+        if os.path.isfile(self.feat_path):
+            self.dim = self._read_header(self.feat_path)
+            assert self._read_header(self.th_path) == 1, "Error! Corrupted threshold file %s." % self.th_path
+            self.has_paths = os.path.isfile(self.path_idx_path)
+            # a crash during append may leave a partial row or more rows in one file than the other
+            self.n = min(self._num_rows(self.feat_path, self.dim), self._num_rows(self.th_path, 1))
+            if self.has_paths:
+                self.n = min(self.n, os.path.getsize(self.path_idx_path) // 8 - 1)
+            if self.mode == 'w':  # drop any incomplete append so that new rows stay aligned
+                for path, width in [(self.feat_path, self.dim), (self.th_path, 1)]:
+                    with open(path, 'r+b') as f:
+                        f.truncate(self.HEADER_SIZE + self.n * width * 4)
+                if self.has_paths:
+                    with open(self.path_idx_path, 'r+b') as f:
+                        f.truncate((self.n + 1) * 8)
+                        f.seek(self.n * 8)
+                        end = struct.unpack('<q', f.read(8))[0]
+                    with open(self.path_data_path, 'r+b') as f:
+                        f.truncate(end)
+        else:
+            assert self.mode == 'w', "Error! Database %s not found." % data_path
+            self.dim, self.n, self.has_paths = None, 0, None
+
+    def _read_header(self, path):
+        """
+        :return: row width (number of float32 values per row) of a database file
+        """
+        with open(path, 'rb') as f:
+            magic, width = self.HEADER.unpack(f.read(self.HEADER.size))
+        assert magic == self.MAGIC, "Error! %s is not a memmap database file." % path
+        return width
+
+    def _write_header(self, path, width):
+        """
+        create an empty database file with rows of width float32 values
+        """
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, width).ljust(self.HEADER_SIZE, b'\0'))
+
+    def _num_rows(self, path, width):
+        """
+        :return: number of complete rows in a database file
+        """
+        return (os.path.getsize(path) - self.HEADER_SIZE) // (width * 4)
+
+    def _map(self, path, width):
+        """
+        :return: read-only memmap of the first self.n rows of a database file
+        """
+        if self.n == 0:
+            return np.zeros((0, width), dtype=np.float32)
+        return np.memmap(path, dtype=np.float32, mode='r', offset=self.HEADER_SIZE, shape=(self.n, width))
+
+    def get_hashes(self):
+        """
+        :return: all hash descriptors (read-only memmap)
+        """
+        assert self.mode == 'r', "Error! Function get_hashes() can only be used in read mode."
+        return self._map(self.feat_path, self.dim)
+
+    def get_thresholds(self):
+        """
+        :return: array of corresponding thresholds (each image has a threshold)
+        """
+        assert self.mode == 'r', "Error! Function get_thresholds() can only be used in read mode."
+        return self._map(self.th_path, 1)[:, 0]
+
+    def iter_blocks(self, block_size=65536):
+        """
+        :param block_size: number of rows per block
+        :return: generator of (start_row, hashes, thresholds)
+        """
+        return iter_array_blocks(self.get_hashes(), self.get_thresholds(), block_size)
+
+    def get_rows(self, ids):
+        """
+        :param ids: row ids
+        :return: hashes of the given rows
+        """
+        return self.get_hashes()[np.asarray(ids)]
+
+    def get_paths(self):
+        """
+        :return: PathList of the image paths (memmap, decoded on access), None if the database stores no paths
+        """
+        assert self.mode == 'r', "Error! Function get_paths() can only be used in read mode."
+        if not self.has_paths:
+            return None
+        offsets = np.memmap(self.path_idx_path, dtype=np.int64, mode='r', shape=(self.n + 1,))
+        if offsets[-1] == 0:  # np.memmap cannot map an empty file
+            return PathList(np.zeros(0, dtype=np.uint8), offsets)
+        return PathList(np.memmap(self.path_data_path, dtype=np.uint8, mode='r', shape=(int(offsets[-1]),)), offsets)
+
+    def append(self, feats, ths, paths=None):
+        """
+        append data to database; create a new database if not exist.
+        :param feats: hashes NxD
+        :param ths: threshold values N
+        :param paths: optional list of the N image paths, if given for all appends
+        :return: 0
+        """
+        assert self.mode == 'w', "Error! Function append() can only be used in write mode."
+        ths = np.ascontiguousarray(ths, dtype=np.float32).reshape(-1)
+        feats = np.ascontiguousarray(feats, dtype=np.float32).reshape(len(ths), -1)  # make sure feats have shape NxD
+        assert paths is None or len(paths) == len(ths), "Error! %d paths for %d hashes." % (len(paths), len(ths))
+        if self.dim is None:  # database not exist, create a new one
+            if not os.path.isdir(self.data_path):
+                os.makedirs(self.data_path)
+            self.dim = feats.shape[1]
+            self.has_paths = paths is not None
+            if self.has_paths:  # created before the hash files so that a database never misses them
+                open(self.path_data_path, 'wb').close()
+                with open(self.path_idx_path, 'wb') as f:
+                    f.write(np.zeros(1, dtype=np.int64).tobytes())
+            self._write_header(self.feat_path, self.dim)
+            self._write_header(self.th_path, 1)
+        assert feats.shape[1] == self.dim, "Error! Hash dimension %d does not match database (%d)." % (
+            feats.shape[1], self.dim)
+        assert (paths is not None) == self.has_paths, "Error! Paths must be given for all appends or for none."
+        # feats first and path offsets last: a crash in between leaves extra rows in some files,
+        # which are ignored on the next open
+        out = [(self.feat_path, feats), (self.th_path, ths)]
+        if self.has_paths:
+            path_data, ends = encode_paths(paths, os.path.getsize(self.path_data_path))
+            out += [(self.path_data_path, path_data), (self.path_idx_path, ends)]
+        for path, data in out:
+            with open(path, 'ab') as f:
+                f.write(data.tobytes())
+        self.n += len(ths)
+        return 0
+
+
+class KeypointData(object):
+    """
+    store of precomputed ORB keypoints and descriptors of the database images, keyed by database row
+    (see utils/geometry.py orb_features). Geometry verification can then load the features of a
+    candidate instead of decoding the original image.
+    hdf5 layout: 'pts' (Mx2 float32 keypoint coordinates), 'des' (Mx32 uint8 descriptors) and
+    'offsets' (N+1 int64): the features of row i are pts[offsets[i]:offsets[i+1]]
+
+    Read usage:
+    kpdata = KeypointData('keypoints.h5', 'r')
+    pts, des = kpdata.get(row)
+
+    Write usage:
+    kpdata = KeypointData('keypoints.h5', 'w')
+    kpdata.append([(pts1, des1), (pts2, des2)])  # features of the next database rows
+    """
+    def __init__(self, data_path, mode='r'):
+        """
+        initializer
+        :param data_path: path to the keypoint store to be read/created.
+        :param mode: 'r' for read mode, 'w' for write mode
+        """
+        assert mode in ['r', 'w'], "Error! Mode can only be 'r' or 'w'."
+        self.mode = mode
+        self.data_path = data_path
+        if self.mode == 'r':
+            import h5py as h5
+            self.data = h5.File(data_path, 'r')
+            self.offsets = self.data['offsets'][...]
+
+    def __del__(self):
+        if self.mode == 'r':
+            try:
+                self.data.close()
+            except Exception as e:
+                pass
+
+    def __len__(self):
+        """
+        :return: number of database rows in the store
+        """
+        if self.mode == 'r':
+            return len(self.offsets) - 1
+        if not os.path.isfile(self.data_path):
+            return 0
+        import h5py as h5
+        with h5.File(self.data_path, 'r') as f:
+            return f['offsets'].shape[0] - 1
+
+    def get(self, row):
+        """
+        :param row: database row
+        :return: keypoint coordinates (Mx2 float32), descriptors (Mx32 uint8)
+        """
+        assert self.mode == 'r', "Error! Function get() can only be used in read mode."
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.data['pts'][start:end], self.data['des'][start:end]
+
+    def append(self, features):
+        """
+        append the features of the next database rows; create a new store if not exist.
+        :param features: list of (pts, des), one per database row
+        :return: 0
+        """
+        assert self.mode == 'w', "Error! Function append() can only be used in write mode."
+        pts = np.concatenate([np.float32(p).reshape(-1, 2) for p, _ in features] + [np.zeros((0, 2), np.float32)])
+        des = np.concatenate([np.uint8(d).reshape(-1, 32) for _, d in features] + [np.zeros((0, 32), np.uint8)])
+        counts = np.cumsum([len(p) for p, _ in features], dtype=np.int64)
+        import h5py as h5
+        if not os.path.isfile(self.data_path):  # store not exist, create a new one
+            with h5.File(self.data_path, 'w') as f:
+                f.create_dataset('pts', shape=(0, 2), maxshape=(None, 2), chunks=(4096, 2), dtype=np.float32)
+                f.create_dataset('des', shape=(0, 32), maxshape=(None, 32), chunks=(4096, 32), dtype=np.uint8)
+                f.create_dataset('offsets', data=np.zeros(1, dtype=np.int64), maxshape=(None,), chunks=(4096,))
+        with h5.File(self.data_path, 'a') as f:
+            n0, m0 = f['offsets'].shape[0], f['pts'].shape[0]
+            if len(pts):
+                for name, data in [('pts', pts), ('des', des)]:
+                    f[name].resize((m0 + len(data), data.shape[1]))
+                    f[name][m0:] = data
+            if len(counts):
+                f['offsets'].resize((n0 + len(counts), ))
+                f['offsets'][n0:] = m0 + counts  # written last: rows only exist once their features do
+            f.flush()
+        return 0
@@ -5,14 +5,16 @@ Created on 14 Jun 2019 11:29
 Tu Bui tb0035@surrey.ac.uk
 
 """
-import tensorflow as tf
-from tensorflow.keras import applications as apps
-from tensorflow.keras.models import Model
-from tensorflow.keras.preprocessing import image
-from tensorflow.keras.layers import GlobalAveragePooling2D
-from tensorflow.keras import backend as K
 from PIL import Image
 import numpy as np
+import os
+import hashlib
+import threading
+import queue
+from .metrics import metrics
+from .inference import supported_backends, set_threads, convert_to_tflite, TFLiteModel
+from .imageio import open_image
+from .cache import FeatureCache, file_digest
 
 # Architecture_name: [base_name, input_shape]
 supported_architectures = {
@@ -29,26 +31,72 @@ augmentation = {
     'flip': True,
     'crop': 0.1  # fraction along each image dimension to be removed
 }
+# augmentation profiles: which of the above augmentations are applied when hashing an image
+# the threshold is only meaningful for 'full'; the cheaper profiles are meant for query images
+# whose threshold is not used (see check.py)
+augmentation_profiles = {
+    'full': {'rotation': True, 'crop': True, 'flip': True},  # 5 rotations x 5 crops x 2 flips = 50 passes
+    'flips': {'rotation': False, 'crop': False, 'flip': True},  # centre crop, flipped and not = 2 passes
+    'centre': {'rotation': False, 'crop': False, 'flip': False},  # centre crop only = 1 pass
+}
+
+
+class PreparedImage(object):
+    """
+    the rotated and resized copies of an image hashed by an augmentation profile (see Extractor.prepare()),
+    a few hundred KB whatever the size of the decoded image
+    """
+    def __init__(self, rotated, profile):
+        self.rotated = rotated
+        self.profile = profile
 
 
 class Extractor(object):
-    def __init__(self, arch='ResNet50'):
+    def __init__(self, arch='ResNet50', weights='imagenet', backend='keras', quantize=None, tflite_path=None,
+                 calibration=None, intra_op_threads=None, inter_op_threads=None, reduced_decode=False, cache=None):
         """
         image feature extraction class
         :param arch: deep architecture to be used e.g. ResNet
+        :param weights: 'imagenet' (default), path to a weights file, or None for random initialisation
+                        (no download; the hashes are meaningless but the speed is the same, see benchmarks/)
+        :param backend: inference backend, 'keras' (default) or 'tflite', see utils/inference.py
+        :param quantize: tflite backend: None (float32), 'dynamic' (int8 weights) or 'int8' (weights and
+                         activations, calibrated on the calibration images)
+        :param tflite_path: tflite backend: converted model file, loaded if it exists, saved otherwise
+        :param calibration: list of sample images (paths or PIL images) for the int8 calibration
+        :param intra_op_threads: threads used inside an op (also the tflite interpreter threads), None for default
+        :param inter_op_threads: ops run concurrently (keras backend), None for default
+        :param reduced_decode: decode jpeg images at the smallest scale (1/2, 1/4, 1/8) that still leaves twice
+                               the resolution of the augmented images, see utils/imageio.py. Much faster on
+                               large photos but the hashes differ slightly from a full resolution decode
+        :param cache: FeatureCache (see utils/cache.py) or its directory; extract2(), extract_batch() and
+                      extract_stream() then skip the inference of image files already hashed with the same settings
         :param verbose: print out some logging info
         """
         assert arch in supported_architectures, 'Error! %s not supported.' % arch
+        assert backend in supported_backends, 'Error! Inference backend %s not supported.' % backend
+        # tensorflow takes seconds to import, so it is only imported when a model is built: tools importing
+        # this module for its settings (e.g. the argument choices of check.py) start fast
+        from tensorflow.keras import applications as apps
+        from tensorflow.keras.models import Model
+        from tensorflow.keras.layers import GlobalAveragePooling2D
+        from tensorflow.keras import backend as K
+        # kept for __del__, which may run at interpreter shutdown when nothing can be imported any more
+        self._clear_session = K.clear_session
+        set_threads(intra_op_threads, inter_op_threads)
         tf_arch = getattr(apps, supported_architectures[arch][0])
-        tf_base = getattr(tf_arch, arch)
-        tf_model = tf_base(weights='imagenet', include_top=False, input_shape=supported_architectures[arch][1])
-        top_layer_id = len(tf_model.layers) - 1
-        while 'relu' in tf_model.layers[top_layer_id].name:
-            top_layer_id -= 1
-        output_layer = GlobalAveragePooling2D()(tf_model.layers[top_layer_id].output)
-        self.model = Model(inputs=tf_model.input, outputs=output_layer)
-        self.in_shape = self.model.input_shape[1:3]
+        self.in_shape = tuple(supported_architectures[arch][1][:2])
         self.prefn = getattr(tf_arch, 'preprocess_input')
+        # an already converted tflite model is loaded as is, the keras model is only built to be converted
+        load_tflite = backend == 'tflite' and tflite_path is not None and os.path.isfile(tflite_path)
+        if not load_tflite:
+            tf_base = getattr(tf_arch, arch)
+            tf_model = tf_base(weights=weights, include_top=False, input_shape=supported_architectures[arch][1])
+            top_layer_id = len(tf_model.layers) - 1
+            while 'relu' in tf_model.layers[top_layer_id].name:
+                top_layer_id -= 1
+            output_layer = GlobalAveragePooling2D()(tf_model.layers[top_layer_id].output)
+            self.model = Model(inputs=tf_model.input, outputs=output_layer)
         # augmentation setting
         self.rot = np.linspace(augmentation['rotation'][0], augmentation['rotation'][1], 5)
         self.flip = [1, -1] if augmentation['flip'] else [1, ]
@@ -59,10 +107,62 @@ class Extractor(object):
                          half_crop,
                          (half_crop[0]*2, 0),
                          half_crop*2]
+        # profile_name: (rotations, crop positions, flips)
+        self.profiles = {}
+        for name, profile in augmentation_profiles.items():
+            self.profiles[name] = (self.rot if profile['rotation'] else [0],
+                                   self.crop_pos if profile['crop'] else [half_crop],
+                                   self.flip if profile['flip'] else [1, ])
+        # number of augmented crops per image for each profile
+        self.n_aug = {name: len(r) * len(c) * len(f) for name, (r, c, f) in self.profiles.items()}
+        self.crop_buffer = None  # reusable float32 buffer for the augmented crops, see _buffer()
+        # smallest decoded (width, height) when decoding at reduced scale, None for full resolution
+        self.decode_size = tuple(int(x) for x in 2 * self.img_shape[::-1]) if reduced_decode else None
+        self.backend = backend
+        if backend == 'tflite':
+            if not load_tflite:
+                print('Converting %s to tflite (quantisation: %s) ...' % (arch, quantize))
+                content = convert_to_tflite(self.model, quantize, self._representative_data(calibration))
+                if tflite_path is not None:
+                    with open(tflite_path, 'wb') as f:
+                        f.write(content)
+            else:
+                with open(tflite_path, 'rb') as f:
+                    content = f.read()
+            self.model = TFLiteModel(content, num_threads=intra_op_threads)
+        self.cache = FeatureCache(cache) if isinstance(cache, str) else cache
+        # a randomly initialised model hashes differently in every run, its hashes must never be reused
+        assert self.cache is None or weights is not None, 'Error! The feature cache needs trained weights.'
+        # everything but the image and the profile that changes the hash, part of the cache keys. A weights
+        # file and the converted tflite model (quantisation, calibration) are identified by their content
+        self.cache_settings = None
+        if self.cache is not None:
+            model_id = file_digest(weights).hex() if os.path.isfile(weights) else weights
+            if backend == 'tflite':
+                model_id += '|' + hashlib.blake2b(content, digest_size=16).hexdigest()
+            self.cache_settings = '%s|%s|%s|%s|%s' % (arch, model_id, backend, self.decode_size,
+                                                      sorted(augmentation.items()))
+
+    def _representative_data(self, calibration, profile='full'):
+        """
+        calibration data of the int8 quantisation: the preprocessed augmented crops of sample images
+        :param calibration: list of paths or PIL images, None if not needed
+        :return: function returning an iterator of [one crop batch], as expected by the tflite converter
+        """
+        if not calibration:
+            return None
+
+        def gen():
+            for img in calibration:
+                ims = self.prefn(self._fill(self._rotate(self._open(img), profile), self._buffer(self.n_aug[profile]),
+                                            profile))
+                for crop in ims:
+                    yield [crop[None, ...]]
+        return gen
 
     def __del__(self):
         del self.model
-        K.clear_session()
+        self._clear_session()
 
     def extract(self, img_path):
         """
@@ -71,47 +171,294 @@ class Extractor(object):
         :param img_path: path to image
         :return: 1-D float32 descriptor
         """
+        from tensorflow.keras.preprocessing import image
         im = image.load_img(img_path, target_size=self.in_shape)
         im = image.img_to_array(im)[None, ...]  # 4-D numpy array
         im = self.prefn(im)
         feat = self.model.predict(im).squeeze()
         return feat
 
-    def extract2(self, img_path, return_threshold=True):
+    def _open(self, img):
+        """
+        :param img: path to an image or PIL image (e.g. already decoded by the caller)
+        :return: PIL RGB image
+        """
+        with metrics.timer('extract.decode'):
+            return open_image(img, 'RGB', min_size=self.decode_size)
+
+    def _prepared(self, img, profile='full'):
+        """
+        :param img: path to an image, PIL image or PreparedImage
+        :param profile: augmentation profile
+        :return: rotated images of img, see _rotate()
+        """
+        if isinstance(img, PreparedImage):
+            assert img.profile == profile, 'Error! Image prepared for profile %s, not %s.' % (img.profile, profile)
+            return img.rotated
+        return self._rotate(self._open(img), profile)
+
+    def prepare(self, img, profile='full'):
+        """
+        decode and rotate an image ahead of extract_batch(), which accepts the result in place of the image, so that
+        a caller can release a large decoded image and still hash many images in shared inference batches
+        :param img: path to an image or PIL image
+        :param profile: augmentation profile the image will be hashed with
+        :return: PreparedImage
+        """
+        im = img if isinstance(img, Image.Image) and img.mode == 'RGB' else self._open(img)  # no copy of a large image
+        return PreparedImage(self._rotate(im, profile), profile)
+
+    def cache_key(self, img, profile='full'):
+        """
+        :param img: path to an image or PIL image
+        :param profile: augmentation profile
+        :return: cache key of an image file, None without cache or for a PIL image (no file content)
+        """
+        if self.cache is None or not isinstance(img, str):
+            return None
+        return self.cache.key(file_digest(img), '%s|%s' % (self.cache_settings, profile))
+
+    def _cached(self, key):
+        """
+        :return: (feat, th) of a cache key, None if not cached
+        """
+        return None if key is None else self.cache.get(key)
+
+    def _rotate(self, im, profile='full'):
+        """
+        rotate and resize an image for each rotation of an augmentation profile
+        each rotated image is converted to a numpy array only once; the crops and flips are views of it
+        :param im: PIL RGB image
+        :param profile: augmentation profile, see augmentation_profiles
+        :return: list of uint8 arrays of shape img_shape x 3, one per rotation
+        """
+        assert profile in self.profiles, 'Error! Augmentation profile %s not supported.' % profile
+        with metrics.timer('extract.rotate'):
+            return [np.asarray(im.rotate(r, Image.BILINEAR, expand=False).resize(self.img_shape[::-1],
+                                                                                 Image.BILINEAR))
+                    for r in self.profiles[profile][0]]
+
+    def _fill(self, rotated, out, profile='full'):
+        """
+        write the augmented crops (rotation x crop position x flip) of an image into a buffer
+        :param rotated: rotated images of one image (as returned by _rotate)
+        :param out: float32 buffer of shape (n_aug, H, W, 3), usually a slice of self._buffer()
+        :param profile: augmentation profile used to rotate the image
+        :return: out
+        """
+        _, crop_pos, flip = self.profiles[profile]
+        h, w = self.in_shape
+        k = 0
+        with metrics.timer('extract.crop'):
+            for im_r in rotated:
+                for c in crop_pos:
+                    crop = im_r[c[0]:c[0]+h, c[1]:c[1]+w]
+                    for f in flip:
+                        out[k] = crop[..., ::f]  # cast to float32 on assignment, no intermediate copy
+                        k += 1
+        return out
+
+    def _buffer(self, n):
+        """
+        reusable float32 buffer for the augmented crops; it only grows when a larger one is requested
+        Note: the buffer is shared by all calls so an Extractor must not be used by several threads at once
+        :param n: number of crops
+        :return: float32 array of shape (n, H, W, 3)
+        """
+        if self.crop_buffer is None or len(self.crop_buffer) < n:
+            self.crop_buffer = None  # release the old buffer before allocating the new one
+            self.crop_buffer = np.empty((n, self.in_shape[0], self.in_shape[1], 3), dtype=np.float32)
+        return self.crop_buffer[:n]
+
+    @staticmethod
+    def _summarise(feats):
+        """
+        aggregate the features of the augmented crops of an image
+        :param feats: features of the augmented crops (n_aug x dim)
+        :return: feat (1-D float32), thres (scalar)
+        """
+        feat = feats.mean(axis=0, keepdims=True)
+        th = np.sqrt(np.sum((feats - feat)**2, axis=1).max())
+        return feat.squeeze(), th
+
+    def extract2(self, img_path, return_threshold=True, profile='full'):
         """
         extract image feat and near-duplication threshold
-        :param img_path: path to image
+        :param img_path: path to image or PIL image
         :param return_threshold: if True also return near-duplication threshold
+        :param profile: augmentation profile, 'full' (default) for database images;
+                        'flips' or 'centre' are much faster for query images but the threshold is not reliable
         :return: feat (1-D float32), thres (scalar)
         """
-        # TODO: augment then pass
         if return_threshold:
-            im = Image.open(img_path).convert('RGB')
-            ims = []
-            for r in self.rot:
-                im_r = im.rotate(r, Image.BILINEAR, expand=False).resize(self.img_shape[::-1], Image.BILINEAR)
-                for c in self.crop_pos:
-                    for f in self.flip:
-                        im_ = np.array(im_r)[c[0]:c[0]+self.in_shape[0], c[1]:c[1]+self.in_shape[1], ::f]
-                        ims.append(im_)
-            ims = self.prefn(np.array(ims, dtype=np.float32))
-            feats = self.model.predict(ims).squeeze()
-            feat = feats.mean(axis=0, keepdims=True)
-            th = np.sqrt(np.sum((feats - feat)**2, axis=1).max())
-            return feat.squeeze(), th
+            key = self.cache_key(img_path, profile)
+            cached = self._cached(key)
+            if cached is not None:
+                return cached
+            im = self._open(img_path)
+            ims = self._fill(self._rotate(im, profile), self._buffer(self.n_aug[profile]), profile)
+            feat, th = self._infer(ims, 32, profile)[0]
+            if key is not None:
+                self.cache.put(key, feat, th)
+            return feat, th
         else:
             return self.extract(img_path)
 
-    def extract_batch(self, img_lst):
+    def _chunk_size(self, max_memory, profile='full'):
+        """
+        number of images whose float32 crops fit within a memory ceiling
+        :param max_memory: memory ceiling in MB
+        :param profile: augmentation profile
+        :return: number of images (at least 1)
+        """
+        crop_bytes = self.n_aug[profile] * self.in_shape[0] * self.in_shape[1] * 3 * 4  # float32 crops of one image
+        return max(1, int(max_memory * 2**20 // crop_bytes))
+
+    def _infer(self, ims, batch_size, profile='full'):
+        """
+        run inference on the augmented crops of several images
+        :param ims: float32 crops of one or more images (as filled by _fill), preprocessed in place
+        :param batch_size: number of crops per model.predict batch
+        :param profile: augmentation profile used to create the crops
+        :return: list of (feat, th), one per image
+        """
+        # keras preprocess_input works in place on float arrays (caffe mode returns a channel-reversed view)
+        with metrics.timer('extract.preprocess'):
+            ims = self.prefn(ims)
+        metrics.observe('extract.predict_crops', len(ims))  # crops per predict call, split in batch_size batches
+        with metrics.timer('extract.predict'):
+            out = self.model.predict(ims, batch_size=batch_size)
+        out = out.reshape(-1, self.n_aug[profile], out.shape[-1])
+        metrics.inc('extract.images', len(out))
+        with metrics.timer('extract.summarise'):
+            return [self._summarise(feats_i) for feats_i in out]
+
+    def extract_batch(self, img_lst, batch_size=32, max_memory=1024, profile='full', cache_keys=None):
         """
         extract features and threshold values for batch of images
-        :param img_lst: list of paths to N images
+        The augmented crops of several images are packed together and passed to the model
+        in fixed-size inference batches, then split back into per-image features.
+        With a cache only the images not in it are decoded and passed to the model.
+        :param img_lst: list of paths to N images (or PIL images, or PreparedImage, see prepare())
+        :param batch_size: number of crops per model.predict batch
+        :param max_memory: ceiling (in MB) on the crops held in memory at once
+        :param profile: augmentation profile, see extract2()
+        :param cache_keys: cache keys of the images if img_lst holds images decoded from files by the caller,
+                           see cache_key()
         :return: feats (Nxdim float32), threshold values (N)
         """
-        feats = []
-        ths = []
-        for path in img_lst:
-            feat, th = self.extract2(path)
-            feats.append(feat)
-            ths.append(th)
-        return np.array(feats), np.array(ths)
+        chunk = self._chunk_size(max_memory, profile)
+        n_aug = self.n_aug[profile]
+        keys = cache_keys if cache_keys is not None else [self.cache_key(img, profile) for img in img_lst]
+        out = [self._cached(key) for key in keys]
+        todo = []
+        first = {}  # identical files of the batch are only hashed once
+        for i, res in enumerate(out):
+            if res is None and (keys[i] is None or first.setdefault(keys[i], i) == i):
+                todo.append(i)
+        for start in range(0, len(todo), chunk):
+            ids = todo[start:start+chunk]
+            ims = self._buffer(len(ids) * n_aug)
+            for j, i in enumerate(ids):
+                self._fill(self._prepared(img_lst[i], profile), ims[j*n_aug:(j+1)*n_aug], profile)
+            for i, (feat, th) in zip(ids, self._infer(ims, batch_size, profile)):
+                out[i] = (feat, th)
+                if keys[i] is not None:
+                    self.cache.put(keys[i], feat, th)
+        for i, key in enumerate(keys):
+            if out[i] is None:
+                out[i] = out[first[key]]
+        return np.array([feat for feat, _ in out]), np.array([th for _, th in out])
+
+    def extract_stream(self, img_lst, workers=4, queue_size=None, batch_size=32, max_memory=1024, profile='full',
+                       skip_errors=False):
+        """
+        streaming version of extract_batch
+        A pool of worker threads decodes and rotates the images into a bounded queue while the
+        calling thread fills the crop buffer and keeps the model busy. PIL releases the GIL while decoding and
+        resampling so threads are enough to overlap image I/O with inference. With a cache the workers look up each
+        image first and cached results are yielded without decoding.
+        Usage:
+        for i, feat, th in hasher.extract_stream(open('image_list.txt')):
+            ...
+        :param img_lst: iterable of image paths or PIL images (can be a lazy iterator e.g. an open file)
+        :param workers: number of decoding threads
+        :param queue_size: max number of decoded images waiting for inference (default: one chunk)
+        :param batch_size: number of crops per model.predict batch
+        :param max_memory: ceiling (in MB) on the crops passed to the model at once
+        :param profile: augmentation profile, see extract2()
+        :param skip_errors: if True an unreadable image is skipped with a warning (its index is never yielded),
+                            otherwise its error stops the stream
+        :return: generator of (index, feat, th) in order of completion, index is the position in img_lst
+        """
+        chunk = self._chunk_size(max_memory, profile)
+        n_aug = self.n_aug[profile]
+        workers = max(1, workers)
+        paths = enumerate(img_lst)
+        lock = threading.Lock()
+        stop = threading.Event()
+        ready = queue.Queue(maxsize=queue_size or chunk)
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def work():
+            while not stop.is_set():
+                with lock:
+                    try:
+                        i, path = next(paths)
+                    except StopIteration:
+                        break
+                try:
+                    path = path.strip() if isinstance(path, str) else path
+                    key = self.cache_key(path, profile)
+                    cached = self._cached(key)
+                    if cached is not None:
+                        put((i, key, None, cached))
+                    else:
+                        put((i, key, self._prepared(path, profile), None))
+                except Exception as e:
+                    if skip_errors:
+                        print('Warning! Skipping %s: %s' % (path, e))
+                    else:
+                        put((i, None, e, None))
+            put(None)  # this worker is done
+
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            running = workers
+            pending = []
+            while running or pending:
+                if running:
+                    item = ready.get()
+                    if item is None:
+                        running -= 1
+                    elif isinstance(item[2], Exception):
+                        raise item[2]
+                    elif item[3] is not None:  # cache hit
+                        yield item[0], item[3][0], item[3][1]
+                    else:
+                        pending.append(item)
+                # run inference on a full chunk, or whatever is ready when the decoders fall behind
+                if pending and (len(pending) >= chunk or ready.empty() or not running):
+                    ims = self._buffer(len(pending) * n_aug)
+                    for j, (_, _, rotated, _) in enumerate(pending):
+                        self._fill(rotated, ims[j*n_aug:(j+1)*n_aug], profile)
+                    keys = [(i, key) for i, key, _, _ in pending]
+                    pending = []
+                    for (i, key), (feat, th) in zip(keys, self._infer(ims, batch_size, profile)):
+                        if key is not None:
+                            self.cache.put(key, feat, th)
+                        yield i, feat, th
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
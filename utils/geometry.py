@@ -19,27 +19,51 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
-import cv2
 from PIL import Image
+try:
+    from .imageio import open_image
+    from .metrics import metrics
+except ImportError:  # run as a script for the demo below (cd utils && python geometry.py)
+    from imageio import open_image
+    from metrics import metrics
 
 
-def geometry_matching(im1, im2, debug=False):
+MIN_MATCH_COUNT = 10
+MIN_INLINERS = 10  # more inliners than this is a geometry match
+
+
+def load_grey(img, max_side=None):
     """
-    match  two images using homography
-    :param im1: image array 1
-    :param im2: image array 2
-    :param debug: if True, visualise the key points and homography
-    :return: # inliners, # total match points
+    greyscale image array for geometry matching, optionally downscaled
+    :param img: path to an image or PIL image
+    :param max_side: if set, the image is downscaled so that its longer side is at most max_side pixels;
+                     jpeg files are then decoded at a reduced scale, see utils/imageio.py
+    :return: greyscale uint8 array (read-only)
     """
-    MIN_MATCH_COUNT = 10
-    img1 = np.copy(im1)  # don't modify destructively
-    img2 = np.copy(im2)
-    orb = cv2.ORB_create()
-    kp1, des1 = orb.detectAndCompute(img1, None)
-    kp2, des2 = orb.detectAndCompute(img2, None)
-    if len(kp1) == 0 or len(kp2) == 0:  # cannot verify
-        return 0, 0
+    im = open_image(img, 'L', max_side=max_side)
+    if max_side and max(im.size) > max_side:
+        im.thumbnail((max_side, max_side), Image.BILINEAR)
+    return np.asarray(im)
+
 
+def orb_features(img):
+    """
+    ORB keypoints and descriptors of an image, in the compact form stored by utils/database.py KeypointData
+    :param img: greyscale image array
+    :return: keypoint coordinates (Mx2 float32), descriptors (Mx32 uint8)
+    """
+    import cv2  # imported on first use (see check.py)
+    kp, des = cv2.ORB_create().detectAndCompute(np.ascontiguousarray(img), None)
+    if len(kp) == 0:
+        return np.zeros((0, 2), dtype=np.float32), np.zeros((0, 32), dtype=np.uint8)
+    return np.float32([k.pt for k in kp]).reshape(-1, 2), des
+
+
+def _match(pts1, des1, pts2, des2):
+    """
+    ratio test matching then RANSAC homography
+    :return: good matches, homography (None if not enough matches), inliner mask
+    """
     # FLANN search
     # FLANN_INDEX_LSH = 6
     # index_params = dict(algorithm=FLANN_INDEX_LSH,
@@ -51,6 +75,7 @@ def geometry_matching(im1, im2, debug=False):
     # matches = flann.knnMatch(des1, des2, k=2)
 
     # Brute force
+    import cv2
     bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
     matches = bf.knnMatch(des1, des2, k=2)
 
@@ -62,9 +87,120 @@ def geometry_matching(im1, im2, debug=False):
 
     # RANSAC
     if len(good) > MIN_MATCH_COUNT:
-        src_pts = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1, 1, 2)
-        dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
+        src_pts = pts1[[m.queryIdx for m in good]].reshape(-1, 1, 2)
+        dst_pts = pts2[[m.trainIdx for m in good]].reshape(-1, 1, 2)
         M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC)
+        return good, M, mask
+    return good, None, None
+
+
+def match_features(pts1, des1, pts2, des2):
+    """
+    match two images from their precomputed ORB features (see orb_features)
+    :param pts1: keypoint coordinates of image 1
+    :param des1: descriptors of image 1
+    :param pts2: keypoint coordinates of image 2
+    :param des2: descriptors of image 2
+    :return: # inliners, # total match points
+    """
+    if len(pts1) == 0 or len(pts2) == 0:  # cannot verify
+        return 0, 0
+    good, M, mask = _match(pts1, des1, pts2, des2)
+    if mask is None:
+        return 0, len(good)
+    return int(mask.sum()), len(good)
+
+
+class QueryFeatures(object):
+    """
+    ORB features of a query image, computed at most once per orientation and only when needed,
+    so that they can be reused against several candidates
+    """
+    def __init__(self, img, max_side=None, features=None):
+        """
+        :param img: path to the query image, PIL image or greyscale array; a path is only read when features
+                    that are not given are needed
+        :param max_side: cap on the longer side of the image, see load_grey()
+        :param features: optional (keypoint coordinates, descriptors) of the unflipped image, e.g. from a
+                         KeypointData store (see utils/database.py)
+        """
+        self.path = img if isinstance(img, str) else None
+        self.max_side = max_side
+        self.img = None if self.path is not None else img if isinstance(img, np.ndarray) else load_grey(img, max_side)
+        self.features = {} if features is None else {False: features}
+
+    def get(self, flip=False):
+        """
+        :param flip: if True return the features of the horizontally flipped image
+        :return: keypoint coordinates, descriptors
+        """
+        if flip not in self.features:
+            if self.img is None:
+                self.img = load_grey(self.path, self.max_side)
+            self.features[flip] = orb_features(self.img[:, ::-1] if flip else self.img)
+        return self.features[flip]
+
+
+def verify_geometry(query, candidate_path, candidate_id=None, keypoints=None, max_side=None):
+    """
+    geometry check between a query and a database image
+    the flipped query is only tested if the query itself does not match
+    :param query: [string/object] path to query image, PIL image or QueryFeatures, the latter
+                  lets several candidates share the query ORB features
+    :param candidate_path: [string] path to the database image
+    :param candidate_id: [int] database row of the candidate, used with keypoints
+    :param keypoints: [object] KeypointData store of the database images (see build_keypoints.py);
+                      if it holds the candidate, the candidate image is not read
+    :param max_side: [int] cap on the longer side of the images, None for full resolution
+    :return: [tuple] (geometry decision, # inliners, # total match points)
+    """
+    if not isinstance(query, QueryFeatures):
+        query = QueryFeatures(query, max_side)
+    if keypoints is not None and candidate_id is not None and candidate_id < len(keypoints):
+        with metrics.timer('geometry.stored_keypoints'):
+            candidate = keypoints.get(candidate_id)
+    else:
+        with metrics.timer('geometry.candidate_read'):  # decode + ORB of the database image
+            candidate = orb_features(load_grey(candidate_path, max_side))
+    with metrics.timer('geometry.query_features'):
+        query_features = query.get()
+    with metrics.timer('geometry.match'):
+        inliners, total = match_features(*(query_features + candidate))
+    if inliners <= MIN_INLINERS:
+        metrics.inc('geometry.flip_checks')
+        with metrics.timer('geometry.query_features'):
+            query_features = query.get(flip=True)
+        with metrics.timer('geometry.match'):
+            inliners2, total2 = match_features(*(query_features + candidate))  # check flip version
+        if inliners2 > inliners:
+            inliners, total = inliners2, total2
+    metrics.observe('geometry.inliners', inliners)
+    return inliners > MIN_INLINERS, inliners, total
+
+
+def geometry_matching(im1, im2, debug=False):
+    """
+    match  two images using homography
+    :param im1: image array 1
+    :param im2: image array 2
+    :param debug: if True, visualise the key points and homography
+    :return: # inliners, # total match points
+    """
+    # ORB does not modify its input, only the debug drawing does
+    img1 = np.copy(im1) if debug else im1
+    img2 = np.copy(im2) if debug else im2
+    import cv2
+    orb = cv2.ORB_create()
+    kp1, des1 = orb.detectAndCompute(img1, None)
+    kp2, des2 = orb.detectAndCompute(img2, None)
+    if len(kp1) == 0 or len(kp2) == 0:  # cannot verify
+        return 0, 0
+
+    pts1 = np.float32([k.pt for k in kp1]).reshape(-1, 2)
+    pts2 = np.float32([k.pt for k in kp2]).reshape(-1, 2)
+    good, M, mask = _match(pts1, des1, pts2, des2)
+
+    if mask is not None:
         matchesMask = mask.ravel().tolist()
         if debug:  # draw homography for the last run
             h, w = img1.shape
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+imageio.py
+image loading shared by the hashing (utils/extractor.py) and geometry (utils/geometry.py) stages
+
+Both stages work on images much smaller than today's camera photos (246x246 for the hash, --max-side
+for the geometry check), so decoding a 20-50MP jpeg at full resolution is mostly wasted. JPEG can be
+decoded directly at 1/2, 1/4 or 1/8 scale (PIL draft mode), which is several times faster and needs
+less memory. Each stage says how much resolution it needs and open_image() picks the smallest scale
+that still provides it. Other formats are always decoded at full resolution.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+from PIL import Image
+
+
+def reduced_size(size, min_size=None, max_side=None):
+    """
+    smallest decoded size meeting the needs of the caller
+    :param size: (width, height) of the full image
+    :param min_size: (width, height) the decoded image must be at least this large in both dimensions
+    :param max_side: the caller downscales the image to this longer side, so the decoded longer side must
+                     be at least max_side
+    :return: (width, height) lower bound of the decoded size, None if full resolution is needed
+    """
+    if min_size is None and max_side is None:
+        return None
+    w, h = size
+    req_w = req_h = 0
+    if max_side:
+        scale = min(1., max_side / max(w, h))
+        req_w, req_h = int(math.ceil(w * scale)), int(math.ceil(h * scale))
+    if min_size is not None:
+        req_w, req_h = max(req_w, int(min_size[0])), max(req_h, int(min_size[1]))
+    if req_w >= w and req_h >= h:
+        return None
+    return req_w, req_h
+
+
+def open_image(img, mode='RGB', min_size=None, max_side=None):
+    """
+    decode an image, at reduced resolution if the format supports it and the caller does not need more
+    Without min_size and max_side the image is decoded at full resolution.
+    :param img: path to an image, file object or PIL image (converted only, it is already decoded)
+    :param mode: PIL mode of the output, e.g. 'RGB' or 'L'
+    :param min_size: (width, height) the decoded image must be at least this large in both dimensions
+    :param max_side: the caller downscales the image to this longer side, see reduced_size()
+    :return: PIL image in the given mode (a new image, the input is never modified)
+    """
+    if isinstance(img, Image.Image):
+        return img.convert(mode)
+    im = Image.open(img)
+    if im.format == 'JPEG':  # the only format PIL can decode at a reduced scale
+        req = reduced_size(im.size, min_size, max_side)
+        if req is not None:
+            im.draft(mode, req)  # picks the largest reduction giving at least req
+    return im.convert(mode)
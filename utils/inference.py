@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+inference.py
+inference backends of the hashing model (see Extractor in utils/extractor.py)
+
+keras: the Keras model itself (default)
+tflite: the same model converted to TensorFlow Lite, optionally quantised after training
+        'dynamic': int8 weights, float activations (no calibration needed)
+        'int8': int8 weights and activations, calibrated on the augmented crops of a few sample images
+The converted model can be saved so that it is only converted once, e.g.
+hasher = Extractor(backend='tflite', quantize='dynamic', tflite_path='resnet50_dynamic.tflite')
+Use eval_backend.py to check the drift of the hashes, thresholds and search results against keras.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import tempfile
+import numpy as np
+
+supported_backends = ['keras', 'tflite']
+supported_quantizations = [None, 'dynamic', 'int8']
+
+
+def set_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    thread pools of tensorflow, to be set before the model is built
+    :param intra_op_threads: threads used inside an op (e.g. a convolution), None for tensorflow default
+    :param inter_op_threads: ops run concurrently, None for tensorflow default
+    """
+    if intra_op_threads is None and inter_op_threads is None:
+        return
+    import tensorflow as tf  # like utils/extractor.py, tensorflow is only imported when a model is built
+    if hasattr(tf, 'ConfigProto'):  # tf 1.x
+        from tensorflow.keras import backend as K
+        config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads or 0,
+                                inter_op_parallelism_threads=inter_op_threads or 0)
+        K.set_session(tf.Session(config=config))
+    else:
+        if intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def convert_to_tflite(model, quantize=None, representative_data=None):
+    """
+    convert a Keras model to TensorFlow Lite
+    :param model: Keras model
+    :param quantize: None, 'dynamic' or 'int8', see supported_quantizations
+    :param representative_data: for 'int8', a function returning an iterator of [float32 input batch]
+    :return: the tflite flatbuffer (bytes)
+    """
+    assert quantize in supported_quantizations, 'Error! Quantisation %s not supported.' % quantize
+    assert quantize != 'int8' or representative_data is not None, \
+        'Error! int8 quantisation needs representative data for calibration.'
+    import tensorflow as tf
+    if hasattr(tf.lite.TFLiteConverter, 'from_keras_model'):
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    else:  # tf 1.x converts from a saved model file
+        fd, path = tempfile.mkstemp(suffix='.h5')
+        os.close(fd)
+        try:
+            model.save(path)
+            converter = tf.lite.TFLiteConverter.from_keras_model_file(path)
+        finally:
+            os.remove(path)
+    if quantize is not None:
+        if hasattr(tf.lite, 'Optimize'):
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if quantize == 'int8':
+                converter.representative_dataset = representative_data
+        else:  # tf 1.13: weights only
+            assert quantize == 'dynamic', 'Error! int8 quantisation needs a newer tensorflow.'
+            converter.post_training_quantize = True
+    return converter.convert()
+
+
+class TFLiteModel(object):
+    """
+    TensorFlow Lite interpreter with the predict() interface of a Keras model
+    Note: like the Keras model it must not be used by several threads at once
+    """
+    def __init__(self, model_content=None, model_path=None, num_threads=None):
+        """
+        initializer
+        :param model_content: tflite flatbuffer (bytes), or
+        :param model_path: path to a .tflite file
+        :param num_threads: interpreter threads, None for the tflite default
+        """
+        import tensorflow as tf
+        kwargs = dict(model_content=model_content) if model_content is not None else dict(model_path=model_path)
+        try:
+            self.interpreter = tf.lite.Interpreter(num_threads=num_threads, **kwargs)
+        except TypeError:  # tf 1.x has no thread control
+            self.interpreter = tf.lite.Interpreter(**kwargs)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch = None
+        self.input_buffer = None
+
+    def _resize(self, batch, in_shape):
+        """
+        fix the input batch size; the tensors are only reallocated when it changes
+        """
+        if batch != self.batch:
+            self.interpreter.resize_tensor_input(self.input_index, [batch] + list(in_shape))
+            self.interpreter.allocate_tensors()
+            self.batch = batch
+            self.input_buffer = np.zeros([batch] + list(in_shape), dtype=np.float32)
+
+    def predict(self, x, batch_size=32):
+        """
+        :param x: float32 inputs N x H x W x 3 (preprocessed)
+        :param batch_size: number of inputs per interpreter call, the last batch is zero padded
+        :return: float32 outputs N x dim
+        """
+        batch_size = min(batch_size, len(x))
+        self._resize(batch_size, x.shape[1:])
+        out = []
+        for start in range(0, len(x), batch_size):
+            batch = x[start:start+batch_size]
+            self.input_buffer[:len(batch)] = batch
+            self.input_buffer[len(batch):] = 0
+            self.interpreter.set_tensor(self.input_index, self.input_buffer)
+            self.interpreter.invoke()
+            out.append(np.array(self.interpreter.get_tensor(self.output_index)[:len(batch)], dtype=np.float32))
+        return np.concatenate(out)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+metrics.py
+per-stage timers, value distributions and counters of the hashing and query pipeline
+
+The pipeline (utils/extractor.py, check.py) reports to the module-level registry `metrics`, which is
+disabled by default: every call then returns immediately, so the instrumentation costs next to nothing.
+Usage:
+from utils.metrics import metrics
+metrics.enable()
+... hash / query images ...
+print(metrics.prometheus())  # Prometheus text exposition format
+print(metrics.to_json())  # structured log line
+Hooks get every event as it happens, e.g. to log each stage of each query:
+metrics.add_hook(json_log_hook(open('events.jsonl', 'a')))
+
+Metric names are dotted '<component>.<stage>' e.g. 'query.search'. Timers are in seconds.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+import json
+import time
+import threading
+
+
+class _NullTimer(object):
+    """
+    timer returned by a disabled registry
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    """
+    context manager recording the wall time of a block
+    """
+    __slots__ = ('registry', 'name', 'start')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, timer=True)
+        return False
+
+
+class Metrics(object):
+    """
+    thread-safe registry of timers, value distributions (count, sum, min, max) and counters
+    """
+    def __init__(self, enabled=False, prefix='image_hash'):
+        """
+        initializer
+        :param enabled: record events if True
+        :param prefix: prefix of the exported metric names
+        """
+        self.enabled = enabled
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+        return self
+
+    def disable(self):
+        self.enabled = False
+        return self
+
+    def reset(self):
+        """
+        forget all recorded values
+        """
+        with self.lock:
+            self.stats = {}  # name: [count, sum, min, max]
+            self.timers = set()  # names of the stats which are durations
+            self.counters = {}
+
+    def add_hook(self, hook):
+        """
+        :param hook: function hook(kind, name, value) called on every event, kind is 'timer', 'value' or 'counter'
+        """
+        self.hooks.append(hook)
+
+    def timer(self, name):
+        """
+        time a block of code:
+        with metrics.timer('query.search'):
+            ...
+        :param name: metric name
+        :return: context manager
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def observe(self, name, value, timer=False):
+        """
+        record a value of a distribution e.g. a batch size
+        :param name: metric name
+        :param value: number
+        :param timer: True if value is a duration in seconds
+        """
+        if not self.enabled:
+            return
+        value = float(value)
+        with self.lock:
+            s = self.stats.get(name)
+            if s is None:
+                self.stats[name] = [1, value, value, value]
+                if timer:
+                    self.timers.add(name)
+            else:
+                s[0] += 1
+                s[1] += value
+                s[2] = min(s[2], value)
+                s[3] = max(s[3], value)
+        for hook in self.hooks:
+            hook('timer' if timer else 'value', name, value)
+
+    def inc(self, name, value=1):
+        """
+        increase a counter
+        :param name: metric name
+        :param value: increment
+        """
+        if not self.enabled:
+            return
+        value = float(value)
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        for hook in self.hooks:
+            hook('counter', name, value)
+
+    def snapshot(self):
+        """
+        :return: dict {'timers': {name: {count, sum, mean, min, max}}, 'values': {...}, 'counters': {name: value}}
+        """
+        out = {'timers': {}, 'values': {}, 'counters': {}}
+        with self.lock:
+            for name, (count, total, lo, hi) in self.stats.items():
+                out['timers' if name in self.timers else 'values'][name] = dict(
+                    count=count, sum=total, mean=total / count, min=lo, max=hi)
+            out['counters'].update(self.counters)
+        return out
+
+    def to_json(self, **extra):
+        """
+        :param extra: additional fields of the log record e.g. query path
+        :return: one line json log record of the current snapshot
+        """
+        record = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), **extra)
+        record.update(self.snapshot())
+        return json.dumps(record)
+
+    def _name(self, name, suffix=''):
+        """
+        :return: metric name in Prometheus format e.g. query.search -> image_hash_query_search_seconds
+        """
+        return re.sub(r'[^a-zA-Z0-9_]', '_', '%s_%s%s' % (self.prefix, name, suffix))
+
+    def prometheus(self):
+        """
+        :return: current snapshot in the Prometheus text exposition format; timers and values are
+                 summaries (_count, _sum) with their max as a gauge
+        """
+        snap = self.snapshot()
+        lines = []
+        for kind, suffix in [('timers', '_seconds'), ('values', '')]:
+            for name, s in sorted(snap[kind].items()):
+                metric = self._name(name, suffix)
+                lines += ['# TYPE %s summary' % metric, '%s_count %d' % (metric, s['count']),
+                          '%s_sum %r' % (metric, float(s['sum'])),
+                          '# TYPE %s_max gauge' % metric, '%s_max %r' % (metric, float(s['max']))]
+        for name, value in sorted(snap['counters'].items()):
+            metric = self._name(name, '_total')
+            lines += ['# TYPE %s counter' % metric, '%s %r' % (metric, float(value))]
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path):
+        """
+        write the current snapshot, as Prometheus text if path ends with .prom, as a json line otherwise
+        :param path: output file
+        """
+        with open(path, 'w') as f:
+            f.write(self.prometheus() if path.endswith('.prom') else self.to_json() + '\n')
+
+
+def json_log_hook(stream):
+    """
+    hook writing every event as a json line, see Metrics.add_hook()
+    :param stream: writable text file
+    :return: hook function
+    """
+    lock = threading.Lock()
+
+    def hook(kind, name, value):
+        with lock:
+            stream.write(json.dumps(dict(time=time.time(), kind=kind, name=name, value=value)) + '\n')
+            stream.flush()
+    return hook
+
+
+metrics = Metrics()  # registry of the pipeline, disabled until metrics.enable() is called
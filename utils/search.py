@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+search.py
+exact nearest neighbor search engines for the hash database
+
+Each engine follows the sklearn NearestNeighbors interface used in check.py:
+fit(feats): build the index from the database hashes
+kneighbors(X, n_neighbors): return (distances, ids) of the nearest database hashes for each query
+Engines which do not keep the full-precision hashes also have set_database(db), to be called after
+loading a saved index with the database reader (see check.py)
+
+Saved indexes (build_searchtree.py) are IncrementalIndex objects, which record how many database rows
+they cover. Rows appended later go to a delta index saved next to the main one (<index>.delta) and
+load_search_index() searches both. Rows appended after the last delta are indexed in memory on load.
+
+An index is saved either as a pickle file or, if its path ends with .index, as a directory holding a
+json description (index.json) and one .npy file per array. The latter needs no unpickling: its arrays
+are memory-mapped, so loading takes milliseconds whatever the index size and the pages are only read
+when searched. Directory indexes support the blas and compressed algorithms.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import time
+import pickle
+import numpy as np
+
+supported_search_algorithms = ['ball_tree', 'blas', 'compressed']
+supported_quantizers = ['int8', 'pq']
+
+
+def build_search_index(feats, algorithm='blas', n_neighbors=1, **kwargs):
+    """
+    build a search index over the database hashes
+    :param feats: database hashes NxD
+    :param algorithm: 'blas' (exact, blocked matrix multiplication), 'ball_tree' (sklearn) or
+                      'compressed' (PCA + quantisation with exact re-ranking, see CompressedIndex)
+    :param n_neighbors: default number of neighbors returned by kneighbors
+    :param kwargs: extra settings of the compressed index
+    :return: fitted search index
+    """
+    assert algorithm in supported_search_algorithms, 'Error! Search algorithm %s not supported.' % algorithm
+    if algorithm == 'ball_tree':
+        from sklearn.neighbors import NearestNeighbors as NN
+        return NN(n_neighbors=n_neighbors, algorithm='ball_tree').fit(feats)
+    elif algorithm == 'compressed':
+        return CompressedIndex(n_neighbors, **kwargs).fit(feats)
+    return BlasIndex(n_neighbors).fit(feats)
+
+
+def topk_smallest(d, k):
+    """
+    :param d: M x N array
+    :param k: number of smallest values to keep per row
+    :return: column ids (M x k, unordered) of the k smallest values of each row
+    """
+    k = min(k, d.shape[1])
+    return np.argpartition(d, k - 1, axis=1)[:, :k]
+
+
+def kmeans(x, n_clusters, n_iter=20, seed=0):
+    """
+    plain Lloyd k-means
+    :param x: training samples N x d
+    :param n_clusters: number of centroids
+    :param n_iter: number of iterations
+    :param seed: random seed
+    :return: centroids n_clusters x d
+    """
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), n_clusters, replace=len(x) < n_clusters)].copy()
+    for _ in range(n_iter):
+        d = np.einsum('ij,ij->i', centroids, centroids)[None, :] - 2 * np.dot(x, centroids.T)
+        assign = d.argmin(axis=1)
+        for c in range(n_clusters):
+            members = x[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+    return centroids
+
+
+class BlasIndex(object):
+    """
+    exact k-nearest neighbor search as blocked matrix multiplications
+    |x - y|^2 = |x|^2 - 2 x.y + |y|^2 where the database norms |y|^2 are precomputed, so each block of
+    database rows costs one BLAS matrix product for all queries. Unlike a ball tree it does not degrade
+    with the hash dimension (2048 for ResNet50) and needs no tree building.
+
+    Usage:
+    index = BlasIndex(n_neighbors=1).fit(feats)
+    dist, ids = index.kneighbors(queries)
+    """
+    def __init__(self, n_neighbors=1, block_size=16384):
+        """
+        initializer
+        :param n_neighbors: default number of neighbors returned by kneighbors
+        :param block_size: number of database rows per matrix product; bounds the temporary memory
+                           to about block_size x (D + number of queries) float32 values
+        """
+        self.n_neighbors = n_neighbors
+        self.block_size = block_size
+        self.feats = None
+        self.sq_norms = None
+
+    def fit(self, feats):
+        """
+        :param feats: database hashes NxD (can be a np.memmap, it is then read block by block)
+        :return: self
+        """
+        self.feats = feats if feats.dtype == np.float32 else np.asarray(feats, dtype=np.float32)
+        self.sq_norms = np.empty(len(feats), dtype=np.float32)
+        for start in range(0, len(feats), self.block_size):
+            block = np.asarray(self.feats[start:start+self.block_size])
+            self.sq_norms[start:start+len(block)] = np.einsum('ij,ij->i', block, block)
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """
+        exact k nearest neighbors of several queries in one call
+        :param X: query hashes MxD
+        :param n_neighbors: number of neighbors (default: the one given at initialisation)
+        :param return_distance: if False only return the ids
+        :return: distances (M x k, euclidean, ascending) and ids (M x k)
+        """
+        k = min(n_neighbors or self.n_neighbors, len(self.feats))
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        m = len(X)
+        best_d = np.full((m, k), np.inf, dtype=np.float32)  # running top-k squared distances
+        best_i = np.zeros((m, k), dtype=np.int64)
+        rows = np.arange(m)[:, None]
+        for start in range(0, len(self.feats), self.block_size):
+            block = np.asarray(self.feats[start:start+self.block_size])
+            d2 = np.dot(X, block.T)
+            d2 *= -2
+            d2 += self.sq_norms[None, start:start+len(block)]  # |x|^2 is constant per query, ranking unchanged
+            kb = min(k, len(block))
+            part = np.argpartition(d2, kb - 1, axis=1)[:, :kb]
+            cand_d = np.concatenate([best_d, d2[rows, part]], axis=1)
+            cand_i = np.concatenate([best_i, part + start], axis=1)
+            keep = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+            best_d, best_i = cand_d[rows, keep], cand_i[rows, keep]
+        # exact distances of the winners, avoiding the cancellation error of the expansion above
+        dist = np.sqrt(((self.feats[best_i.ravel()].reshape(m, k, -1) - X[:, None, :])**2).sum(axis=2))
+        order = np.argsort(dist, axis=1, kind='stable')
+        dist, ids = dist[rows, order], best_i[rows, order]
+        return (dist, ids) if return_distance else ids
+
+
+class CompressedIndex(object):
+    """
+    approximate candidate search on compact codes followed by exact re-ranking
+    The hashes are reduced with PCA then quantised, either to int8 (one byte per component) or with
+    product quantisation (one byte per sub-vector). Candidates are searched on the codes and the best
+    ones are re-ranked with exact distances to the full-precision rows fetched from the database, so
+    the returned distances are exact and the threshold check in check.py stays correct; only the
+    recall depends on the compression (see benchmarks/compressed.py).
+    The saved index only holds the codes: after loading it, call set_database() with the database reader.
+
+    Usage:
+    index = CompressedIndex(n_components=256, quantizer='pq').fit(feats)
+    pickle.dump(index, f)
+    ...
+    index = pickle.load(f)
+    index.set_database(get_database_reader('hash_database.h5'))
+    dist, ids = index.kneighbors(queries)
+    """
+    def __init__(self, n_neighbors=1, n_components=256, quantizer='int8', n_subvectors=32, rerank=64,
+                 train_size=65536, block_size=65536, seed=0):
+        """
+        initializer
+        :param n_neighbors: default number of neighbors returned by kneighbors
+        :param n_components: PCA dimension
+        :param quantizer: 'int8' (n_components bytes per hash) or 'pq' (n_subvectors bytes per hash)
+        :param n_subvectors: number of product quantisation sub-vectors, must divide n_components
+        :param rerank: number of candidates per query re-ranked with the full-precision hashes
+        :param train_size: number of hashes sampled to learn the PCA and the quantiser
+        :param block_size: number of codes scanned at a time
+        :param seed: random seed
+        """
+        assert quantizer in supported_quantizers, 'Error! Quantizer %s not supported.' % quantizer
+        assert quantizer != 'pq' or n_components % n_subvectors == 0, \
+            'Error! n_subvectors must divide n_components.'
+        self.n_neighbors = n_neighbors
+        self.n_components = n_components
+        self.quantizer = quantizer
+        self.n_subvectors = n_subvectors
+        self.rerank = rerank
+        self.train_size = train_size
+        self.block_size = block_size
+        self.seed = seed
+        self.database = None
+
+    def __getstate__(self):
+        """
+        pickle support
+        """
+        state = self.__dict__.copy()
+        state['database'] = None  # the full-precision hashes are not saved with the index
+        return state
+
+    def set_database(self, db):
+        """
+        :param db: database reader (with get_rows()) or array holding the full-precision hashes
+        :return: self
+        """
+        self.database = db
+        return self
+
+    def _rows(self, ids):
+        """
+        :return: full-precision hashes of the given database rows
+        """
+        assert self.database is not None, 'Error! Call set_database() before searching a loaded index.'
+        if hasattr(self.database, 'get_rows'):
+            return np.asarray(self.database.get_rows(ids), dtype=np.float32)
+        return np.asarray(self.database[ids], dtype=np.float32)
+
+    def _project(self, x):
+        """
+        :return: PCA projection of hashes x
+        """
+        return np.dot(np.asarray(x, dtype=np.float32) - self.mean, self.components.T)
+
+    def _encode(self, p):
+        """
+        :param p: PCA projected hashes
+        :return: int8 or uint8 codes
+        """
+        if self.quantizer == 'int8':
+            return np.clip(np.rint(p / self.scale), -127, 127).astype(np.int8)
+        sub = self.n_components // self.n_subvectors
+        codes = np.empty((len(p), self.n_subvectors), dtype=np.uint8)
+        for j in range(self.n_subvectors):
+            x = p[:, j*sub:(j+1)*sub]
+            c = self.codebooks[j]
+            codes[:, j] = (np.einsum('ij,ij->i', c, c)[None, :] - 2 * np.dot(x, c.T)).argmin(axis=1)
+        return codes
+
+    def fit(self, feats):
+        """
+        :param feats: database hashes NxD (can be a np.memmap, it is then encoded block by block)
+        :return: self
+        """
+        n, dim = feats.shape
+        rng = np.random.RandomState(self.seed)
+        sample = np.sort(rng.choice(n, min(n, self.train_size), replace=False))
+        sample = np.asarray(feats[sample], dtype=np.float32)
+        self.n_components = min(self.n_components, dim)
+        # PCA
+        self.mean = sample.mean(axis=0)
+        _, vecs = np.linalg.eigh(np.cov(sample - self.mean, rowvar=False))
+        self.components = np.ascontiguousarray(vecs[:, ::-1][:, :self.n_components].T, dtype=np.float32)
+        # quantiser
+        p = self._project(sample)
+        if self.quantizer == 'int8':
+            self.scale = np.maximum(np.abs(p).max(axis=0), 1e-12) / 127
+        else:
+            sub = self.n_components // self.n_subvectors
+            self.codebooks = np.array([kmeans(p[:, j*sub:(j+1)*sub], min(256, len(p)), seed=self.seed)
+                                       for j in range(self.n_subvectors)], dtype=np.float32)
+        self.codes = np.concatenate([self._encode(self._project(feats[start:start+self.block_size]))
+                                     for start in range(0, n, self.block_size)])
+        if self.quantizer == 'int8':  # norms of the decoded hashes for the blas distance trick
+            self.sq_norms = np.concatenate([((self.codes[start:start+self.block_size] * self.scale)**2).sum(axis=1)
+                                            for start in range(0, n, self.block_size)]).astype(np.float32)
+        self.database = feats
+        return self
+
+    def _candidates(self, p, n_cand):
+        """
+        approximate nearest neighbors on the codes
+        :param p: PCA projected queries M x n_components
+        :param n_cand: number of candidates per query
+        :return: candidate ids M x n_cand
+        """
+        m = len(p)
+        rows = np.arange(m)[:, None]
+        if self.quantizer == 'pq':  # asymmetric distance: per query lookup table of sub-vector distances
+            sub = self.n_components // self.n_subvectors
+            lut = np.stack([((p[:, None, j*sub:(j+1)*sub] - self.codebooks[j][None])**2).sum(axis=2)
+                            for j in range(self.n_subvectors)], axis=1)  # M x n_subvectors x 256
+        best_d = np.full((m, 0), np.inf, dtype=np.float32)
+        best_i = np.zeros((m, 0), dtype=np.int64)
+        for start in range(0, len(self.codes), self.block_size):
+            codes = self.codes[start:start+self.block_size]
+            if self.quantizer == 'int8':
+                d = self.sq_norms[None, start:start+len(codes)] - 2 * np.dot(p, (codes * self.scale).T)
+            else:
+                d = np.zeros((m, len(codes)), dtype=np.float32)
+                for j in range(self.n_subvectors):
+                    d += lut[:, j, codes[:, j]]
+            part = topk_smallest(d, n_cand)
+            cand_d = np.concatenate([best_d, d[rows, part]], axis=1)
+            cand_i = np.concatenate([best_i, part + start], axis=1)
+            keep = topk_smallest(cand_d, n_cand)
+            best_d, best_i = cand_d[rows, keep], cand_i[rows, keep]
+        return best_i
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """
+        k nearest neighbors of several queries: candidates from the codes, exact re-ranking
+        :param X: query hashes MxD
+        :param n_neighbors: number of neighbors (default: the one given at initialisation)
+        :param return_distance: if False only return the ids
+        :return: distances (M x k, exact euclidean, ascending) and ids (M x k)
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        k = min(n_neighbors or self.n_neighbors, len(self.codes))
+        cand = self._candidates(self._project(X), max(k, self.rerank))
+        uids, inverse = np.unique(cand, return_inverse=True)
+        full = self._rows(uids)[inverse.reshape(cand.shape)]  # M x n_cand x D
+        dist = np.sqrt(((full - X[:, None, :])**2).sum(axis=2))
+        rows = np.arange(len(X))[:, None]
+        order = np.argsort(dist, axis=1, kind='stable')[:, :k]
+        dist, ids = dist[rows, order], cand[rows, order]
+        return (dist, ids) if return_distance else ids
+
+
+def index_size(index):
+    """
+    :param index: a fitted search index
+    :return: number of database rows covered by the index
+    """
+    if isinstance(index, IncrementalIndex):
+        return index.n_rows
+    elif isinstance(index, BlasIndex):
+        return len(index.feats)
+    elif isinstance(index, CompressedIndex):
+        return len(index.codes)
+    return index.n_samples_fit_  # sklearn NearestNeighbors
+
+
+class OffsetDatabase(object):
+    """
+    view of a database reader starting at a given row, used by the indexes covering appended rows
+    """
+    def __init__(self, db, offset):
+        self.db = db
+        self.offset = offset
+
+    def get_rows(self, ids):
+        """
+        :param ids: row ids relative to the offset
+        :return: hashes of the given rows
+        """
+        ids = np.asarray(ids) + self.offset
+        if hasattr(self.db, 'get_rows'):
+            return self.db.get_rows(ids)
+        return self.db[ids]
+
+
+class IncrementalIndex(object):
+    """
+    search index made of parts, each covering a contiguous range of database rows
+    New rows are indexed by adding a part instead of rebuilding everything; compact() merges the parts.
+
+    Usage:
+    index = IncrementalIndex('blas').add_rows(feats)  # rows 0..N-1
+    index.add_rows(new_feats)  # rows N..N+M-1
+    dist, ids = index.kneighbors(queries)  # ids are database rows
+    """
+    def __init__(self, algorithm='blas', n_neighbors=1, **kwargs):
+        """
+        initializer
+        :param algorithm: search algorithm of the parts, see build_search_index()
+        :param n_neighbors: default number of neighbors returned by kneighbors
+        :param kwargs: extra settings of the compressed index
+        """
+        assert algorithm in supported_search_algorithms, 'Error! Search algorithm %s not supported.' % algorithm
+        self.algorithm = algorithm
+        self.n_neighbors = n_neighbors
+        self.kwargs = kwargs
+        self.parts = []  # list of (first database row, index over the following rows)
+
+    @classmethod
+    def wrap(cls, index):
+        """
+        turn a plain index (e.g. an older search_index.pkl) into a single part incremental index
+        :param index: fitted index covering the database rows from 0
+        :return: IncrementalIndex
+        """
+        if isinstance(index, IncrementalIndex):
+            return index
+        algorithm = 'blas' if isinstance(index, BlasIndex) else 'compressed' if \
+            isinstance(index, CompressedIndex) else 'ball_tree'
+        out = cls(algorithm, getattr(index, 'n_neighbors', 1))
+        out.parts.append((0, index))
+        return out
+
+    @property
+    def n_rows(self):
+        """
+        number of database rows covered
+        """
+        return max([offset + index_size(index) for offset, index in self.parts] or [0])
+
+    def add_rows(self, feats, offset=None):
+        """
+        index new database rows
+        :param feats: hashes of the new rows
+        :param offset: database row of feats[0] (default: right after the rows already covered)
+        :return: self
+        """
+        offset = self.n_rows if offset is None else offset
+        if len(feats):
+            self.parts.append((offset, build_search_index(feats, self.algorithm, self.n_neighbors, **self.kwargs)))
+        return self
+
+    def merge(self, other):
+        """
+        add the parts of another index which cover rows not covered yet (e.g. a delta index)
+        :param other: IncrementalIndex
+        :return: self
+        """
+        n_rows = self.n_rows
+        self.parts.extend([(offset, index) for offset, index in other.parts if offset >= n_rows])
+        return self
+
+    def compact(self, db):
+        """
+        rebuild a single part over all the covered rows
+        :param db: database reader
+        :return: self
+        """
+        from utils.database import read_hashes
+        n_rows = self.n_rows
+        self.parts = []
+        self.add_rows(read_hashes(db, 0, n_rows), 0)
+        return self
+
+    def set_database(self, db):
+        """
+        :param db: database reader, passed to the parts which re-rank with the database hashes
+        :return: self
+        """
+        for offset, index in self.parts:
+            if hasattr(index, 'set_database'):
+                index.set_database(OffsetDatabase(db, offset) if offset else db)
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """
+        search every part and merge the results
+        :param X: query hashes MxD
+        :param n_neighbors: number of neighbors (default: the one given at initialisation)
+        :param return_distance: if False only return the ids
+        :return: distances (M x k, ascending) and database row ids (M x k)
+        """
+        k = n_neighbors or self.n_neighbors
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        dists, ids = [], []
+        for offset, index in self.parts:
+            dist, idx = index.kneighbors(X, min(k, index_size(index)))
+            dists.append(dist)
+            ids.append(idx + offset)
+        dist, ids = np.concatenate(dists, axis=1), np.concatenate(ids, axis=1)
+        rows = np.arange(len(X))[:, None]
+        order = np.argsort(dist, axis=1, kind='stable')[:, :k]
+        dist, ids = dist[rows, order], ids[rows, order]
+        return (dist, ids) if return_distance else ids
+
+
+def is_directory_index(path):
+    """
+    :param path: path to an index or to its delta
+    :return: True if the index is saved as a directory of memory-mapped arrays (extension .index)
+    """
+    path = path.rstrip('/')
+    if path.endswith('.delta'):
+        path = path[:-len('.delta')]
+    return path.endswith('.index')
+
+
+# part types of a directory index
+directory_index_parts = {'blas': BlasIndex, 'compressed': CompressedIndex}
+
+
+def _save_array(path, a, block_size=65536):
+    """
+    save an array as .npy, block by block so that a memory-mapped input is never loaded at once
+    """
+    if len(a) <= block_size:
+        np.save(path, np.asarray(a))
+        return
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=a.dtype, shape=a.shape)
+    for start in range(0, len(a), block_size):
+        out[start:start+block_size] = a[start:start+block_size]
+    out.flush()
+    del out
+
+
+def _load_array(path):
+    """
+    :return: read-only memmap of a .npy file (a plain array if it is empty, which cannot be mapped)
+    """
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        return np.load(path)
+
+
+def save_index_directory(index, path):
+    """
+    save an index as a directory: index.json plus one .npy file per array
+    New files get a fresh name and index.json is replaced atomically, so a running query process keeps
+    reading the previous version until it reloads.
+    :param index: search index (blas or compressed parts)
+    :param path: output directory
+    """
+    index = IncrementalIndex.wrap(index)
+    names = dict((cls, name) for name, cls in directory_index_parts.items())
+    for _, part in index.parts:  # checked before anything is written
+        assert type(part) in names, 'Error! %s cannot be saved as a directory index, use a .pkl file.' % \
+            type(part).__name__
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    version = '%x' % int(time.time() * 1e6)
+    parts = []
+    for p, (offset, part) in enumerate(index.parts):
+        attrs, arrays = {}, {}
+        for name, value in part.__dict__.items():
+            if name == 'database':  # never saved, see CompressedIndex.set_database()
+                continue
+            if isinstance(value, np.ndarray):
+                arrays[name] = 'part%d_%s.%s.npy' % (p, name, version)
+                _save_array(os.path.join(path, arrays[name]), value)
+            else:
+                attrs[name] = value.item() if isinstance(value, np.generic) else value
+        parts.append(dict(offset=int(offset), type=names[type(part)], attrs=attrs, arrays=arrays))
+    desc = dict(algorithm=index.algorithm, n_neighbors=index.n_neighbors, kwargs=index.kwargs, parts=parts)
+    tmp = os.path.join(path, 'index.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(desc, f, indent=1)
+    os.replace(tmp, os.path.join(path, 'index.json'))
+    used = set(name for part in parts for name in part['arrays'].values())
+    for name in os.listdir(path):  # arrays of the previous version
+        if name.endswith('.npy') and name not in used:
+            os.remove(os.path.join(path, name))
+
+
+def load_index_directory(path):
+    """
+    :param path: directory saved by save_index_directory()
+    :return: IncrementalIndex whose arrays are read-only memmaps
+    """
+    with open(os.path.join(path, 'index.json')) as f:
+        desc = json.load(f)
+    index = IncrementalIndex(desc['algorithm'], desc['n_neighbors'], **desc['kwargs'])
+    for entry in desc['parts']:
+        cls = directory_index_parts[entry['type']]
+        part = cls.__new__(cls)  # restored as saved, without re-running fit()
+        part.__dict__.update(entry['attrs'])
+        for name, filename in entry['arrays'].items():
+            setattr(part, name, _load_array(os.path.join(path, filename)))
+        if cls is CompressedIndex:
+            part.database = None
+        index.parts.append((entry['offset'], part))
+    return index
+
+
+def save_search_index(index, path):
+    """
+    save an index atomically, so that a running query process never reads a partial file
+    :param index: search index
+    :param path: output path, a directory of memory-mapped arrays if it ends with .index (or .index.delta),
+                 a pickle file otherwise
+    """
+    if is_directory_index(path):
+        save_index_directory(index, path)
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(index, f)
+    os.replace(tmp, path)
+
+
+def remove_search_index(path):
+    """
+    delete a saved index (e.g. a stale delta) if it exists
+    :param path: path to the saved index
+    """
+    if os.path.isdir(path):
+        import shutil
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+
+def _load(path):
+    """
+    :return: IncrementalIndex saved at path, in either format
+    """
+    if os.path.isdir(path):
+        return load_index_directory(path)
+    with open(path, 'rb') as f:
+        return IncrementalIndex.wrap(pickle.load(f))
+
+
+def load_search_index(path, db=None, delta=True):
+    """
+    load a saved index and its pending delta (<path>.delta) if any
+    With delta and a database, the database rows covered by neither (appended since the last build or update)
+    are indexed in memory, so that every row is searched.
+    :param path: path to the saved index (pickle file or .index directory)
+    :param db: database reader, needed by the compressed index
+    :param delta: if False only load the main index
+    :return: IncrementalIndex
+    """
+    index = _load(path)
+    if delta and os.path.exists(path.rstrip('/') + '.delta'):
+        index.merge(_load(path.rstrip('/') + '.delta'))  # parts already compacted into the main index are skipped
+    if db is not None:
+        n = len(db.get_thresholds())
+        if delta and n > index.n_rows:
+            from utils.database import read_hashes
+            print('Indexing the %d rows appended since the last build, run build_searchtree.py --update to save '
+                  'them.' % (n - index.n_rows))
+            index.add_rows(read_hashes(db, index.n_rows, n))
+        index.set_database(db)
+    return index
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+selfjoin.py
+all-pairs near-duplicate search inside a hash database, and clustering of the pairs found
+
+Rows i < j form a semantic pair if |h_i - h_j| <= max(ths[i], ths[j]), i.e. either image would be
+reported by check.py when the other one is the query. The database is compared with itself block by block:
+each pair of blocks is one BLAS matrix product (see BlasIndex in utils/search.py), so the memory is bounded
+by a few blocks whatever the database size. Block pairs are processed concurrently by a thread pool, numpy
+releases the GIL in the matrix products.
+
+Usage:
+for i, j, dist in self_join(db, block_size=4096, workers=8):
+    ...
+groups = clusters(len(db.get_thresholds()), pairs)
+See selfjoin.py for the command line tool.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .database import H5pyData
+
+
+def _block_pairs(a0, feats_a, ths_a, b0, feats_b, ths_b):
+    """
+    semantic pairs between two blocks of rows
+    :param a0: first row of block a
+    :param feats_a: hashes of block a
+    :param ths_a: thresholds of block a
+    :param b0: first row of block b (b0 >= a0)
+    :return: (i, j, dist) arrays, global rows with i < j
+    """
+    sq_a = np.einsum('ij,ij->i', feats_a, feats_a)
+    sq_b = np.einsum('ij,ij->i', feats_b, feats_b)
+    d2 = np.dot(feats_a, feats_b.T)
+    d2 *= -2
+    d2 += sq_a[:, None]
+    d2 += sq_b[None, :]
+    th = np.maximum(ths_a[:, None], ths_b[None, :])
+    mask = d2 <= th * th
+    if a0 == b0:
+        mask &= np.triu(np.ones(mask.shape, dtype=bool), 1)  # each pair once, no self pairs
+    i, j = np.nonzero(mask)
+    dist = np.sqrt(np.maximum(d2[i, j], 0))
+    return i + a0, j + b0, dist
+
+
+def self_join(db, block_size=4096, workers=4):
+    """
+    find all semantic pairs of a hash database
+    :param db: database reader
+    :param block_size: rows per block; each worker holds two blocks of hashes and block_size^2 distances
+    :param workers: number of threads
+    :return: generator of (i, j, dist) arrays (rows i < j, euclidean distance), one per pair of blocks
+    """
+    # row slices of the hashes without loading the whole database (hdf5 dataset or memmap)
+    feats = db.data['feats'] if isinstance(db, H5pyData) else db.get_hashes()
+    ths = np.asarray(db.get_thresholds(), dtype=np.float32)
+    n = len(ths)
+
+    def read(start):
+        stop = min(start + block_size, n)  # an hdf5 dataset may hold rows beyond the database
+        return start, np.asarray(feats[start:stop], dtype=np.float32), ths[start:stop]
+
+    pool = ThreadPoolExecutor(max(1, workers))
+    try:
+        pending = []
+        for a0 in range(0, n, block_size):
+            block_a = read(a0)
+            for b0 in range(a0, n, block_size):
+                block_b = block_a if b0 == a0 else read(b0)
+                pending.append(pool.submit(_block_pairs, *(block_a + block_b)))
+                while len(pending) >= 2 * max(1, workers):  # bound the blocks held in memory
+                    yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+    finally:
+        pool.shutdown(wait=False)
+
+
+class UnionFind(object):
+    """
+    disjoint sets over rows 0..n-1, with path halving and union by size
+    """
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+        self.size = np.ones(n, dtype=np.int64)
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x == y:
+            return
+        if self.size[x] < self.size[y]:
+            x, y = y, x
+        self.parent[y] = x
+        self.size[x] += self.size[y]
+
+
+def clusters(n, pairs):
+    """
+    connected components of the duplicate pairs
+    :param n: number of rows
+    :param pairs: iterable of (i, j) rows
+    :return: list of clusters (sorted lists of rows, 2 rows or more), largest first
+    """
+    uf = UnionFind(n)
+    rows = set()
+    for i, j in pairs:
+        uf.union(int(i), int(j))
+        rows.update((int(i), int(j)))
+    groups = {}
+    for row in sorted(rows):
+        groups.setdefault(uf.find(row), []).append(row)
+    return sorted(groups.values(), key=lambda g: (-len(g), g[0]))
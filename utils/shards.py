@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+shards.py
+sharded hash database with scatter-gather nearest neighbor search
+
+The database is split into shards, each with its own hash database, search index and slice of the image
+list, described by a json manifest (see build_shards.py):
+{"shards": [{"database": "shard_000.mmap", "search_index": "shard_000.index", "image_list": "shard_000.txt",
+             "offset": 0, "rows": 1000000},
+            {"database": ..., "offset": 1000000, "rows": 1000000, "address": "node2:5000"}, ...]}
+Paths are relative to the manifest. offset is the global id of the first row of the shard.
+Shards with an address are served by a shard worker on that node (shard_worker.py); the others are
+loaded in this process, or started as local worker processes with ShardedIndex(..., processes=True).
+
+ShardedIndex has the kneighbors() interface of the other search engines (utils/search.py) and returns
+global ids, so check.py only needs its thresholds and image_list lookups to run the usual threshold and
+geometry checks:
+index = ShardedIndex('shards.json')
+dist, ids = index.kneighbors(queries, 5)  # top-5 of every shard, merged
+index.thresholds[ids[0, 0]], index.image_list[ids[0, 0]]
+
+Worker protocol: one json object per line in each direction, arrays are packed with pack_array()
+request:  {"op": "search", "queries": array, "k": k}
+response: {"dist": array, "ids": array, "ths": array, "paths": [[...]]}  (global ids, M x k)
+request:  {"op": "rows", "ids": [global ids]}
+response: {"ths": [...], "paths": [...]}
+or {"error": message}
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import base64
+import bisect
+import atexit
+import socket
+import subprocess
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .database import get_database_reader
+from .search import BlasIndex, load_search_index
+
+
+def read_manifest(path):
+    """
+    :param path: path to the json manifest
+    :return: list of shard entries (dicts) sorted by offset, with paths made absolute
+    """
+    with open(path, 'r') as f:
+        shards = json.load(f)['shards']
+    root = os.path.dirname(os.path.abspath(path))
+    for shard in shards:
+        for key in ['database', 'search_index', 'image_list']:
+            if shard.get(key):
+                shard[key] = os.path.join(root, shard[key])
+    shards = sorted(shards, key=lambda s: s['offset'])
+    for prev, shard in zip(shards, shards[1:]):
+        assert prev['offset'] + prev['rows'] == shard['offset'], 'Error! Shards of %s are not contiguous.' % path
+    return shards
+
+
+def write_manifest(path, shards):
+    """
+    :param path: output json manifest
+    :param shards: list of shard entries, paths relative to the manifest
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'shards': shards}, f, indent=2)
+    os.replace(tmp, path)
+
+
+def pack_array(a):
+    """
+    :param a: numpy array
+    :return: json serialisable dict
+    """
+    a = np.ascontiguousarray(a)
+    return {'dtype': a.dtype.str, 'shape': list(a.shape), 'data': base64.b64encode(a.tobytes()).decode('ascii')}
+
+
+def unpack_array(d):
+    """
+    :param d: dict made by pack_array()
+    :return: numpy array
+    """
+    return np.frombuffer(base64.b64decode(d['data']), dtype=np.dtype(d['dtype'])).reshape(d['shape'])
+
+
+class LocalShard(object):
+    """
+    shard loaded in this process
+    """
+    def __init__(self, entry):
+        """
+        :param entry: shard entry of the manifest
+        """
+        self.offset = entry['offset']
+        db = get_database_reader(entry['database'])
+        self.ths = np.asarray(db.get_thresholds())
+        assert len(self.ths) == entry['rows'], 'Error! Shard %s has %d rows, %d expected.' % (
+            entry['database'], len(self.ths), entry['rows'])
+        if entry.get('search_index'):
+            self.search = load_search_index(entry['search_index'], db)
+        else:
+            self.search = BlasIndex().fit(db.get_hashes())
+        if entry.get('image_list'):
+            import pandas as pd
+            self.image_list = pd.read_csv(entry['image_list'], header=None)[0].tolist()
+        else:  # paths stored in the shard database (see ingest.py)
+            self.image_list = db.get_paths()
+
+    def search_rows(self, X, k):
+        """
+        :param X: query hashes MxD
+        :param k: number of neighbors
+        :return: dict of distances, global ids, thresholds and paths (M x k)
+        """
+        dist, ids = self.search.kneighbors(X, min(k, len(self.ths)))
+        return dict(dist=dist, ids=ids + self.offset, ths=self.ths[ids],
+                    paths=[[self.image_list[i] for i in row] for row in ids])
+
+    def rows(self, ids):
+        """
+        :param ids: global ids of rows of this shard
+        :return: (thresholds, paths)
+        """
+        ids = np.asarray(ids, dtype=np.int64) - self.offset
+        return self.ths[ids], [self.image_list[i] for i in ids]
+
+
+class RemoteShard(object):
+    """
+    shard served by a shard worker, one connection per request
+    """
+    def __init__(self, address, timeout=60):
+        """
+        :param address: 'host:port' of the worker
+        :param timeout: socket timeout in seconds
+        """
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.timeout = timeout
+
+    def _call(self, request):
+        """
+        :param request: json serialisable dict
+        :return: response dict
+        """
+        sock = socket.create_connection(self.address, self.timeout)
+        try:
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            with sock.makefile('rb') as f:
+                res = json.loads(f.readline().decode('utf-8'))
+        finally:
+            sock.close()
+        if 'error' in res:
+            raise RuntimeError('Error! Shard worker %s:%d: %s' % (self.address + (res['error'],)))
+        return res
+
+    def search_rows(self, X, k):
+        """
+        see LocalShard.search_rows()
+        """
+        res = self._call({'op': 'search', 'queries': pack_array(np.asarray(X, dtype=np.float32)), 'k': k})
+        return dict(dist=unpack_array(res['dist']), ids=unpack_array(res['ids']), ths=unpack_array(res['ths']),
+                    paths=res['paths'])
+
+    def rows(self, ids):
+        """
+        see LocalShard.rows()
+        """
+        res = self._call({'op': 'rows', 'ids': [int(i) for i in ids]})
+        return np.asarray(res['ths'], dtype=np.float32), res['paths']
+
+
+class ShardHandler(socketserver.StreamRequestHandler):
+    """
+    answer the json requests of a connection, see the protocol above
+    """
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                break
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if request['op'] == 'search':
+                    res = self.server.shard.search_rows(unpack_array(request['queries']), request['k'])
+                    res = dict(dist=pack_array(res['dist']), ids=pack_array(res['ids']),
+                               ths=pack_array(res['ths']), paths=res['paths'])
+                elif request['op'] == 'rows':
+                    ths, paths = self.server.shard.rows(request['ids'])
+                    res = dict(ths=ths.tolist(), paths=paths)
+                else:
+                    res = {'error': 'Unknown op %s' % request['op']}
+            except Exception as e:
+                res = {'error': str(e)}
+            self.wfile.write((json.dumps(res) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class ShardServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    TCP server of a LocalShard (see shard_worker.py); numpy searches release the GIL so requests are
+    answered by concurrent threads
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, shard):
+        socketserver.TCPServer.__init__(self, address, ShardHandler)
+        self.shard = shard
+
+
+def spawn_shard_worker(manifest, shard_id, host='127.0.0.1'):
+    """
+    start shard_worker.py as a local process on a free port
+    :param manifest: path to the manifest
+    :param shard_id: position of the shard in the manifest
+    :param host: interface to listen on
+    :return: (subprocess.Popen, 'host:port')
+    """
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shard_worker.py')
+    proc = subprocess.Popen([sys.executable, script, '-m', manifest, '-i', str(shard_id), '--host', host,
+                             '--port', '0'], stdout=subprocess.PIPE, universal_newlines=True)
+    for line in proc.stdout:  # loading messages, then the address once ready
+        match = re.search(r'Listening on (\S+):(\d+)', line)
+        if match:
+            return proc, '%s:%s' % match.groups()
+    raise RuntimeError('Error! Shard worker %d exited with code %s.' % (shard_id, proc.wait()))
+
+
+class ShardLookup(object):
+    """
+    per-row lookup (thresholds or image paths) over all shards, indexed by global id
+    rows returned by the last search are answered from a cache, the others are asked to their shard
+    """
+    def __init__(self, index, field):
+        """
+        :param index: ShardedIndex
+        :param field: 0 for thresholds, 1 for paths
+        """
+        self.index = index
+        self.field = field
+
+    def __len__(self):
+        return self.index.n_rows
+
+    def __getitem__(self, i):
+        i = int(i)
+        row = self.index.cache.get(i)
+        if row is None:
+            shard = self.index.shard_of(i)
+            ths, paths = shard.rows([i])
+            row = (ths[0], paths[0])
+        return row[self.field]
+
+
+class ShardedIndex(object):
+    """
+    scatter-gather search over the shards of a manifest
+    Every shard is searched concurrently for its k nearest rows and the results are merged into the
+    global k nearest, so the result is the same as a single index over the whole database.
+    """
+    def __init__(self, manifest, n_neighbors=1, processes=False):
+        """
+        initializer
+        :param manifest: path to the json manifest
+        :param n_neighbors: default number of neighbors returned by kneighbors
+        :param processes: if True start a local worker process for each shard without an address,
+                          otherwise load those shards in this process
+        """
+        self.n_neighbors = n_neighbors
+        entries = read_manifest(manifest)
+        self.offsets = [entry['offset'] for entry in entries]
+        self.n_rows = entries[-1]['offset'] + entries[-1]['rows'] if entries else 0
+        self.procs = []
+        self.shards = []
+        for i, entry in enumerate(entries):
+            if entry.get('address'):
+                self.shards.append(RemoteShard(entry['address']))
+            elif processes:
+                if not self.procs:
+                    atexit.register(self.close)
+                proc, address = spawn_shard_worker(manifest, i)
+                self.procs.append(proc)
+                self.shards.append(RemoteShard(address))
+            else:
+                print('Loading shard %d/%d ...' % (i + 1, len(entries)))
+                self.shards.append(LocalShard(entry))
+        self.pool = ThreadPoolExecutor(max(1, len(self.shards)))
+        self.cache = {}  # global id: (threshold, path) of the rows returned by the last search
+        self.thresholds = ShardLookup(self, 0)
+        self.image_list = ShardLookup(self, 1)
+
+    def shard_of(self, i):
+        """
+        :param i: global id
+        :return: shard holding row i
+        """
+        assert 0 <= i < self.n_rows, 'Error! Row %d out of range.' % i
+        return self.shards[bisect.bisect_right(self.offsets, i) - 1]
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """
+        :param X: query hashes MxD
+        :param n_neighbors: number of neighbors (default: the one given at initialisation)
+        :param return_distance: if False only return the ids
+        :return: distances (M x k, ascending) and global ids (M x k)
+        """
+        k = n_neighbors or self.n_neighbors
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        results = list(self.pool.map(lambda shard: shard.search_rows(X, k), self.shards))
+        dist = np.concatenate([res['dist'] for res in results], axis=1)
+        ids = np.concatenate([res['ids'] for res in results], axis=1)
+        ths = np.concatenate([res['ths'] for res in results], axis=1)
+        paths = [sum((res['paths'][m] for res in results), []) for m in range(len(X))]
+        rows = np.arange(len(X))[:, None]
+        order = np.argsort(dist, axis=1, kind='stable')[:, :k]
+        cache = {}
+        for m, row in enumerate(order):
+            for j in row:
+                cache[int(ids[m, j])] = (ths[m, j], paths[m][j])
+        self.cache = cache
+        dist, ids = dist[rows, order], ids[rows, order]
+        return (dist, ids) if return_distance else ids
+
+    def close(self):
+        """
+        stop the local worker processes
+        """
+        self.pool.shutdown(wait=False)
+        for proc in self.procs:
+            proc.terminate()
+            proc.wait()
+        self.procs = []